@@ -0,0 +1,441 @@
+"""
+Title:   bench.py
+Date:    10/17/26
+Purpose: Benchmark suite for the main phases of a run
+Notes:   Each benchmark file uses the same format as a parameter file, except that
+            any value can be a comma separated list to sweep over (see
+            benchmarks/). Grid creation, field initialization, diffusion and path
+            accumulation are timed separately for every combination, and the results
+            are saved as JSON so that two commits can be compared:
+
+                python bench.py benchmarks/*.txt -o new.json
+                python bench.py --compare old.json new.json
+
+            Cases run at single precision (precision : single) are also run again at
+            double precision, and how far the end points and the mean squared
+            displacement are from the double precision ones is saved with the timings.
+            A case whose error is over --error-bound makes the run fail.
+
+            Every run also times how long main.py takes to start a run (see
+            startup_case), and fails if that pulls in matplotlib, scipy or h5py or
+            takes longer than --max-startup.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import grid
+import user_fields as uf
+import utils
+
+
+
+# Run in a fresh interpreter by startup_case. The modules to look for are passed as
+# arguments
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+args = main.parse_args(['run', 'params.txt'])
+import grid, instrument, output, user_fields, utils
+print(json.dumps({'seconds' : time.perf_counter() - start,
+    'loaded' : [m for m in sys.argv[1:] if m in sys.modules]}))
+'''
+
+
+
+#============================================
+#                  measure
+#============================================
+def measure(func, *args, **kwargs):
+    """
+    Calls func and records how long it took and the peak amount of memory allocated
+    while it ran. The memory is tracked with tracemalloc, which sees NumPy's
+    allocations but not those made by worker processes.
+
+    Parameters:
+    -----------
+        func : function
+            The function to time
+
+        args, kwargs :
+            Passed on to func
+
+    Returns:
+    --------
+        out : object
+            Whatever func returned
+
+        seconds : float
+            Wall time
+
+        peakBytes : int
+            Peak memory allocated during the call
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        out = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peakBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return out, seconds, peakBytes
+
+
+
+#============================================
+#                  run_case
+#============================================
+def run_case(params, seed=0):
+    """
+    Runs and times every phase for one set of parameters.
+
+    Parameters:
+    -----------
+        params : dict
+            One combination of benchmark parameters. ndims, ncells, boxSize, npaths,
+            nsteps and stepSize are required. integrator, tol, interpolate, workers
+            and precision are optional
+
+        seed : int
+            Seed for the field and the starting points
+
+    Returns:
+    --------
+        result : dict
+            The parameters and, for each phase, its time, peak memory and throughput.
+            Single precision cases also have their error (see precision_error)
+    """
+    np.random.seed(seed)
+    ndims = params['ndims']
+    ncells = params['ncells']
+    boxSize = params['boxSize']
+    npaths = params['npaths']
+    nsteps = params['nsteps']
+    nCellsTotal = ncells**ndims
+    pathSteps = npaths * nsteps
+    phases = {}
+    # Grid creation (_create_grid is called from the constructor)
+    precision = params.get('precision', 'double')
+    g, seconds, peak = measure(grid.Grid, ndims, ncells, boxSize, precision=precision)
+    phases['create_grid'] = (seconds, peak, nCellsTotal, 'cells/s')
+    field = uf.OceanCurrent(seed)
+    _, seconds, peak = measure(g.init_field, field)
+    phases['init_field'] = (seconds, peak, nCellsTotal, 'cells/s')
+    start = np.random.uniform(0., boxSize, (npaths, ndims))
+    g.init_paths(npaths, start)
+    _, seconds, peak = measure(g.diffuse, field, nsteps, params['stepSize'],
+        workers=params.get('workers', 1), **scheme(params))
+    phases['diffuse'] = (seconds, peak, pathSteps, 'path-steps/s')
+    error = None
+    if precision != 'double':
+        error = precision_error(params, seed, start, g.paths.curPos)
+    _, seconds, peak = measure(g.path_accumulation, field)
+    phases['path_accumulation'] = (seconds, peak, pathSteps, 'path-steps/s')
+    result = {'params' : params, 'phases' : {}}
+    for name, (seconds, peak, work, unit) in phases.items():
+        result['phases'][name] = {
+            'seconds'    : seconds,
+            'peakBytes'  : peak,
+            'throughput' : work / seconds if seconds > 0. else float('inf'),
+            'unit'       : unit,
+        }
+    if error is not None:
+        result['error'] = error
+    return result
+
+
+
+#============================================
+#                  scheme
+#============================================
+def scheme(params):
+    # The integration options of a case, as keywords for Grid.diffuse
+    tol = params.get('tol')
+    return {
+        'integrator'  : params.get('integrator', 'euler'),
+        'tol'         : None if tol is None else float(tol),
+        'interpolate' : params.get('interpolate'),
+    }
+
+
+
+#============================================
+#              precision_error
+#============================================
+def precision_error(params, seed, start, ends):
+    """
+    Runs a case again at double precision and measures how far the given end points
+    are from it.
+
+    Paths that follow the value in the cell they're in (the default, without
+    interpolation) can land on the other side of a cell edge from the reference
+    after a rounding error, and from then on they go their own way. So a few paths
+    can end up far from their reference no matter the precision, and it's the bulk
+    of the ensemble (the 99th percentile) and the ensemble statistics that are
+    bounded.
+
+    Parameters:
+    -----------
+        params : dict
+            The case (see run_case)
+
+        seed : int
+            The seed the case was run with
+
+        start : ndarray
+            The (npaths, ndims) starting points the case was run from
+
+        ends : ndarray
+            Where the paths ended up
+
+    Returns:
+    --------
+        error : dict
+            maxError and p99Error, the largest and 99th percentile distance from the
+            reference end points in cell widths, and msdError, the relative error of
+            the mean squared displacement
+    """
+    g = grid.Grid(params['ndims'], params['ncells'], params['boxSize'])
+    field = uf.OceanCurrent(seed)
+    g.init_field(field)
+    g.init_paths(params['npaths'], start)
+    g.diffuse(field, params['nsteps'], params['stepSize'], history='endpoints',
+        **scheme(params))
+    ref = g.paths.curPos
+    dist = np.linalg.norm(ends - ref, axis=1) / g.cellWidth
+    msd = ((ends - start)**2).sum(axis=1).mean()
+    msdRef = ((ref - start)**2).sum(axis=1).mean()
+    return {
+        'maxError' : float(dist.max()),
+        'p99Error' : float(np.percentile(dist, 99.)),
+        'msdError' : float(abs(msd / msdRef - 1.)) if msdRef > 0. else 0.,
+    }
+
+
+
+#============================================
+#               startup_case
+#============================================
+def startup_case(heavy=('matplotlib', 'scipy', 'h5py')):
+    """
+    Times how long it takes main.py to get to the point of reading the parameter file
+    for a run: importing it, parsing the command line and importing everything the
+    run subcommand uses. This is done in a fresh interpreter, since anything already
+    imported here would be free. The interpreter's own start up isn't counted.
+
+    Parameters:
+    -----------
+        heavy : tuple
+            Modules a run without a plot shouldn't load
+
+    Returns:
+    --------
+        result : dict
+            In the same form as run_case, with the time as the import_run phase. The
+            heavy modules that were loaded anyway are in heavyModules
+    """
+    out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, *heavy],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    report = json.loads(out.strip().splitlines()[-1])
+    seconds = report['seconds']
+    return {
+        'params'       : {'case' : 'startup'},
+        'phases'       : {'import_run' : {
+            'seconds'    : seconds,
+            'peakBytes'  : 0,
+            'throughput' : 1. / seconds if seconds > 0. else float('inf'),
+            'unit'       : 'starts/s',
+        }},
+        'heavyModules' : report['loaded'],
+    }
+
+
+
+#============================================
+#                 get_meta
+#============================================
+def get_meta():
+    # Where the numbers came from, so that comparisons are between like and like
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit'   : commit,
+        'python'   : platform.python_version(),
+        'numpy'    : np.__version__,
+        'platform' : platform.platform(),
+        'date'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+
+#============================================
+#                 case_key
+#============================================
+def case_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+
+#============================================
+#                case_label
+#============================================
+def case_label(params):
+    # How a case is shown in the tables: its parameters as key=value pairs
+    return ' '.join('{}={}'.format(k, v) for k, v in params.items())
+
+
+
+#============================================
+#               print_results
+#============================================
+def print_results(results):
+    cases = [case_label(result['params']) for result in results]
+    # The case column is as wide as the longest label, so none are cut off
+    width = max([len('case')] + [len(case) for case in cases])
+    header = '{:<{w}} {:<18} {:>10} {:>12} {:>16}'
+    print(header.format('case', 'phase', 'seconds', 'peak MB', 'throughput', w=width))
+    for case, result in zip(cases, results):
+        for name, phase in result['phases'].items():
+            print('{:<{w}} {:<18} {:>10.4f} {:>12.1f} {:>11.3e} {}'.format(case, name,
+                phase['seconds'], phase['peakBytes'] / 2.**20, phase['throughput'],
+                phase['unit'], w=width))
+        if 'error' in result:
+            print('{:<{w}} {:<18} max {:.3e} p99 {:.3e} cells, msd {:.3e}'.format(
+                case, 'precision_error', result['error']['maxError'],
+                result['error']['p99Error'], result['error']['msdError'], w=width))
+
+
+
+#============================================
+#                  compare
+#============================================
+def compare(oldFile, newFile, tolerance):
+    """
+    Prints the new/old time ratio for every phase of every case the two runs have in
+    common.
+
+    Parameters:
+    -----------
+        oldFile, newFile : str
+            JSON files written by this script
+
+        tolerance : float
+            Slowdowns by more than this fraction are flagged as regressions
+
+    Returns:
+    --------
+        nregressions : int
+            The number of flagged phases
+    """
+    with open(oldFile, 'r') as f:
+        old = {case_key(r['params']) : r for r in json.load(f)['results']}
+    with open(newFile, 'r') as f:
+        new = {case_key(r['params']) : r for r in json.load(f)['results']}
+    nregressions = 0
+    keys = sorted(set(old) & set(new))
+    cases = [case_label(json.loads(key)) for key in keys]
+    width = max([len('case')] + [len(case) for case in cases])
+    print('{:<{w}} {:<18} {:>10} {:>10} {:>8}'.format('case', 'phase', 'old s', 'new s',
+        'ratio', w=width))
+    for case, key in zip(cases, keys):
+        for name, phase in new[key]['phases'].items():
+            if name not in old[key]['phases']:
+                continue
+            before = old[key]['phases'][name]['seconds']
+            after = phase['seconds']
+            ratio = after / before if before > 0. else float('inf')
+            flag = ''
+            if ratio > 1. + tolerance:
+                flag = '  REGRESSION'
+                nregressions += 1
+            print('{:<{w}} {:<18} {:>10.4f} {:>10.4f} {:>8.2f}{}'.format(case, name,
+                before, after, ratio, flag, w=width))
+    return nregressions
+
+
+
+#============================================
+#                parse_args
+#============================================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time the phases of a run')
+    parser.add_argument('benchFiles', nargs='*',
+        help='Benchmark files (parameter files whose values can be lists)')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+        help='Where to save the results')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+        help='Run each case this many times and keep the fastest')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two result files instead of running anything')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='Fractional slowdown that counts as a regression in --compare')
+    parser.add_argument('--error-bound', type=float, default=1e-2,
+        help='Largest p99 end point error (in cell widths) and relative MSD error '
+            'allowed for single precision cases')
+    parser.add_argument('--max-startup', type=float, default=0.5,
+        help='Longest time (in seconds) main.py may take to start a run')
+    return parser.parse_args(argv)
+
+
+
+#============================================
+#                   main
+#============================================
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.tolerance) else 0)
+    if not args.benchFiles:
+        print('Usage: python bench.py benchmarks/*.txt [-o results.json]')
+        sys.exit(1)
+    results = []
+    for fname in args.benchFiles:
+        for params in utils.expand_sweep(utils.read_sweep_file(fname)):
+            runs = [run_case(params) for _ in range(args.repeat)]
+            # Keep the fastest run of each phase
+            best = runs[0]
+            for run in runs[1:]:
+                for name, phase in run['phases'].items():
+                    if phase['seconds'] < best['phases'][name]['seconds']:
+                        best['phases'][name] = phase
+            results.append(best)
+    startup = min((startup_case() for _ in range(args.repeat)),
+        key=lambda r: r['phases']['import_run']['seconds'])
+    results.append(startup)
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump({'meta' : get_meta(), 'results' : results}, f, indent=2)
+    failed = [r for r in results if 'error' in r and
+        max(r['error']['p99Error'], r['error']['msdError']) > args.error_bound]
+    for result in failed:
+        print('Precision error over {} for {}'.format(args.error_bound,
+            case_key(result['params'])))
+    if startup['heavyModules']:
+        print('Starting a run loads {}'.format(', '.join(startup['heavyModules'])))
+        failed.append(startup)
+    if startup['phases']['import_run']['seconds'] > args.max_startup:
+        print('Starting a run takes more than {} s'.format(args.max_startup))
+        failed.append(startup)
+    if failed:
+        sys.exit(1)
+
+
+
+#============================================
+#               Run Program
+#============================================
+if __name__ == '__main__':
+    main()
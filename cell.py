@@ -3,31 +3,105 @@ Title:   cell.py
 Author:  Jared Coughlin
 Date:    3/13/19
 Purpose: Contains the cell class
-Notes:
+Notes:   Cells no longer own any data. The grid keeps one contiguous array per field
+            and a Cell is just a thin view onto a single element of those arrays. This
+            keeps the old grid[ind][field.name] style of access working without paying
+            for one Python object per cell.
 """
+import numpy as np
 
 
 
 #============================================
 #                Cell Class
 #============================================
-class Cell(dict):
+class Cell():
     """
     This class is for an individual cell. Each cell contains a region in space and
-    stores information about various quantities in that region.
+    stores information about various quantities in that region. It's a view: the
+    values themselves live in the grid's field arrays, so cells are cheap to make and
+    can be thrown away as soon as they're used.
 
     Parameters:
+    -----------
+        grid : Grid Class
+            The grid that owns the field arrays
+
+        index : tuple
+            The multi-index of the cell within the grid
+
+    Attributes:
     -----------
         loc : ndarray
             This array contains the location of the cell's center
 
-        cellWidth : float
+        width : float
             The width of the cell in each dimension. Assumed to be the same for each
             dimension.
 
+    Methods:
+    --------
+        keys()
+            The names of the fields defined on the grid
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, grid, index):
+        self._grid = grid
+        self.index = index
+        self.loc   = grid.cell_center(index)
+        self.width = grid.cellWidth
+
+    #-----
+    # __getitem__
+    #-----
+    def __getitem__(self, name):
+        return self._grid.fields[name][self.index]
+
+    #-----
+    # __setitem__
+    #-----
+    def __setitem__(self, name, value):
+        self._grid.fields[name][self.index] = value
+        self._grid.invalidate(name)
+
+    #-----
+    # __contains__
+    #-----
+    def __contains__(self, name):
+        return name in self._grid.fields
+
+    #-----
+    # keys
+    #-----
+    def keys(self):
+        return self._grid.fields.keys()
+
+
+
+#============================================
+#              CellArray Class
+#============================================
+class CellArray():
+    """
+    Compatibility stand-in for the old object array of cells. Indexing it with a
+    multi-index hands back a Cell view for that location, so code written against the
+    old layout (e.g., Path.update) keeps working. Nothing is allocated per cell, so
+    making one of these is O(1) no matter how large the grid is.
+
+    Parameters:
+    -----------
+        grid : Grid Class
+            The grid being viewed
+
     Attributes:
     -----------
-        pass
+        grid : Grid Class
+            The grid being viewed
+
+        shape : tuple
+            The number of cells along each dimension
 
     Methods:
     --------
@@ -36,6 +110,49 @@ class Cell(dict):
     #-----
     # Constructor
     #-----
-    def __init__(self, loc, cellWidth):
-        self.loc   = loc
-        self.width = cellWidth
+    def __init__(self, grid):
+        self.grid = grid
+
+    #-----
+    # shape
+    #-----
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    #-----
+    # ndim
+    #-----
+    @property
+    def ndim(self):
+        return len(self.grid.shape)
+
+    #-----
+    # size
+    #-----
+    @property
+    def size(self):
+        return int(np.prod(self.grid.shape))
+
+    #-----
+    # __getitem__
+    #-----
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        return Cell(self.grid, tuple(int(i) for i in index))
+
+    #-----
+    # __len__
+    #-----
+    def __len__(self):
+        return self.grid.shape[0]
+
+    #-----
+    # __iter__
+    #-----
+    def __iter__(self):
+        # This visits every cell one at a time, so it's only here for convenience on
+        # small grids. Anything performance sensitive should use the field arrays
+        for index in np.ndindex(*self.grid.shape):
+            yield Cell(self.grid, index)
@@ -0,0 +1,502 @@
+"""
+Title:   decomp.py
+Date:    10/17/26
+Purpose: Domain decomposed path advection
+Notes:   The grid is cut into slabs along the first axis and each worker process owns
+            one slab: it only ever holds its own part of the field plus a halo of
+            ghost cells deep enough to cover any stage of a single step. Every step,
+            each worker advances the paths in its slab and then hands the ones that
+            left it to their new owner. The exchange is an all-to-all over
+            multiprocessing queues (standing in for MPI), one batch per pair of
+            workers per step, so the workers stay in lockstep until every path has
+            taken all of its steps.
+
+            The slab edges are placed so that each slab starts with about the same
+            number of paths, which keeps skewed distributions balanced. If the paths
+            drift, the run can be split into segments with the slabs redrawn in
+            between (rebalanceEvery).
+"""
+import multiprocessing as mp
+import pickle
+import queue
+import traceback
+
+import numpy as np
+
+import integrators
+
+
+
+#============================================
+#              slab_bounds
+#============================================
+def slab_bounds(g, pos, nslabs, minWidth=1):
+    """
+    Picks slab edges (in cells along the first axis) so that every slab holds about
+    the same number of paths.
+
+    Parameters:
+    -----------
+        g : Grid Class
+            The grid being split
+
+        pos : ndarray
+            The (npaths, ndims) positions of the paths
+
+        nslabs : int
+            The number of slabs
+
+        minWidth : int
+            The fewest cells a slab can have
+
+    Returns:
+    --------
+        bounds : ndarray
+            nslabs + 1 cell edges, starting at 0 and ending at ncells
+    """
+    nslabs = min(nslabs, g.ncells // minWidth)
+    cells = _first_axis_cell(g, pos)
+    counts = np.bincount(cells, minlength=g.ncells)
+    # Cut the cumulative count into equal parts, then make sure every slab keeps
+    # at least minWidth cells
+    cum = np.cumsum(counts)
+    targets = cum[-1] * np.arange(1, nslabs) / nslabs
+    inner = np.searchsorted(cum, targets, side='left') + 1
+    bounds = np.concatenate([[0], inner, [g.ncells]])
+    for i in range(1, nslabs + 1):
+        bounds[i] = max(bounds[i], bounds[i-1] + minWidth)
+    for i in range(nslabs - 1, 0, -1):
+        bounds[i] = min(bounds[i], bounds[i+1] - minWidth)
+    return bounds
+
+
+
+#============================================
+#             _first_axis_cell
+#============================================
+def _first_axis_cell(g, pos):
+    # The cell each (wrapped) position is in along the first axis
+    x = (g.wrap(pos)[:, 0] - g.origin[0]) / g.cellWidth
+    return np.clip(np.floor(x).astype(np.intp), 0, g.ncells - 1)
+
+
+
+#============================================
+#               _slab_data
+#============================================
+def _slab_data(g, name, lo, hi, halo):
+    """
+    Pulls one slab of a field (plus its halo) out of the full field. Only the cells
+    in the slab are read, so fields on disk or lazy fields are never loaded whole.
+
+    Returns:
+    --------
+        data : ndarray
+            The slab, with the first axis covering cells start, start+1, ...
+
+        start : int
+            The (global) first axis cell of the first row of data. Along a periodic
+            axis this can be negative
+    """
+    n = g.ncells
+    if g._periodic[0]:
+        start = lo - halo
+        rows = np.arange(start, hi + halo) % n
+    else:
+        start = max(lo - halo, 0)
+        rows = np.arange(start, min(hi + halo, n))
+    data = g.fields[name]
+    if isinstance(data, np.ndarray):
+        return data[rows], start
+    rest = np.indices(g.shape[1:]).reshape(g.ndims - 1, -1)
+    multi = [np.repeat(rows, rest.shape[1])] + [np.tile(r, rows.size) for r in rest]
+    values = data.take(np.ravel_multi_index(tuple(multi), g.shape))
+    return values.reshape((rows.size,) + g.shape[1:] + values.shape[1:]), start
+
+
+
+#============================================
+#               Slab Class
+#============================================
+class Slab():
+    """
+    A worker's piece of the field, and the sampling on it. This mirrors
+    Grid._get_cell_indices and Grid._interpolate_by_gather, except that rows along
+    the first axis are looked up in the slab instead of the full grid, so that the
+    results are the same.
+
+    Parameters:
+    -----------
+        g : Grid Class
+            A grid with the full grid's geometry and boundaries (it doesn't need any
+            fields)
+
+        data : ndarray
+            The slab of the field, as returned by _slab_data
+
+        start : int
+            The global first axis cell of the slab's first row
+
+    Attributes:
+    -----------
+        nrows : int
+            The number of rows (cells along the first axis) the slab holds
+
+    Methods:
+    --------
+        sample(pos, order)
+            The field at a set of positions
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, g, data, start):
+        self.g = g
+        self.data = data
+        self.start = start
+        self.nrows = data.shape[0]
+
+    #-----
+    # _rows
+    #-----
+    def _rows(self, cells, upper):
+        # Global first axis cells to slab rows. Anything the halo doesn't reach gets
+        # the nearest row
+        if self.g._periodic[0]:
+            rows = (cells - self.start) % self.g.ncells
+        else:
+            rows = cells - self.start
+        return np.clip(rows, 0, self.nrows - 1 - upper)
+
+    #-----
+    # sample
+    #-----
+    def sample(self, pos, order=0):
+        g = self.g
+        u = (g.wrap(pos) - g.origin) / g.cellWidth
+        if order == 0:
+            multi = np.floor(u).astype(np.intp)
+            multi = np.where(g._periodic, multi % g.ncells,
+                np.clip(multi, 0, g.ncells - 1))
+            multi[:, 0] = self._rows(multi[:, 0], 0)
+            return self.data[tuple(multi.T)]
+        u = u - 0.5
+        lower = np.floor(u).astype(np.intp)
+        lower = np.where(g._periodic, lower, np.clip(lower, 0, g.ncells - 2))
+        frac = u - lower
+        lower[:, 0] = self._rows(lower[:, 0], 1)
+        values = 0.
+        for corner in np.ndindex(*(2,) * g.ndims):
+            weight = np.prod(np.where(corner, frac, 1. - frac), axis=1)
+            multi = lower + corner
+            multi[:, 1:] = np.where(g._periodic[1:], multi[:, 1:] % g.ncells,
+                multi[:, 1:])
+            vals = self.data[tuple(multi.T)]
+            values = values + weight.reshape((-1,) + (1,) * (vals.ndim - 1)) * vals
+        return values
+
+
+
+#============================================
+#               _slab_worker
+#============================================
+def _slab_worker(rank, task, inboxes, results):
+    """
+    Worker entry point. Runs _advance_slab and sends back what it returns. If it
+    raises, the exception (and its traceback) is sent back instead, so the parent
+    can stop the other workers and raise it rather than wait forever.
+
+    Parameters:
+    -----------
+        See _advance_slab
+
+    Returns:
+    --------
+        None
+    """
+    try:
+        results.put(_advance_slab(rank, task, inboxes))
+    except Exception as e:
+        # Queues pickle in a background thread and drop anything that fails, so
+        # check here that the exception can make it back
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError('{}: {}'.format(type(e).__name__, e))
+        results.put({'rank' : rank, 'error' : e, 'traceback' : traceback.format_exc()})
+
+
+
+#============================================
+#               _advance_slab
+#============================================
+def _advance_slab(rank, task, inboxes):
+    """
+    Advances the paths in this worker's slab one step at a time, swapping the ones
+    that leave with the other workers after every step.
+
+    Parameters:
+    -----------
+        rank : int
+            This worker's slab
+
+        task : dict
+            Everything the worker needs; see _run_segment
+
+        inboxes : list
+            One queue per worker. Batches for a worker go in its queue
+
+    Returns:
+    --------
+        out : dict
+            The paths this worker ends up with and the ones that left the box
+    """
+    import grid
+    g = grid.Grid(*task['geometry'], origin=task['origin'], boundary=task['boundary'],
+        precision=task['precision'])
+    slab = Slab(g, task['data'], task['start'])
+    bounds = task['bounds']
+    nworkers = len(inboxes)
+    integrator, tol, interpolate = task['scheme']
+    adaptive = integrator in integrators.ADAPTIVE_INTEGRATORS
+    order = 1 if interpolate else 0
+    def rhs(t, pos):
+        return slab.sample(pos, order)
+    # The paths this worker holds: global index, position and substep
+    ids, pos, sub = task['ids'], task['pos'], task['substep']
+    doneIds, donePos, doneStep, doneTime = [], [], [], []
+    # Batches that arrived early, by step. A worker that's ahead can send its next
+    # batch before a slower one has sent this step's
+    early = {}
+    stepSize = task['stepSize']
+    for i in range(task['nsteps']):
+        step = task['step0'] + i + 1
+        t = task['time0'] + i * stepSize
+        if ids.size:
+            # Worked out in double precision and rounded to the grid's precision
+            # afterwards, the same as Grid._advect
+            oldPos = pos.astype(np.float64, copy=False)
+            if adaptive:
+                newPos, sub = integrators.ADAPTIVE_INTEGRATORS[integrator](rhs, t,
+                    oldPos, stepSize, tol, sub)
+            else:
+                newPos = integrators.INTEGRATORS[integrator](rhs, t, oldPos, stepSize)
+            pos, exited, frac = g._apply_boundaries(oldPos, newPos)
+            pos = pos.astype(g.dtype, copy=False)
+            if exited.any():
+                doneIds.append(ids[exited])
+                donePos.append(pos[exited])
+                doneStep.append(np.full(exited.sum(), step))
+                doneTime.append(t + frac * stepSize)
+                ids, pos, sub = ids[~exited], pos[~exited], sub[~exited]
+        # Hand every path that left the slab to its new owner. Everyone sends every
+        # other worker exactly one (possibly empty) batch per step, so everyone knows
+        # how many to wait for
+        owner = np.searchsorted(bounds, _first_axis_cell(g, pos), side='right') - 1
+        for dest in range(nworkers):
+            if dest != rank:
+                sel = owner == dest
+                inboxes[dest].put((step, ids[sel], pos[sel], sub[sel]))
+        keep = owner == rank
+        ids, pos, sub = [ids[keep]], [pos[keep]], [sub[keep]]
+        batches = early.pop(step, [])
+        while len(batches) < nworkers - 1:
+            batch = inboxes[rank].get()
+            if batch[0] == step:
+                batches.append(batch)
+            else:
+                early.setdefault(batch[0], []).append(batch)
+        for _, inIds, inPos, inSub in batches:
+            ids.append(inIds)
+            pos.append(inPos)
+            sub.append(inSub)
+        ids = np.concatenate(ids)
+        pos = np.concatenate(pos).reshape(-1, g.ndims)
+        sub = np.concatenate(sub)
+    empty = np.empty(0)
+    return {
+        'ids'      : ids,
+        'pos'      : pos,
+        'substep'  : sub,
+        'doneIds'  : np.concatenate(doneIds) if doneIds else empty.astype(np.intp),
+        'donePos'  : np.concatenate(donePos) if donePos else empty.reshape(0, g.ndims),
+        'doneStep' : np.concatenate(doneStep) if doneStep else empty.astype(np.int64),
+        'doneTime' : np.concatenate(doneTime) if doneTime else empty,
+    }
+
+
+
+#============================================
+#               _run_segment
+#============================================
+def _run_segment(g, name, nsteps, stepSize, workers, scheme, halo):
+    """
+    Splits the grid into slabs around where the active paths are now and advances
+    them nsteps steps.
+    """
+    ens = g.paths
+    active = ens.active
+    pos = ens.curPos[active]
+    bounds = slab_bounds(g, pos, workers)
+    nslabs = len(bounds) - 1
+    owner = np.searchsorted(bounds, _first_axis_cell(g, pos), side='right') - 1
+    ctx = mp.get_context()
+    inboxes = [ctx.Queue() for _ in range(nslabs)]
+    results = ctx.Queue()
+    procs = []
+    for rank in range(nslabs):
+        slabData, start = _slab_data(g, name, bounds[rank], bounds[rank+1], halo)
+        sel = owner == rank
+        task = {
+            'geometry'  : (g.ndims, g.ncells, g.boxSize),
+            'origin'    : g.origin,
+            'boundary'  : g.boundary,
+            'precision' : g.precision,
+            'data'      : slabData,
+            'start'     : start,
+            'bounds'    : bounds,
+            'scheme'    : scheme,
+            'nsteps'    : nsteps,
+            'stepSize'  : stepSize,
+            'step0'     : ens.step,
+            'time0'     : ens.time,
+            'ids'       : active[sel],
+            'pos'       : pos[sel],
+            'substep'   : ens.substep[active[sel]],
+        }
+        procs.append(ctx.Process(target=_slab_worker,
+            args=(rank, task, inboxes, results)))
+    for p in procs:
+        p.start()
+    # The results have to be read before joining, or a worker can block on a full
+    # queue forever
+    try:
+        outs = _collect(procs, results)
+    except BaseException:
+        # The others are stuck waiting for batches that will never come
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join()
+        raise
+    for p in procs:
+        p.join()
+    for out in outs:
+        ens.curPos[out['ids']] = out['pos']
+        ens.substep[out['ids']] = out['substep']
+        gone = out['doneIds']
+        ens.curPos[gone] = out['donePos']
+        ens.exitStep[gone] = out['doneStep']
+        ens.exitTime[gone] = out['doneTime']
+        ens.exitPos[gone] = out['donePos']
+    ens.active = np.nonzero(ens.exitStep < 0)[0]
+    ens.step += nsteps
+    ens.time += nsteps * stepSize
+    ens.history.record(ens.step, ens.curPos)
+
+
+
+#============================================
+#                 _collect
+#============================================
+def _collect(procs, results, poll=1.):
+    """
+    Waits for every worker's result. A worker that sends back an error (see
+    _slab_worker) has it raised here, and one that dies without sending anything
+    (e.g., killed) raises a RuntimeError, instead of hanging the run.
+
+    Parameters:
+    -----------
+        procs : list
+            The worker processes
+
+        results : Queue
+            Where the workers send their results
+
+        poll : float
+            How often (in seconds) to check on the workers while waiting
+
+    Returns:
+    --------
+        outs : list
+            One result per worker
+    """
+    outs = []
+    while len(outs) < len(procs):
+        try:
+            out = results.get(timeout=poll)
+        except queue.Empty:
+            for p in procs:
+                if p.exitcode not in (None, 0):
+                    raise RuntimeError('Slab worker {} exited with code {}'.format(
+                        p.name, p.exitcode))
+            continue
+        if 'error' in out:
+            raise out['error'] from RuntimeError('In slab worker {}:\n{}'.format(
+                out['rank'], out['traceback']))
+        outs.append(out)
+    return outs
+
+
+
+#============================================
+#                  diffuse
+#============================================
+def diffuse(g, field, nsteps, stepSize, workers, integrator, tol, interpolate,
+    halo=None, rebalanceEvery=None):
+    """
+    The domain decomposed version of Grid._advect. Only the start and end of each
+    path are kept (history='endpoints').
+
+    Parameters:
+    -----------
+        g : Grid Class
+            The grid whose paths are being advanced
+
+        field : Field Class
+            The field doing the "kicking"
+
+        nsteps : int
+            The number of steps to take
+
+        stepSize : float
+            The size of each step
+
+        workers : int
+            The number of slabs (and worker processes)
+
+        integrator, tol, interpolate :
+            See Grid.diffuse
+
+        halo : int, optional
+            The depth of the ghost region around each slab, in cells. By default it's
+            enough to cover a full step at the field's largest speed (for in-memory
+            fields) plus the interpolation stencil. Stages that reach past the halo
+            get the values at its edge
+
+        rebalanceEvery : int, optional
+            Redraw the slabs around the paths every this many steps
+
+    Returns:
+    --------
+        None
+    """
+    if g.children:
+        raise ValueError('Domain decomposition doesn\'t support refined grids')
+    ens = g.paths
+    if ens.substep is None:
+        ens.substep = np.full(ens.npaths, float(stepSize))
+    if halo is None:
+        halo = 2
+        data = g.fields[field.name]
+        if isinstance(data, np.ndarray):
+            speed = np.abs(data).max() if data.size else 0.
+            halo += int(np.ceil(speed * stepSize / g.cellWidth))
+    scheme = (integrator, tol, interpolate)
+    segment = rebalanceEvery or nsteps
+    done = 0
+    while done < nsteps:
+        n = min(segment, nsteps - done)
+        _run_segment(g, field.name, n, stepSize, workers, scheme, halo)
+        done += n
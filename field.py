@@ -5,6 +5,9 @@ Date:    3/13/19
 Purpose: Contains the field class
 Notes:
 """
+import itertools
+
+import numpy as np
 
 
 
@@ -25,19 +28,176 @@ class Field():
         assignmentFunc : function
             The subclass' driver function for initializing itself in each cell of a grid.
             Each assignment function should have the same signature of taking in both the
-            grid and current cell index, in case that information is needed.
+            grid and current cell index, in case that information is needed. This gets
+            called once per cell, so it's only used when there's no blockFunc.
+
+        blockFunc : function, optional
+            The vectorized version of assignmentFunc. It has the signature
+            blockFunc(grid, ndims, index), where grid is the Grid instance and index is a
+            tuple of slices selecting a block of cells. It should return the field
+            values for the whole block at once, as an array of shape
+            block shape + (component shape). grid.block_coords(index) gives the cell
+            center coordinates of the block if they're needed.
 
     Attributes:
     -----------
-        pass
+        timeDependent : bool
+            Whether the field changes with the path parameter. Time-dependent fields
+            (see snapshots.SnapshotField) provide attach, advance_to and sample
+            instead of an assignmentFunc
 
     Methods:
     --------
         pass
     """
+    timeDependent = False
+
     #-----
     # Constructor
     #-----
-    def __init__(self, name, assignmentFunc):
+    def __init__(self, name, assignmentFunc, blockFunc=None):
         self.name = name
         self.assignmentFunc = assignmentFunc
+        self.blockFunc = blockFunc
+
+
+
+#============================================
+#             RandomField Class
+#============================================
+class RandomField(Field):
+    """
+    Parent class for fields built from random numbers. The random numbers don't come
+    from the global np.random state. Instead, the grid's cells are split into fixed
+    RNG blocks of rngBlock cells per side, and each RNG block has its own counter-based
+    (Philox) stream, keyed by the seed, the refinement level and the block's index.
+    The values in any block of cells therefore don't depend on how the field is
+    split up, what order the blocks are made in, or which process makes them, so
+    any part of the field can be (re)generated on its own with bit-identical results.
+
+    Cell indices are counted from the global origin (using the grid's origin), so
+    grids on the same level that overlap see the same values.
+
+    Parameters:
+    -----------
+        name, assignmentFunc, blockFunc :
+            See Field
+
+        seed : int, optional
+            The seed for the field. Drawn from np.random if not given
+
+        rngBlock : int
+            The width, in cells, of the RNG blocks. Changing it changes the values
+
+    Attributes:
+    -----------
+        seed : int
+            The seed in use
+
+    Methods:
+    --------
+        normal_block(grid, index, compShape)
+            Standard normal values for a block of cells
+
+    Notes:
+    ------
+        The draws for the last RNG block are kept, so filling cells one at a time
+        (the assignmentFunc fallback) only generates each RNG block about once per
+        row of it rather than once per cell
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, name, assignmentFunc, blockFunc=None, seed=None, rngBlock=16):
+        super().__init__(name, assignmentFunc, blockFunc)
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed = seed
+        self.rngBlock = rngBlock
+        self._lastDraws = None
+
+    #-----
+    # __getstate__
+    #-----
+    def __getstate__(self):
+        # The cached draws aren't worth sending to workers
+        state = dict(self.__dict__)
+        state['_lastDraws'] = None
+        return state
+
+    #-----
+    # rng
+    #-----
+    def rng(self, level, blockCoord):
+        """
+        The generator for one RNG block.
+
+        Parameters:
+        -----------
+            level : int
+                The refinement level of the grid
+
+            blockCoord : tuple
+                The (non-negative) multi-index of the RNG block
+
+        Returns:
+        --------
+            rng : np.random.Generator
+        """
+        seq = np.random.SeedSequence(self.seed, spawn_key=(level,) + tuple(blockCoord))
+        return np.random.Generator(np.random.Philox(seq))
+
+    #-----
+    # normal_block
+    #-----
+    def normal_block(self, grid, index, compShape=()):
+        """
+        Draws standard normal values for a block of cells. Every RNG block the cells
+        overlap is generated in full and the overlapping part is copied out.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid being initialized
+
+            index : tuple
+                A tuple of slices (with a step of one) selecting the block of cells
+
+            compShape : tuple
+                The shape of the value in each cell
+
+        Returns:
+        --------
+            values : ndarray
+                The random values, with shape block shape + compShape
+        """
+        compShape = tuple(compShape)
+        offset = np.rint(grid.origin / grid.cellWidth).astype(int)
+        bounds = [s.indices(n)[:2] for s, n in zip(index, grid.shape)]
+        lo = [a + o for (a, _), o in zip(bounds, offset)]
+        hi = [b + o for (_, b), o in zip(bounds, offset)]
+        b = self.rngBlock
+        values = np.empty(tuple(h - l for l, h in zip(lo, hi)) + compShape)
+        ranges = [range(l // b, -(-h // b)) for l, h in zip(lo, hi)]
+        for blockCoord in itertools.product(*ranges):
+            draws = self._draws(grid.level, blockCoord, (b,) * grid.ndims + compShape)
+            src = []
+            dst = []
+            for c, l, h in zip(blockCoord, lo, hi):
+                start = max(l, c * b)
+                stop = min(h, (c + 1) * b)
+                src.append(slice(start - c * b, stop - c * b))
+                dst.append(slice(start - l, stop - l))
+            values[tuple(dst)] = draws[tuple(src)]
+        return values
+
+    #-----
+    # _draws
+    #-----
+    def _draws(self, level, blockCoord, shape):
+        # All of the draws for one RNG block. The last block's are reused
+        key = (level, tuple(blockCoord), shape)
+        if self._lastDraws is None or self._lastDraws[0] != key:
+            draws = self.rng(level, blockCoord).standard_normal(shape)
+            self._lastDraws = (key, draws)
+        return self._lastDraws[1]
@@ -0,0 +1,226 @@
+"""
+Title:   flowmap.py
+Date:    10/17/26
+Purpose: Finite-time flow maps of a static field
+Notes:   For a static field, where a path ends up after a fixed horizon only depends
+            on where it starts. So instead of advecting every starting point, one
+            tracer is advected from each cell center and the resulting displacements
+            are interpolated to any other starting point. The cost of building the
+            map depends on the number of cells, not the number of paths, and longer
+            horizons are reached by composing maps instead of advecting again.
+"""
+import numpy as np
+
+import grid as gridmod
+
+
+
+#============================================
+#               FlowMap Class
+#============================================
+class FlowMap():
+    """
+    The map from starting points to end points over a fixed horizon, stored as the
+    displacement of the tracer started from each cell center. The displacement is
+    smooth (and periodic along periodic axes, since positions are kept unwrapped)
+    so it's interpolated linearly between the cell centers.
+
+    Parameters:
+    -----------
+        g : Grid Class
+            The grid the map was built on. Only its geometry and boundaries are used
+
+        displacement : ndarray
+            The displacement of the tracer from each cell center, with shape
+            g.shape + (ndims,)
+
+        horizon : float
+            The path parameter the map covers
+
+    Attributes:
+    -----------
+        grid : Grid Class
+            A grid with the same geometry holding the displacement as a field
+
+        horizon : float
+            The path parameter the map covers
+
+    Methods:
+    --------
+        build(g, field, nsteps, stepSize, **kwargs)
+            Makes the map by advecting one tracer per cell
+
+        __call__(points)
+            Maps starting points to end points
+
+        compose(other)
+            The map that applies this one and then other
+
+        power(n)
+            This map applied n times
+
+        ftle()
+            The finite-time Lyapunov exponent in each cell
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, g, displacement, horizon):
+        self.grid = gridmod.Grid(g.ndims, g.ncells, g.boxSize, origin=g.origin,
+            boundary=g.boundary, precision=g.precision)
+        self.grid.fields['displacement'] = np.asarray(displacement,
+            dtype=self.grid.dtype)
+        self.horizon = horizon
+
+    #-----
+    # displacement
+    #-----
+    @property
+    def displacement(self):
+        return self.grid.fields['displacement']
+
+    #-----
+    # build
+    #-----
+    @classmethod
+    def build(cls, g, field, nsteps, stepSize, integrator='rk4', **kwargs):
+        """
+        Advects one tracer from every cell center of g through field for nsteps
+        steps. The grid's own paths are left alone.
+
+        Parameters:
+        -----------
+            g : Grid Class
+                The grid holding the field
+
+            field : Field Class
+                The field doing the "kicking"
+
+            nsteps : int
+                The number of steps to take
+
+            stepSize : float
+                The size of each step
+
+            integrator : str
+                See Grid.diffuse. Interpolation is on by default for everything but
+                euler, which is what the map should use
+
+            kwargs :
+                Anything else to pass on to Grid.diffuse (e.g., tol, workers)
+
+        Returns:
+        --------
+            fmap : FlowMap
+                The map over a horizon of nsteps * stepSize
+        """
+        nodes = np.stack(np.meshgrid(*g.axisCoords, indexing='ij'), axis=-1)
+        nodes = nodes.reshape(-1, g.ndims)
+        saved = g.paths
+        try:
+            g.init_paths(nodes.shape[0], nodes)
+            g.diffuse(field, nsteps, stepSize, history='endpoints',
+                integrator=integrator, **kwargs)
+            displacement = g.paths.curPos - nodes
+        finally:
+            g.paths = saved
+        return cls(g, displacement.reshape(g.shape + (g.ndims,)), nsteps * stepSize)
+
+    #-----
+    # __call__
+    #-----
+    def __call__(self, points):
+        """
+        Maps starting points to where they are after the horizon.
+
+        Parameters:
+        -----------
+            points : ndarray
+                An (npoints, ndims) array of starting points
+
+        Returns:
+        --------
+            ends : ndarray
+                The (npoints, ndims) end points
+        """
+        points = np.asarray(points, dtype=float)
+        return points + self.grid.sample('displacement', points, order=1)
+
+    #-----
+    # compose
+    #-----
+    def compose(self, other):
+        """
+        The map that applies this one and then other, i.e., the flow over the sum of
+        the two horizons. The displacement from each cell center is this map's
+        displacement plus other's displacement from where this one ends up.
+
+        Parameters:
+        -----------
+            other : FlowMap
+                The map to apply second. It has to be on the same grid
+
+        Returns:
+        --------
+            fmap : FlowMap
+                The composed map
+        """
+        nodes = np.stack(np.meshgrid(*self.grid.axisCoords, indexing='ij'), axis=-1)
+        nodes = nodes.reshape(-1, self.grid.ndims)
+        ends = other(self(nodes))
+        displacement = (ends - nodes).reshape(self.displacement.shape)
+        return FlowMap(self.grid, displacement, self.horizon + other.horizon)
+
+    #-----
+    # power
+    #-----
+    def power(self, n):
+        """
+        This map applied n times (the flow over n horizons), by repeated squaring, so
+        it only takes about log2(n) compositions.
+        """
+        if n < 1:
+            raise ValueError('Flow map powers have to be positive')
+        result = None
+        base = self
+        while n:
+            if n & 1:
+                result = base if result is None else result.compose(base)
+            n >>= 1
+            if n:
+                base = base.compose(base)
+        return result
+
+    #-----
+    # ftle
+    #-----
+    def ftle(self):
+        """
+        The finite-time Lyapunov exponent at each cell center: log(sqrt(lmax)) / T,
+        where lmax is the largest eigenvalue of the Cauchy-Green tensor F^T F of the
+        map's gradient F. Derivatives are central differences, wrapping around
+        periodic axes and one sided at any other edge.
+
+        Parameters:
+        -----------
+            None
+
+        Returns:
+        --------
+            ftle : ndarray
+                The exponent in each cell, with shape grid.shape
+        """
+        g = self.grid
+        disp = self.displacement
+        F = np.empty(g.shape + (g.ndims, g.ndims))
+        for axis in range(g.ndims):
+            if g._periodic[axis]:
+                deriv = (np.roll(disp, -1, axis) - np.roll(disp, 1, axis)) / \
+                    (2. * g.cellWidth)
+            else:
+                deriv = np.gradient(disp, g.cellWidth, axis=axis)
+            F[..., axis] = deriv
+        F += np.eye(g.ndims)
+        C = np.einsum('...ki,...kj->...ij', F, F)
+        lmax = np.linalg.eigvalsh(C)[..., -1]
+        return np.log(np.sqrt(np.maximum(lmax, 1e-300))) / abs(self.horizon)
@@ -3,13 +3,28 @@ Title:   grid.py
 Author:  Jared Coughlin
 Date:    3/13/19
 Purpose: Contains the grid class
-Notes:
+Notes:   Field values are stored structure-of-arrays style: one contiguous ndarray
+            per field (cells along the leading ndims axes, components along the last
+            axis for vector fields). Cell centers are computed from index arithmetic
+            rather than stored.
 """
+import itertools
+import os
+import shutil
+import tempfile
+import weakref
+
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator as RGI
 
 import cell
+import decomp
+import instrument
+import integrators
+import output
+import parallel
 import path
+import stats
+import storage
 
 
 
@@ -35,9 +50,81 @@ class Grid():
             The length of each dimension of the simulation volume. Assumed to be the same
             for each dimension.
 
+        storage : str
+            Where the field arrays live. 'memory' keeps them as ordinary arrays.
+            'disk' keeps each one in a chunked, memory-mapped file (see
+            storage.ChunkedArray) so grids larger than RAM can be used
+
+        storageDir : str, optional
+            The directory for the field files when storage='disk'. A temporary
+            directory is made if this isn't given, and removed (along with the
+            field files) when the grid goes away
+
+        chunkSize : int
+            The chunk width, in cells, for storage='disk' and for lazy fields
+
+        cacheBytes : int
+            The memory cap for each field's chunk cache when storage='disk' and for
+            lazy fields
+
+        origin : array_like, optional
+            The coordinates of the lower corner of the grid. Defaults to the origin.
+            Refined child grids use this to sit inside their parent
+
+        boundary : str or list
+            What happens to paths at the edges of the box, either one mode for every
+            axis or one per axis:
+                'periodic'   : the field repeats. Path positions are left unwrapped
+                               (so displacements stay meaningful) and are wrapped
+                               back into the box whenever the field is looked up
+                'reflecting' : paths bounce back off of the walls
+                'absorbing'  : paths that leave are done. Where and when they left
+                               is recorded and they drop out of the active set, so
+                               they cost nothing on later steps
+
+        precision : str
+            How the fields and the paths are stored. 'double' (the default) keeps
+            everything in float64. 'single' stores the field arrays, the tip
+            positions and the trajectories as float32 and the flattened cell indices
+            in the smallest integer type that holds them (uint16 or int32), which
+            halves the memory and the bandwidth of the gathers. Each step is still
+            worked out in float64 and only rounded when it's stored, and the line
+            integrals and statistics are accumulated in float64, so the error is
+            just the float32 rounding of the field and of the positions
+
     Attributes:
     -----------
-        pass
+        shape : tuple
+            The number of cells along each dimension
+
+        dtype : dtype
+            The type the field arrays and tip positions are stored as
+
+        indexDtype : dtype
+            The type of the flattened cell indices (see _get_cell_indices)
+
+        fields : dict
+            The field arrays, keyed by field name. Each has shape shape for scalar
+            fields and shape + (ncomponents,) for vector fields
+
+        registry : dict
+            The fields that have been stacked together (see stack_fields). Maps each
+            field's name to (stack name, component slice, component shape)
+
+        grid : CellArray
+            Compatibility view that hands back a Cell for grid[ind]
+
+        axisCoords : list
+            The cell center coordinates along each axis (one 1D array per dimension)
+
+        parent : Grid Class
+            The coarser grid this one refines (None for the root grid)
+
+        children : list
+            The refined grids covering flagged regions of this one (see refine)
+
+        level : int
+            The refinement level. 0 for the root grid
 
     Methods:
     --------
@@ -46,57 +133,417 @@ class Grid():
     #-----
     # Constructor
     #-----
-    def __init__(self, ndims, ncells, boxSize):
+    def __init__(self, ndims, ncells, boxSize, storage='memory', storageDir=None,
+        chunkSize=64, cacheBytes=2**30, origin=None, boundary='periodic',
+        precision='double'):
+        if storage not in ('memory', 'disk'):
+            raise ValueError('Unknown storage: {}'.format(storage))
+        if precision not in ('double', 'single'):
+            raise ValueError('Unknown precision: {}'.format(precision))
+        if isinstance(boundary, str):
+            boundary = [boundary] * ndims
+        for mode in boundary:
+            if mode not in ('periodic', 'reflecting', 'absorbing'):
+                raise ValueError('Unknown boundary: {}'.format(mode))
         self.ndims     = ndims
         self.ncells    = ncells
         self.boxSize   = boxSize
         self.parent    = None
         self.children  = None
-        self.cellWidth = self.boxSize / self.ncells 
+        self.cellWidth = self.boxSize / self.ncells
+        self.origin    = np.zeros(self.ndims) if origin is None else \
+                            np.asarray(origin, dtype=float)
+        self.level     = 0
+        self.boundary  = list(boundary)
+        self._periodic = np.array([mode == 'periodic' for mode in self.boundary])
+        self.shape     = (self.ncells,) * self.ndims
+        self.precision = precision
+        self.dtype     = np.dtype(np.float64 if precision == 'double' else np.float32)
+        self.indexDtype = self._index_dtype()
+        self.fields    = {}
+        self.registry  = {}
         self.grid      = self._create_grid()
         self.paths     = None
+        self.axisCoords = [self.cell_center(np.arange(self.ncells), axis)
+            for axis in range(self.ndims)]
+        self._interpolators = {}
+        self.storage    = storage
+        self.storageDir = storageDir
+        self.chunkSize  = chunkSize
+        self.cacheBytes = cacheBytes
+        if self.storage == 'disk' and self.storageDir is None:
+            self.storageDir = tempfile.mkdtemp(prefix='nonlocal_')
+            weakref.finalize(self, shutil.rmtree, self.storageDir, ignore_errors=True)
+        # Point location table for the refinement hierarchy. The grid is tiled into
+        # blocks of refineBlock cells per side and _childMap holds, for each block
+        # (by flattened block index), which child covers it or -1
+        self.refineBlock = None
+        self._childMap   = None
+
+    #-----
+    # _index_dtype
+    #-----
+    def _index_dtype(self):
+        # The smallest type that holds every flattened cell index. Double precision
+        # grids keep numpy's native index type
+        ncells = self.ncells**self.ndims
+        if self.precision == 'double':
+            return np.dtype(np.intp)
+        if ncells <= np.iinfo(np.uint16).max + 1:
+            return np.dtype(np.uint16)
+        if ncells <= np.iinfo(np.int32).max + 1:
+            return np.dtype(np.int32)
+        return np.dtype(np.intp)
 
     #-----
     # _create_grid
     #-----
     def _create_grid(self):
         """
-        Instantiates a ndims array of Cell instances that hold the value of various
-        quantities at certain locations in the simulation space.
+        Sets up the view used to get at individual cells. The field arrays themselves
+        are allocated when a field is initialized, so nothing here scales with the
+        number of cells.
+
+        Parameters:
+        -----------
+            None
+
+        Returns:
+        --------
+            grid : CellArray
+                An ndims dimensional view that returns a Cell for each multi-index
+        """
+        return cell.CellArray(self)
+
+    #-----
+    # cell_center
+    #-----
+    def cell_center(self, index, axis=None):
+        """
+        Gets the location of the cell center from the cell index (x0,x1,x2,...,xn).
+        This is just the number of half deltas in each dimension, where delta is the
+        width of the cell. The number of half deltas is just 2k + 1, where k is the cell
+        index along a dimension.
+
+        Parameters:
+        -----------
+            index : array_like
+                A multi-index, or an array of them with the dimension along the last
+                axis
+
+            axis : int, optional
+                If given, index is instead a set of cell indices along just this axis
+
+        Returns:
+        --------
+            loc : ndarray
+                The coordinates of the cell center(s)
+        """
+        origin = self.origin if axis is None else self.origin[axis]
+        return origin + (2 * np.asarray(index) + 1) * (self.cellWidth / 2.)
+
+    #-----
+    # _allocate_field
+    #-----
+    def _allocate_field(self, name, compShape=()):
+        """
+        Makes the (uninitialized) storage for a field.
+
+        Parameters:
+        -----------
+            name : str
+                The name of the field
+
+            compShape : tuple
+                The shape of the field value in a single cell. Empty for scalars
+
+        Returns:
+        --------
+            data : ndarray or ChunkedArray
+                The array now registered in self.fields
+        """
+        if self.storage == 'disk':
+            data = storage.ChunkedArray(storage.field_filename(self.storageDir, name),
+                self.shape, compShape, self.chunkSize, self.cacheBytes, dtype=self.dtype)
+        else:
+            data = np.empty(self.shape + tuple(compShape), dtype=self.dtype)
+        # A field that's made again no longer lives in its stack
+        self.registry.pop(name, None)
+        self.fields[name] = data
+        self.invalidate(name)
+        return data
+
+    #-----
+    # invalidate
+    #-----
+    def invalidate(self, name):
+        """
+        Throws away anything cached for a field (e.g., its interpolator). This needs to
+        be called whenever a field's values are changed outside of init_field. The
+        stack a field is part of is invalidated along with it.
 
         Parameters:
         -----------
+            name : str
+                The name of the field that changed
+
+        Returns:
+        --------
             None
+        """
+        self._interpolators.pop(name, None)
+        if name in self.registry:
+            self._interpolators.pop(self.registry[name][0], None)
+
+    #-----
+    # stack_fields
+    #-----
+    def stack_fields(self, names, stackName='stack'):
+        """
+        Puts several fields into one array so that they can all be read at once. The
+        stack has shape shape + (ncomponents,), with the components of every field
+        laid end to end, so all of the quantities in a cell sit next to each other
+        and one gather pulls every field out for a set of cells. The fields
+        themselves are replaced by views into the stack, so writes through either
+        one show up in both. Refined children are stacked as well.
+
+        Only in-memory fields can be stacked.
+
+        Parameters:
+        -----------
+            names : list
+                The names of the (already initialized) fields to stack
+
+            stackName : str
+                The name the stack is stored under in self.fields
+
+        Returns:
+        --------
+            stack : ndarray
+                The stacked array
+        """
+        arrays = [self.fields[name] for name in names]
+        for name, data in zip(names, arrays):
+            if not isinstance(data, np.ndarray):
+                raise ValueError('Only in-memory fields can be stacked: {}'.format(name))
+        flat = [data.reshape(self.shape + (-1,)) for data in arrays]
+        stack = np.concatenate(flat, axis=-1)
+        self.fields[stackName] = stack
+        self.invalidate(stackName)
+        start = 0
+        for name, data, f in zip(names, arrays, flat):
+            comps = slice(start, start + f.shape[-1])
+            start = comps.stop
+            compShape = data.shape[self.ndims:]
+            self.fields[name] = stack[..., comps].reshape(self.shape + compShape)
+            self.registry[name] = (stackName, comps, compShape)
+            self.invalidate(name)
+        for c in self.children or []:
+            c.stack_fields(names, stackName)
+        return stack
+
+    #-----
+    # get_interpolator
+    #-----
+    def get_interpolator(self, name):
+        """
+        Gets the (cached) linear interpolator for a field. The interpolator is only
+        built the first time it's asked for and is reused until the field changes.
+        Points outside of the outermost cell centers are linearly extrapolated. Every
+        field, however it's stored, is interpolated the same way: by gathering just
+        the corner cells around each point (see _interpolate_by_gather). So in-memory,
+        on-disk and lazy runs of the same field give bit-identical paths.
+
+        Parameters:
+        -----------
+            name : str
+                The name of the field
+
+        Returns:
+        --------
+            interp : function
+                Callable taking an (npoints, ndims) array of coordinates
+        """
+        interp = self._interpolators.get(name)
+        if interp is None:
+            def interp(pos):
+                return self._interpolate_by_gather(name, pos)
+            self._interpolators[name] = interp
+        return interp
+
+    #-----
+    # _interpolate_by_gather
+    #-----
+    def _interpolate_by_gather(self, name, pos):
+        """
+        Multilinear interpolation built only out of gathers, so it works with any
+        field storage. Each point is interpolated from the 2**ndims cell centers
+        around it. Along periodic axes the neighbors wrap around the box. Along the
+        others, points beyond the outermost cell centers are extrapolated from the
+        edge cells (as scipy's RegularGridInterpolator does with fill_value=None).
+
+        Parameters:
+        -----------
+            name : str
+                The name of the field
+
+            pos : ndarray
+                An (npoints, ndims) array of coordinates
 
         Returns:
         --------
-            grid : ndarray
-                An ndims dimensional array of Cell instances
-        """
-        # Initialize empty array
-        grid = np.empty([self.ncells]*self.ndims, dtype=object)
-        # Initialize each cell in the grid. This is done using the nditer iterator in
-        # order to loop over each element in the ndims dimensional grid. The multi_index
-        # flag tells the iterator to yield the index for the current array element
-        it = np.nditer(grid, flags=['multi_index', 'refs_ok'])
-        while not it.finished:
-            # Get location of cell center from cell index (x0,x1,x2,...,xn). This is just
-            # the number of half deltas in each dimension, where delta is the width of the
-            # cell. The number of half deltas is just 2k + 1, where k is the cell index
-            # along a dimension.
-            ind = np.array(it.multi_index)
-            loc = (2 * ind + 1) * (self.cellWidth / 2.)
-            grid[it.multi_index] = cell.Cell(loc, self.cellWidth)
-            # Go to the next element. Without this, it's an infinite loop
-            it.iternext()
-        return grid
+            values : ndarray
+                The interpolated field values
+        """
+        # Position in units of cell widths, measured from the first cell center
+        u = (pos - self.origin) / self.cellWidth - 0.5
+        lower = np.floor(u).astype(np.intp)
+        lower = np.where(self._periodic, lower, np.clip(lower, 0, self.ncells - 2))
+        frac = u - lower
+        values = 0.
+        for corner in itertools.product((0, 1), repeat=self.ndims):
+            weight = np.prod(np.where(corner, frac, 1. - frac), axis=1)
+            multiIndex = lower + corner
+            multiIndex = np.where(self._periodic, multiIndex % self.ncells, multiIndex)
+            ind = np.ravel_multi_index(tuple(multiIndex.T), self.shape)
+            vals = self.gather(name, ind)
+            values = values + weight.reshape((-1,) + (1,) * (vals.ndim - 1)) * vals
+        return values
+
+    #-----
+    # block_shape
+    #-----
+    def block_shape(self, index):
+        """
+        Gets the number of cells along each dimension of a block.
+
+        Parameters:
+        -----------
+            index : tuple
+                A tuple of slices selecting a block of cells
+
+        Returns:
+        --------
+            shape : tuple
+                The shape of the block
+        """
+        return tuple(len(range(*s.indices(n))) for s, n in zip(index, self.shape))
+
+    #-----
+    # block_coords
+    #-----
+    def block_coords(self, index):
+        """
+        Gets the cell center coordinates of every cell in a block. The arrays are open
+        meshes (each one only varies along its own axis), so they broadcast against
+        each other to the block shape without materializing ndims full copies.
+
+        Parameters:
+        -----------
+            index : tuple
+                A tuple of slices selecting a block of cells
+
+        Returns:
+        --------
+            coords : list
+                One coordinate array per dimension
+        """
+        axes = [self.cell_center(np.arange(self.ncells)[s], axis)
+            for axis, s in enumerate(index)]
+        return np.meshgrid(*axes, indexing='ij', sparse=True)
+
+    #-----
+    # _iter_blocks
+    #-----
+    def _iter_blocks(self, blockSize=None):
+        """
+        Splits the grid up into blocks of at most blockSize cells along each
+        dimension.
+
+        Parameters:
+        -----------
+            blockSize : int, optional
+                The maximum block width. If None, the whole grid is one block
+
+        Yields:
+        -------
+            index : tuple
+                A tuple of slices selecting the block
+        """
+        if blockSize is None:
+            blockSize = self.ncells
+        starts = range(0, self.ncells, blockSize)
+        for corner in np.ndindex(*([len(starts)] * self.ndims)):
+            yield tuple(slice(starts[c], min(starts[c] + blockSize, self.ncells))
+                for c in corner)
 
     #-----
     # init_field
     #-----
-    def init_field(self, field):
+    def init_field(self, field, blockSize=None, lazy=False):
+        """
+        This is the driver function for initializing a field on the grid. If the field
+        has a blockFunc, it's called once per block of cells (by default the whole grid
+        is a single block). Otherwise, the field's per-cell assignmentFunc is applied
+        to every cell, which is much slower.
+
+        With lazy=True nothing is evaluated here. The field is stored as a
+        storage.LazyArray instead, which calls blockFunc for a tile of chunkSize cells
+        per side the first time a path needs a value from it, so the cost scales with
+        the part of the box the paths actually visit. Up to cacheBytes of tiles are
+        kept; the rest are re-evaluated if they're needed again.
+
+        Time-dependent fields (e.g., snapshots.SnapshotField) aren't evaluated at all;
+        they're just attached to the grid and load their own values as time goes on.
+
+        Parameters:
+        -----------
+            field : Field Class
+                An instance of the field class that contains useful info about the field
+
+            blockSize : int, optional
+                The maximum width of the blocks handed to field.blockFunc
+
+            lazy : bool
+                Evaluate the field on demand instead of up front. Needs a blockFunc
+                that gives the same values every time it's called on a block
+
+        Returns:
+        --------
+            None
+        """
+        if field.timeDependent:
+            field.attach(self)
+            return
+        if lazy:
+            self.registry.pop(field.name, None)
+            self.fields[field.name] = storage.LazyArray(self, field, self.chunkSize,
+                self.cacheBytes)
+            self.invalidate(field.name)
+            return
+        if field.blockFunc is None:
+            self._init_field_by_cell(field)
+            return
+        # Fields on disk are written one chunk at a time
+        if blockSize is None and self.storage == 'disk':
+            blockSize = self.chunkSize
+        data = None
+        for index in self._iter_blocks(blockSize):
+            values = np.asarray(field.blockFunc(self, self.ndims, index))
+            # The first block tells us what shape the field value has in each cell,
+            # which is needed to size the array
+            if data is None:
+                data = self._allocate_field(field.name, values.shape[self.ndims:])
+            data[index] = values
+        if self.storage == 'disk':
+            data.flush()
+
+    #-----
+    # _init_field_by_cell
+    #-----
+    def _init_field_by_cell(self, field):
         """
-        This is the driver function for initializing a field on the grid.
+        Slow fallback for fields that only provide a per-cell assignment function.
 
         Parameters:
         -----------
@@ -107,40 +554,204 @@ class Grid():
         --------
             None
         """
-        # Loop over every cell and apply the field's cell assignemnt function
-        it = np.nditer(self.grid, flags=['multi_index', 'refs_ok'])
-        while not it.finished:
-            self.grid[it.multi_index][field.name] = \
-                field.assignmentFunc(self.grid, self.ndims, it.multi_index)
-            it.iternext()
+        # The first cell tells us what shape the field value has in each cell, which
+        # is needed to size the array
+        first = (0,) * self.ndims
+        value = np.asarray(field.assignmentFunc(self.grid, self.ndims, first))
+        data = self._allocate_field(field.name, value.shape)
+        data[first] = value
+        # Loop over every other cell and apply the field's cell assignemnt function
+        for index in np.ndindex(*self.shape):
+            if index != first:
+                data[index] = field.assignmentFunc(self.grid, self.ndims, index)
+
+    #-----
+    # refine
+    #-----
+    def refine(self, field, criterion='gradient', threshold=None, blockSize=8,
+        factor=2, maxLevel=1):
+        """
+        Builds a refinement hierarchy on top of this grid. Cells are flagged by the
+        refinement criterion, the grid is tiled into blocks of blockSize cells per
+        side, and every block holding a flagged cell gets a child grid that's factor
+        times finer over the same region. The field is initialized on each child
+        directly (so analytic fields are resolved at the finer spacing) and the
+        children are refined in turn until maxLevel is reached.
+
+        Parameters:
+        -----------
+            field : Field Class
+                The field used to flag cells. It's also initialized on the children
+
+            criterion : str or function
+                'gradient' flags cells where the magnitude of the field's gradient
+                exceeds threshold. A function is called as criterion(grid, field) and
+                should return a boolean array of shape grid.shape
+
+            threshold : float, optional
+                The gradient magnitude cut for criterion='gradient'
+
+            blockSize : int
+                The width, in cells, of the regions that get refined. It has to divide
+                ncells
+
+            factor : int
+                How much finer each level is than the one above it
+
+            maxLevel : int
+                The deepest level to refine to
+
+        Returns:
+        --------
+            None
+        """
+        if self.ncells % blockSize != 0:
+            raise ValueError('blockSize must divide ncells')
+        if self.level >= maxLevel:
+            return
+        if criterion == 'gradient':
+            if threshold is None:
+                raise ValueError('Gradient refinement needs a threshold')
+            flags = self.gradient_magnitude(field.name) > threshold
+        elif callable(criterion):
+            flags = np.asarray(criterion(self, field), dtype=bool)
+        else:
+            raise ValueError('Unknown refinement criterion: {}'.format(criterion))
+        # A block gets refined if any of its cells are flagged
+        nblocks = self.ncells // blockSize
+        blocks = flags.reshape(sum([(nblocks, blockSize)] * self.ndims, ()))
+        blocks = blocks.any(axis=tuple(range(1, 2 * self.ndims, 2)))
+        self.refineBlock = blockSize
+        self._childMap = np.full(blocks.size, -1, dtype=np.int32)
+        self.children = []
+        for blockIndex in zip(*np.nonzero(blocks)):
+            origin = self.origin + np.array(blockIndex) * blockSize * self.cellWidth
+            child = Grid(self.ndims, blockSize * factor, blockSize * self.cellWidth,
+                origin=origin, boundary='absorbing', precision=self.precision)
+            child.parent = self
+            child.level = self.level + 1
+            child.init_field(field)
+            self._childMap[np.ravel_multi_index(blockIndex, blocks.shape)] = \
+                len(self.children)
+            self.children.append(child)
+            child.refine(field, criterion, threshold, blockSize, factor, maxLevel)
+
+    #-----
+    # gradient_magnitude
+    #-----
+    def gradient_magnitude(self, name):
+        """
+        Gets the magnitude of the gradient of a field in every cell. For vector
+        fields this is the Frobenius norm of the gradient tensor.
+
+        Parameters:
+        -----------
+            name : str
+                The name of the field
+
+        Returns:
+        --------
+            grad : ndarray
+                The gradient magnitude, with shape self.shape
+        """
+        data = np.asarray(self.fields[name])
+        grads = np.gradient(data, self.cellWidth, axis=tuple(range(self.ndims)))
+        if self.ndims == 1:
+            grads = [grads]
+        total = sum(g**2 for g in grads)
+        return np.sqrt(total.reshape(self.shape + (-1,)).sum(axis=-1))
+
+    #-----
+    # _child_owner
+    #-----
+    def _child_owner(self, locs):
+        """
+        Finds which child (if any) covers each point, using the flat block table.
+
+        Parameters:
+        -----------
+            locs : ndarray
+                An (npoints, ndims) array of coordinates
+
+        Returns:
+        --------
+            owner : ndarray
+                The index into self.children for each point, or -1
+        """
+        nblocks = self.ncells // self.refineBlock
+        blockIndex = np.floor((locs - self.origin) / (self.refineBlock *
+            self.cellWidth)).astype(np.intp)
+        inside = np.all((blockIndex >= 0) & (blockIndex < nblocks), axis=1)
+        owner = np.full(locs.shape[0], -1, dtype=np.int32)
+        flat = np.ravel_multi_index(tuple(blockIndex[inside].T), (nblocks,) * self.ndims)
+        owner[inside] = self._childMap[flat]
+        return owner
+
+    #-----
+    # locate
+    #-----
+    def locate(self, locs):
+        """
+        Finds the finest cell holding each point. This walks down the hierarchy with
+        one table lookup per level, handling all of the points at once.
+
+        Parameters:
+        -----------
+            locs : ndarray
+                An (npoints, ndims) array of coordinates
+
+        Yields:
+        -------
+            grid : Grid Class
+                The finest grid covering some of the points
+
+            sel : ndarray
+                Which of the points (as indices into locs) are in that grid
+
+            cell_ind : ndarray
+                The flattened cell index of each of those points in that grid
+        """
+        sel = np.arange(locs.shape[0])
+        if self.children:
+            owner = self._child_owner(locs)
+            for cid in np.unique(owner[owner >= 0]):
+                mine = np.nonzero(owner == cid)[0]
+                for g, childSel, ind in self.children[cid].locate(locs[mine]):
+                    yield g, mine[childSel], ind
+            sel = np.nonzero(owner < 0)[0]
+        if sel.size > 0:
+            yield self, sel, self._get_cell_indices(locs[sel])
 
     #-----
     # init_paths
     #-----
     def init_paths(self, npaths, startingPoints):
         """
-        This function creates the path objects.
+        This function creates the ensemble holding every path.
 
         Parameters:
         -----------
             npaths : int
-                The number of path objects to use
+                The number of paths to use
 
-            startingPoints: list
-                A list of coordinate tuples specifying where each path should begin
+            startingPoints: array_like
+                A list of coordinate tuples (or an (npaths, ndims) array) specifying
+                where each path should begin
 
         Returns:
         --------
             None
         """
-        self.paths = []
-        for i in range(npaths):
-            self.paths.append(path.Path(startingPoints[i]))
+        self.paths = path.PathEnsemble(np.asarray(startingPoints)[:npaths], self.dtype)
 
     #-----
     # diffuse
     #-----
-    def diffuse(self, field, nsteps, stepSize):
+    def diffuse(self, field, nsteps, stepSize, history='full', historyStride=None,
+        historyLength=None, integrator='euler', tol=None, interpolate=None, workers=1,
+        accumulate=None, writer=None, checkpoint=None, checkpointEvery=None,
+        resume=False, deposit=None, statistics=False, decompose=False,
+        rebalanceEvery=None):
         """
         This function simply "kicks" each of the path starting points around the volume
         according to the values of field in the cells. That is, the paths don't accumulate
@@ -158,29 +769,555 @@ class Grid():
         ANSWERS?
             1.) The easiest thing to start with is definitely a fixed, user-specifed,
                 number of steps.
-            2.) The easiest thing is just a fixed step that's simply chosen a priori
+            2.) The easiest thing is just a fixed step that's simply chosen a priori.
+                The adaptive integrator (dopri5) keeps stepSize as the spacing of the
+                recorded steps, but chooses its own substeps for each path based on tol
 
         Parameters:
         -----------
             field : Field Class
                 The field to do the "kicking"
-,
+
+            nsteps : int
+                The number of steps to take
+
+            stepSize : float
+                The size of each step
+
+            history : str
+                How much of each trajectory to keep: 'full', 'every', 'last' or
+                'endpoints'. See path.Trajectory
+
+            historyStride : int, optional
+                Keep every historyStride-th step (history='every')
+
+            historyLength : int, optional
+                Keep only the last historyLength steps (history='last')
+
+            integrator : str
+                The scheme used to advance the paths: one of integrators.INTEGRATORS
+                ('euler', 'midpoint', 'rk4') or integrators.ADAPTIVE_INTEGRATORS
+                ('dopri5')
+
+            tol : float, optional
+                The error tolerance for the adaptive integrators
+
+            interpolate : bool, optional
+                Whether the field is linearly interpolated to the tip positions (True)
+                or taken from the cell the tip is in (False). Defaults to False for
+                euler, which is the original kick, and True for everything else
+
+            workers : int
+                The number of processes to split the paths over. With more than one,
+                the paths are sharded across a process pool and the field is shared
+                with the workers through shared memory (see parallel.py)
+
+            accumulate : list, optional
+                Fields to integrate along the paths as they go, with the midpoint rule
+                on every step (see path_accumulation for what's integrated). All of
+                them are sampled together once per step, and since nothing is read
+                back from the history this works with any history mode. The results
+                are in self.paths.accumulator, by field name
+
+            writer : output.TrajectoryWriter, optional
+                Streams the positions (and any sampled fields) to disk as the run
+                goes. Pair it with history='endpoints' to keep memory use flat
+
+            checkpoint : str, optional
+                File to save a checkpoint to every checkpointEvery steps (and at the
+                end of the run). The history recorded so far goes into it, unless a
+                writer is streaming the trajectory
+
+            checkpointEvery : int, optional
+                The number of steps between checkpoints
+
+            resume : bool
+                Carry on from checkpoint, if it exists, instead of starting over. The
+                arguments have to be the same as for the run that saved it, and the
+                paths have to have been set up the same way (init_paths)
+
+            deposit : str, optional
+                Deposit the tips onto the grid after every step, with 'ngp' or 'cic'
+                weights (see deposit_weights). At the end of the run the grid gets
+                three new fields, none of which need the trajectories to be kept:
+                    'occupancy'     : the number of tip-steps in each cell
+                    'residenceTime' : the mean time a path spent in each cell
+                    'density'       : the number of paths per unit volume at the end
+
+            statistics : bool
+                Gather the displacement statistics (mean displacement, MSD,
+                dispersion tensor, percentiles of the distance travelled) of the
+                active paths at every step, without keeping any history. They end up
+                in self.paths.stats (see stats.TransportStats)
+
+            decompose : bool
+                Split the grid itself, rather than just the paths, over the workers:
+                each worker holds one slab of the field and the paths move between
+                workers as they cross slabs (see decomp.py). Only the endpoints of
+                the paths are kept, so this needs history='endpoints' and doesn't
+                work with any of the options that follow the paths along the way
+
+            rebalanceEvery : int, optional
+                With decompose, redraw the slabs around the paths every this many
+                steps
+
+        Returns:
+        --------
+            None
+        """
+        adaptive = integrator in integrators.ADAPTIVE_INTEGRATORS
+        if not adaptive and integrator not in integrators.INTEGRATORS:
+            raise ValueError('Unknown integrator: {}'.format(integrator))
+        if adaptive and tol is None:
+            raise ValueError('Integrator {} needs a tolerance'.format(integrator))
+        if interpolate is None:
+            interpolate = integrator != 'euler'
+        if workers > 1 and field.timeDependent:
+            raise ValueError('Time-dependent fields need workers=1')
+        if workers > 1 and (writer is not None or checkpoint is not None):
+            raise ValueError('Streaming output and checkpoints need workers=1')
+        if deposit not in (None, 'ngp', 'cic'):
+            raise ValueError('Unknown deposit scheme: {}'.format(deposit))
+        if decompose and (history != 'endpoints' or accumulate or writer is not None or
+            checkpoint is not None or deposit is not None or statistics):
+            raise ValueError('Domain decomposition only keeps the endpoints of the paths')
+        # Set the step size for the paths and preallocate their trajectory buffer
+        self.paths.stepSize = stepSize
+        # Parallel runs record straight into shared memory
+        allocate = None
+        if workers > 1 and not decompose:
+            allocate = parallel.history_allocator(self.paths)
+        self.paths.init_history(nsteps, history, historyStride, historyLength,
+            allocate=allocate)
+        accumulate = [f.name for f in accumulate or []]
+        for name in accumulate:
+            compShape = self.fields[name].shape[self.ndims:]
+            if compShape == (self.ndims,):
+                compShape = ()
+            self.paths.accumulator[name] = np.zeros((self.paths.npaths,) + compShape)
+        self.paths.occupancy = None if deposit is None else \
+            np.zeros(int(np.prod(self.shape)))
+        self.paths.stats = None
+        if statistics:
+            self.paths.stats = stats.TransportStats(nsteps, self.ndims)
+            self._record_stats()
+        if decompose:
+            decomp.diffuse(self, field, nsteps, stepSize, workers, integrator, tol,
+                interpolate, rebalanceEvery=rebalanceEvery)
+        elif workers > 1:
+            parallel.diffuse(self, field, nsteps, stepSize, workers, integrator, tol,
+                interpolate, accumulate, deposit, statistics)
+        else:
+            if resume and checkpoint is not None and os.path.exists(checkpoint):
+                output.load_checkpoint(checkpoint, self.paths)
+            if writer is not None:
+                writer.open(self, self.paths.step)
+            try:
+                self._advect(field, nsteps - self.paths.step, stepSize, integrator,
+                    tol, interpolate, accumulate, writer, checkpoint, checkpointEvery,
+                    deposit)
+            finally:
+                if writer is not None:
+                    writer.close()
+            if checkpoint is not None:
+                output.save_checkpoint(checkpoint, self.paths, history=writer is None)
+        if deposit is not None:
+            self._finish_deposit(deposit)
+
+    #-----
+    # _advect
+    #-----
+    def _advect(self, field, nsteps, stepSize, integrator, tol, interpolate,
+        accumulate=(), writer=None, checkpoint=None, checkpointEvery=None,
+        deposit=None):
+        """
+        The stepping loop behind diffuse. The paths' history has to be set up already.
+        This is also what each worker runs on its own shard of the paths.
+
+        Parameters:
+        -----------
+            See diffuse. accumulate is a list of field names here, and their
+            accumulators have to exist already
+
         Returns:
         --------
             None
         """
-        # Loop over each step
+        adaptive = integrator in integrators.ADAPTIVE_INTEGRATORS
+        rhs = self._get_rhs(field, interpolate)
+        if adaptive and self.paths.substep is None:
+            self.paths.substep = np.full(self.paths.npaths, float(stepSize))
+        # Loop over each step. Every path is advanced at once, so there's no loop over
+        # the paths themselves. Only paths still in the active set do any work
         for i in range(nsteps):
-            # At each step, loop over each path
-            for j in range(len(self.paths)):
-                # Set the step size for the path
-                self.paths[j].stepSize = stepSize
-                # Figure out which cell the "tip" of the path is currently in
-                cell_ind = self._get_cell_index(self.paths[j].curPos)
-                # Update the path's tip position based on the field value in that cell.
-                # This also archives the old current position and saves the field values
-                # in case integration/accumulation happens later
-                self.paths[j].curPos = self.paths[j].update(self.grid, cell_ind, field)
+            instrument.begin_step()
+            active = self.paths.active
+            t = self.paths.time
+            if field.timeDependent:
+                field.advance_to(t)
+            # The step itself is always worked out in double precision
+            oldPos = self.paths.curPos[active].astype(np.float64, copy=False)
+            if adaptive:
+                step = integrators.ADAPTIVE_INTEGRATORS[integrator]
+                newPos, substep = step(rhs, t, oldPos, stepSize, tol,
+                    self.paths.substep[active])
+                # In place, since the substeps may live in shared memory
+                self.paths.substep[active] = substep
+            else:
+                newPos = integrators.INTEGRATORS[integrator](rhs, t, oldPos, stepSize)
+            newPos, exited, frac = self._apply_boundaries(oldPos, newPos)
+            if accumulate:
+                self._accumulate_step(accumulate, active, oldPos, newPos)
+            # Move every tip and archive the new positions in case
+            # integration/accumulation happens later
+            self.paths.advance(newPos)
+            if exited.any():
+                self.paths.retire(exited, t + frac * stepSize)
+            if self.paths.stats is not None:
+                self._record_stats()
+            if deposit is not None:
+                ind, weights = self.deposit_weights(
+                    self.paths.curPos[self.paths.active], deposit)
+                self.paths.occupancy += np.bincount(ind, weights,
+                    self.paths.occupancy.size)
+            if writer is not None:
+                writer.record(self)
+            # The writer is flushed first so that the trajectory on disk always
+            # reaches (exactly) the last checkpoint
+            if checkpointEvery and self.paths.step % checkpointEvery == 0:
+                if writer is not None:
+                    writer.flush()
+                output.save_checkpoint(checkpoint, self.paths, history=writer is None)
+            instrument.end_step(self.paths.step, active.size)
+
+    #-----
+    # _accumulate_step
+    #-----
+    def _accumulate_step(self, names, active, oldPos, newPos):
+        """
+        Adds one step's segment to the running line integrals, using the midpoint
+        rule. Every field is sampled in the same call.
+
+        Parameters:
+        -----------
+            names : list
+                The names of the fields being integrated
+
+            active : ndarray
+                The paths that took the step
+
+            oldPos, newPos : ndarray
+                The positions of those paths before and after the step
+
+        Returns:
+        --------
+            None
+        """
+        mid = 0.5 * (oldPos + newPos)
+        values = self.sample_many(names, mid, order=1)
+        dr = newPos - oldPos
+        for name in names:
+            self.paths.accumulator[name][active] += self._segment_integral(
+                values[name], dr)
+
+    #-----
+    # _record_stats
+    #-----
+    def _record_stats(self):
+        # Adds the current displacement of the active paths to the statistics
+        active = self.paths.active
+        disp = self.paths.curPos[active].astype(np.float64) - \
+            self.paths.startingPoint[active]
+        self.paths.stats.record(self.paths.step, self.paths.time, disp)
+
+    #-----
+    # _finish_deposit
+    #-----
+    def _finish_deposit(self, scheme):
+        """
+        Turns the running deposit into the occupancy, residence time and final
+        density fields (see diffuse).
+        """
+        occupancy = self.paths.occupancy.reshape(self.shape)
+        self.fields['occupancy'] = occupancy
+        self.fields['residenceTime'] = occupancy * self.paths.stepSize / \
+            self.paths.npaths
+        self.fields['density'] = self.deposit(self.paths.curPos[self.paths.active],
+            scheme) / self.cellWidth**self.ndims
+        for name in ('occupancy', 'residenceTime', 'density'):
+            self.registry.pop(name, None)
+            self.invalidate(name)
+
+    #-----
+    # deposit_weights
+    #-----
+    def deposit_weights(self, pos, scheme='ngp'):
+        """
+        Works out which cells a set of points is deposited onto, and with what
+        weights. 'ngp' (nearest grid point) puts each point entirely in the cell it's
+        in. 'cic' (cloud in cell) spreads it over the 2**ndims cells whose centers
+        surround it, weighted by overlap. Periodic axes wrap around and anything
+        that would fall off of any other edge goes to the edge cell, so every point
+        deposits a total weight of one.
+
+        Parameters:
+        -----------
+            pos : ndarray
+                An (npoints, ndims) array of coordinates
+
+            scheme : str
+                'ngp' or 'cic'
+
+        Returns:
+        --------
+            cell_ind : ndarray
+                Flattened cell indices
+
+            weights : ndarray
+                The weight going to each of those cells
+        """
+        if scheme == 'ngp':
+            return self._get_cell_indices(self.wrap(pos)), np.ones(pos.shape[0])
+        x = (self.wrap(pos) - self.origin) / self.cellWidth - 0.5
+        lower = np.floor(x).astype(np.intp)
+        frac = x - lower
+        inds = []
+        weights = []
+        for corner in itertools.product((0, 1), repeat=self.ndims):
+            corner = np.array(corner)
+            multiIndex = lower + corner
+            multiIndex = np.where(self._periodic, multiIndex % self.ncells,
+                np.clip(multiIndex, 0, self.ncells - 1))
+            inds.append(np.ravel_multi_index(tuple(multiIndex.T), self.shape))
+            weights.append(np.prod(np.where(corner, frac, 1. - frac), axis=1))
+        return np.concatenate(inds), np.concatenate(weights)
+
+    #-----
+    # deposit
+    #-----
+    def deposit(self, pos, scheme='ngp', weights=None):
+        """
+        Deposits a set of points onto the grid.
+
+        Parameters:
+        -----------
+            pos : ndarray
+                An (npoints, ndims) array of coordinates
+
+            scheme : str
+                'ngp' or 'cic' (see deposit_weights)
+
+            weights : ndarray, optional
+                How much each point deposits. Defaults to one each
+
+        Returns:
+        --------
+            counts : ndarray
+                The total deposited in each cell, with shape self.shape
+        """
+        ind, w = self.deposit_weights(pos, scheme)
+        if weights is not None:
+            w = w * np.tile(weights, w.size // pos.shape[0])
+        return np.bincount(ind, w, int(np.prod(self.shape))).reshape(self.shape)
+
+    #-----
+    # _get_rhs
+    #-----
+    def _get_rhs(self, field, interpolate):
+        """
+        Builds the right hand side function rhs(t, pos) the integrators use, i.e., the
+        field value at each of the given positions.
+
+        Parameters:
+        -----------
+            field : Field Class
+                The field doing the "kicking"
+
+            interpolate : bool
+                Use linear interpolation instead of the value in the containing cell
+
+        Returns:
+        --------
+            rhs : function
+                rhs(t, pos) for an (npaths, ndims) array of positions
+        """
+        order = 1 if interpolate else 0
+        if field.timeDependent:
+            def rhs(t, pos):
+                return field.sample(self, pos, t, order)
+            return rhs
+        def rhs(t, pos):
+            return self.sample(field.name, pos, order)
+        return rhs
+
+    #-----
+    # sample
+    #-----
+    def sample(self, name, pos, order=0):
+        """
+        Gets the value of a field at a set of positions.
+
+        Parameters:
+        -----------
+            name : str
+                The name of the field
+
+            pos : ndarray
+                An (npoints, ndims) array of coordinates
+
+            order : int
+                0 for the value in the cell containing each point, 1 for linear
+                interpolation between cell centers
+
+        Returns:
+        --------
+            values : ndarray
+                The field values, with the points along the first axis
+        """
+        pos = self.wrap(pos)
+        # Points covered by a refined child are handed off to it
+        if self.children:
+            owner = self._child_owner(pos)
+            coarse = np.nonzero(owner < 0)[0]
+            values = None
+            for cid in np.unique(owner):
+                sel = coarse if cid < 0 else np.nonzero(owner == cid)[0]
+                if cid < 0:
+                    vals = self._sample_level(name, pos[sel], order)
+                else:
+                    vals = self.children[cid].sample(name, pos[sel], order)
+                if values is None:
+                    values = np.empty((pos.shape[0],) + vals.shape[1:], vals.dtype)
+                values[sel] = vals
+            if values is not None:
+                return values
+        return self._sample_level(name, pos, order)
+
+    #-----
+    # sample_many
+    #-----
+    def sample_many(self, names, pos, order=0):
+        """
+        Gets the values of several fields at a set of positions. Fields that share a
+        stack (see stack_fields) are read together with a single sample of the stack,
+        so the cost is one lookup per stack rather than one per field.
+
+        Parameters:
+        -----------
+            names : list
+                The names of the fields
+
+            pos : ndarray
+                An (npoints, ndims) array of coordinates
+
+            order : int
+                See sample
+
+        Returns:
+        --------
+            values : dict
+                The values of each field, by name, with the points along the first axis
+        """
+        values = {}
+        stacks = {}
+        for name in names:
+            if name in self.registry:
+                stacks.setdefault(self.registry[name][0], []).append(name)
+            else:
+                values[name] = self.sample(name, pos, order)
+        for stackName, members in stacks.items():
+            stacked = self.sample(stackName, pos, order)
+            for name in members:
+                _, comps, compShape = self.registry[name]
+                values[name] = stacked[:, comps].reshape((-1,) + compShape)
+        return values
+
+    #-----
+    # wrap
+    #-----
+    def wrap(self, locs):
+        """
+        Maps positions along periodic axes back into the box.
+
+        Parameters:
+        -----------
+            locs : ndarray
+                An (npoints, ndims) array of coordinates
+
+        Returns:
+        --------
+            locs : ndarray
+                The wrapped coordinates (the input itself if nothing is periodic)
+        """
+        if not self._periodic.any():
+            return locs
+        wrapped = self.origin + np.mod(locs - self.origin, self.boxSize)
+        return np.where(self._periodic, wrapped, locs)
+
+    #-----
+    # _apply_boundaries
+    #-----
+    def _apply_boundaries(self, oldPos, newPos):
+        """
+        Applies the reflecting and absorbing boundary conditions to a step from
+        oldPos to newPos. Periodic axes are left alone (see wrap).
+
+        Parameters:
+        -----------
+            oldPos : ndarray
+                The (npaths, ndims) positions at the start of the step
+
+            newPos : ndarray
+                The positions at the end of the step. Modified in place
+
+        Returns:
+        --------
+            newPos : ndarray
+                The positions after the boundary conditions. Paths that left through
+                an absorbing wall are put at the point where they crossed it
+
+            exited : ndarray
+                Which paths left through an absorbing wall during the step
+
+            frac : ndarray
+                The fraction of the step each exited path took before crossing
+        """
+        exited = np.zeros(newPos.shape[0], dtype=bool)
+        frac = np.ones(newPos.shape[0])
+        for axis, mode in enumerate(self.boundary):
+            lo = self.origin[axis]
+            hi = lo + self.boxSize
+            x = newPos[:, axis]
+            if mode == 'absorbing':
+                out = (x < lo) | (x >= hi)
+                if out.any():
+                    face = np.where(x[out] < lo, lo, hi)
+                    x0 = oldPos[out, axis]
+                    frac[out] = np.minimum(frac[out], (face - x0) / (x[out] - x0))
+                    exited |= out
+            elif mode == 'reflecting':
+                # Fold the position back into the box (this also handles steps long
+                # enough to bounce off of both walls)
+                y = np.mod(x - lo, 2. * self.boxSize)
+                y = np.where(y > self.boxSize, 2. * self.boxSize - y, y)
+                newPos[:, axis] = lo + y
+        if exited.any():
+            newPos[exited] = oldPos[exited] + frac[exited, np.newaxis] * \
+                (newPos[exited] - oldPos[exited])
+        return newPos, exited, frac[exited]
+
+    #-----
+    # _sample_level
+    #-----
+    def _sample_level(self, name, pos, order):
+        """
+        The same as sample, but only looks at this grid and ignores any children.
+        """
+        if order == 0:
+            return self.gather(name, self._get_cell_indices(pos))
+        instrument.count('interpolatorCalls')
+        instrument.count('interpolatedPoints', pos.shape[0])
+        return self.get_interpolator(name)(pos)
 
     #-----
     # _get_cell_index
@@ -201,21 +1338,85 @@ class Grid():
             cell_ind : tuple
                 The multi-index of grid corresponding to the cell that loc lies in
         """
-        # Make loc a list since tuples are immutable
-        if isinstance(loc, tuple):
-            loc = list(loc)
+        # Make loc a list since tuples are immutable (this also makes sure the caller's
+        # array doesn't get overwritten with the index)
+        loc = list(loc)
         # Since the cell width in each dimension is known, all that needs to be done is
         # to divide the point's position in each dimension by the cell width and floor
         # the result to get the appropriate index. This implicitly assumes that the cell
         # width is the same in all dimensions as well as the same for every cell
         for i in range(len(loc)):
-            loc[i] = int(loc[i] / self.grid[0].cellWidth)
+            loc[i] = int((loc[i] - self.origin[i]) / self.cellWidth)
         return tuple(loc)
 
+    #-----
+    # _get_cell_indices
+    #-----
+    def _get_cell_indices(self, locs):
+        """
+        The vectorized version of _get_cell_index. The multi-index of each point is
+        flattened into a single integer so that the field values can be pulled out with
+        one fancy index (see gather). Points outside of the box are wrapped or clamped
+        according to the boundary conditions, so the index is always valid.
+
+        Parameters:
+        -----------
+            locs : ndarray
+                An (npoints, ndims) array of coordinates
+
+        Returns:
+        --------
+            cell_ind : ndarray
+                The flattened index of the cell each point lies in, as indexDtype
+        """
+        instrument.count('cellLookups', locs.shape[0])
+        multiIndex = np.floor((locs - self.origin) / self.cellWidth).astype(np.intp)
+        # Wrap around periodic axes. Anything else that's out of the box (e.g., an
+        # intermediate integrator stage) gets the nearest edge cell
+        multiIndex = np.where(self._periodic, multiIndex % self.ncells,
+            np.clip(multiIndex, 0, self.ncells - 1))
+        if self.indexDtype == np.intp:
+            return np.ravel_multi_index(tuple(multiIndex.T), self.shape)
+        # Flatten straight into the compact type. Every partial sum is smaller than
+        # the final index, so nothing overflows
+        multiIndex = multiIndex.astype(self.indexDtype)
+        ind = multiIndex[:, 0].copy()
+        for axis in range(1, self.ndims):
+            ind *= self.ncells
+            ind += multiIndex[:, axis]
+        return ind
+
+    #-----
+    # gather
+    #-----
+    def gather(self, name, cell_ind):
+        """
+        Pulls the values of a field out of the given cells.
+
+        Parameters:
+        -----------
+            name : str
+                The name of the field
+
+            cell_ind : ndarray
+                Flattened cell indices, as returned by _get_cell_indices
+
+        Returns:
+        --------
+            values : ndarray
+                The field values, with the cells along the first axis
+        """
+        data = self.fields[name]
+        # Out-of-core and lazy fields only produce the chunks these cells are in
+        if not isinstance(data, np.ndarray):
+            return data.take(cell_ind)
+        flat = data.reshape((-1,) + data.shape[self.ndims:])
+        return np.take(flat, cell_ind, axis=0)
+
     #-----
     # path_accumulation
     #-----
-    def path_accumulation(self, field):
+    def path_accumulation(self, field, quadrature='midpoint'):
         """
         This function performs a line integral of the quantity 'field' along each path
         that has been defined on the grid. In practice this is done by using the values
@@ -224,37 +1425,95 @@ class Grid():
         the actual equations of the path segments themselves, to perform the line
         integral.
 
+        The path segments are the straight lines between the positions kept in the
+        paths' history, so the integral only covers what the history retained (e.g.,
+        history='last' only integrates over the last few steps). For scalar fields
+        this is the integral of f ds. For vector fields with ndims components it's the
+        integral of F . dr. Any other shape of field is integrated component-wise
+        against ds.
+
+        Several fields can be integrated at once by passing a list of them. Every
+        field is then sampled in the same pass over the paths (and fields that share
+        a stack in a single read, see stack_fields).
+
         Parameters:
         -----------
-            field : field class instance
-                The field to be integrated along each path
+            field : field class instance or list
+                The field (or fields) to be integrated along each path
+
+            quadrature : str
+                The rule used on each segment: 'midpoint', 'trapezoid' or 'simpson'
 
         Returns:
         --------
-            None
+            accum : ndarray or dict
+                The line integral along each path (a dict of them, by field name, if a
+                list of fields was given). These are also stored in
+                self.paths.accumulator
+        """
+        if quadrature not in ('midpoint', 'trapezoid', 'simpson'):
+            raise ValueError('Unknown quadrature rule: {}'.format(quadrature))
+        locs = self.paths.locs
+        nverts = locs.shape[0]
+        start = locs[:-1]
+        end = locs[1:]
+        mid = 0.5 * (start + end)
+        # Figure out every point the rule needs so the interpolator only gets called
+        # once. The vertices are shared by neighboring segments, so they're only
+        # evaluated once as well
+        if quadrature == 'midpoint':
+            points = mid
+        elif quadrature == 'trapezoid':
+            points = locs
+        else:
+            points = np.concatenate([locs, mid])
+        # Sample rather than use the interpolator directly so that refined regions
+        # come from the finest level available
+        fields = field if isinstance(field, (list, tuple)) else [field]
+        names = [f.name for f in fields]
+        sampled = self.sample_many(names, points.reshape(-1, self.ndims), order=1)
+        dr = end - start
+        for name in names:
+            values = sampled[name]
+            values = values.reshape(points.shape[:2] + values.shape[1:])
+            # Get the (weighted) average value of the field along each segment
+            if quadrature == 'midpoint':
+                avg = values
+            elif quadrature == 'trapezoid':
+                avg = 0.5 * (values[:-1] + values[1:])
+            else:
+                verts = values[:nverts]
+                avg = (verts[:-1] + 4. * values[nverts:] + verts[1:]) / 6.
+            # Combine with the segment itself and sum over the segments of each path
+            self.paths.accumulator[name] = self._segment_integral(avg, dr).sum(axis=0)
+        if fields is field:
+            return {name : self.paths.accumulator[name] for name in names}
+        return self.paths.accumulator[field.name]
+
+    #-----
+    # _segment_integral
+    #-----
+    def _segment_integral(self, avg, dr):
+        """
+        The integral over each straight segment given the average field value on it:
+        F . dr for vector fields with ndims components and f ds for anything else.
+
+        Parameters:
+        -----------
+            avg : ndarray
+                The average field value on each segment. The segments are along the
+                leading axes, which match those of dr
+
+            dr : ndarray
+                The displacement along each segment, with ndims along the last axis
+
+        Returns:
+        --------
+            integral : ndarray
+                The integral over each segment
         """
-        # Build list of coordinates for the interpolator object. This list is comprised
-        # of a series of 1D arrays (1 array for each dimension). Each array contains the
-        # coordinates of the known points in that dimension (i.e., the first array has all
-        # of the x coordinates for the grid points, the second has all the y, etc.). I
-        # feel like the first part of this (creating the coordinate arrays) should be
-        # moved to the constructor, because having to separate out the coordinates for
-        # every field you want to accumulate is dumb, since it's the same thing each time.
-        coords = []
-        for i in range(self.ndims):
-            coords.append([])
-        for c in self.grid:
-            for i in range(self.ndims):
-                coords[i].append(c.loc[i])
-        # Now build the data array (must have the same shape as the grid). This can
-        # probably be done when assigning the field to each grid cell.
-        data = np.zeros(self.grid.shape)
-        it = np.nditer(self.grid, flags=['multi_index'])
-        while not it.finished:
-            data[it.multi_index] = self.grid[it.multi_index][field.name]
-            it.iternext()
-        # Instantiate interpolation object (possible issue (?): this presupposes that
-        # the cells are accessed in the same order when building the coords list and
-        # the data array. MAKE SURE THIS IS TRUE!!!!!)
-        interp = RGI(coords, data)
-        # Get the value of the field at each path segment for each path 
+        if avg.shape[dr.ndim - 1:] == (self.ndims,):
+            return np.einsum('...d,...d->...', avg, dr)
+        ds = np.linalg.norm(dr, axis=-1)
+        ds = ds.reshape(ds.shape + (1,) * (avg.ndim - ds.ndim))
+        return avg * ds
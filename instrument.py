@@ -0,0 +1,224 @@
+"""
+Title:   instrument.py
+Date:    10/17/26
+Purpose: Phase timers and hot-path counters
+Notes:   Everything here is off by default. While it's off, phase() hands back a
+            shared do-nothing context manager and every other call returns after
+            checking a single module level flag, so leaving the hooks in the hot loops
+            costs next to nothing. Call enable() (main.py does this for --profile) to
+            start recording.
+"""
+import contextlib
+import json
+import time
+import tracemalloc
+
+
+
+# Whether anything is being recorded
+enabled = False
+# name -> {'calls', 'seconds', 'memDelta'}
+_phases = {}
+# name -> running total
+_counters = {}
+# One dict per diffusion step
+_steps = []
+# State for the step currently in progress
+_stepStart = None
+_stepCounters = None
+_null = contextlib.nullcontext()
+
+
+
+#============================================
+#                  enable
+#============================================
+def enable():
+    """
+    Starts recording (and clears anything recorded before). Memory deltas come from
+    tracemalloc, which is only started here so it costs nothing otherwise.
+    """
+    global enabled
+    reset()
+    enabled = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+
+#============================================
+#                  disable
+#============================================
+def disable():
+    global enabled
+    enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+
+#============================================
+#                   reset
+#============================================
+def reset():
+    global _stepStart, _stepCounters
+    _phases.clear()
+    _counters.clear()
+    del _steps[:]
+    _stepStart = None
+    _stepCounters = None
+
+
+
+#============================================
+#                   phase
+#============================================
+def phase(name):
+    """
+    Times a block of code. Use as
+
+        with instrument.phase('init_field'):
+            ...
+
+    Repeated phases with the same name are accumulated.
+
+    Parameters:
+    -----------
+        name : str
+            The name of the phase
+
+    Returns:
+    --------
+        context : context manager
+    """
+    if not enabled:
+        return _null
+    return _timed(name)
+
+
+
+#============================================
+#                  _timed
+#============================================
+@contextlib.contextmanager
+def _timed(name):
+    mem0 = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        mem = tracemalloc.get_traced_memory()[0] - mem0
+        entry = _phases.setdefault(name, {'calls' : 0, 'seconds' : 0., 'memDelta' : 0})
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['memDelta'] += mem
+
+
+
+#============================================
+#                   count
+#============================================
+def count(name, n=1):
+    """
+    Adds n to a named counter (e.g., the number of cell lookups).
+    """
+    if not enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + n
+
+
+
+#============================================
+#                begin_step
+#============================================
+def begin_step():
+    global _stepStart, _stepCounters
+    if not enabled:
+        return
+    _stepStart = time.perf_counter()
+    _stepCounters = dict(_counters)
+
+
+
+#============================================
+#                 end_step
+#============================================
+def end_step(step, active):
+    """
+    Records one diffusion step: its wall time, how many paths were active, and how
+    much each counter went up during the step.
+
+    Parameters:
+    -----------
+        step : int
+            The step number
+
+        active : int
+            The number of paths that were advanced
+    """
+    if not enabled or _stepStart is None:
+        return
+    entry = {'step' : step, 'seconds' : time.perf_counter() - _stepStart,
+        'active' : active}
+    for name, total in _counters.items():
+        entry[name] = total - _stepCounters.get(name, 0)
+    _steps.append(entry)
+
+
+
+#============================================
+#                  report
+#============================================
+def report():
+    """
+    Everything recorded so far.
+
+    Returns:
+    --------
+        report : dict
+            'phases', 'counters' and 'steps'
+    """
+    return {'phases' : {k : dict(v) for k, v in _phases.items()},
+        'counters' : dict(_counters), 'steps' : [dict(s) for s in _steps]}
+
+
+
+#============================================
+#                write_json
+#============================================
+def write_json(fname):
+    with open(fname, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+
+#============================================
+#               format_table
+#============================================
+def format_table():
+    """
+    Human readable summary of the phases and counters. The per-step records are only
+    summarized (they're all in the JSON report).
+
+    Returns:
+    --------
+        table : str
+    """
+    lines = ['{:<24} {:>8} {:>12} {:>14}'.format('phase', 'calls', 'seconds',
+        'mem delta MB')]
+    for name, entry in _phases.items():
+        lines.append('{:<24} {:>8d} {:>12.4f} {:>14.2f}'.format(name, entry['calls'],
+            entry['seconds'], entry['memDelta'] / 2.**20))
+    if _counters:
+        lines.append('')
+        lines.append('{:<24} {:>14}'.format('counter', 'total'))
+        for name, total in _counters.items():
+            lines.append('{:<24} {:>14d}'.format(name, total))
+    if _steps:
+        seconds = [s['seconds'] for s in _steps]
+        lines.append('')
+        lines.append('{} steps: mean {:.4g} s, max {:.4g} s, active paths {} -> {}'
+            .format(len(_steps), sum(seconds) / len(seconds), max(seconds),
+            _steps[0]['active'], _steps[-1]['active']))
+    return '\n'.join(lines)
@@ -0,0 +1,199 @@
+"""
+Title:   integrators.py
+Date:    10/17/26
+Purpose: Contains the schemes used to advance path tips through a field
+Notes:   Every integrator works on the whole ensemble at once. The right hand side is
+            a function rhs(t, pos) that takes an (npaths, ndims) array of positions and
+            returns the velocity at each of them, so the number of Python calls per step
+            doesn't depend on the number of paths.
+"""
+import numpy as np
+
+
+
+#============================================
+#                   euler
+#============================================
+def euler(rhs, t, pos, h):
+    """
+    Forward Euler. This is the original "kick": move along the local field value for a
+    full step.
+
+    Parameters:
+    -----------
+        rhs : function
+            rhs(t, pos) gives the velocity at each position
+
+        t : float
+            The path parameter at the start of the step
+
+        pos : ndarray
+            The (npaths, ndims) positions at the start of the step
+
+        h : float
+            The step size
+
+    Returns:
+    --------
+        pos : ndarray
+            The positions at the end of the step
+    """
+    return pos + h * rhs(t, pos)
+
+
+
+#============================================
+#                  midpoint
+#============================================
+def midpoint(rhs, t, pos, h):
+    """
+    Second order Runge-Kutta using the velocity at the midpoint of an Euler half step.
+    Same parameters and returns as euler.
+    """
+    k1 = rhs(t, pos)
+    k2 = rhs(t + 0.5 * h, pos + 0.5 * h * k1)
+    return pos + h * k2
+
+
+
+#============================================
+#                    rk4
+#============================================
+def rk4(rhs, t, pos, h):
+    """
+    Classic fourth order Runge-Kutta. Same parameters and returns as euler.
+    """
+    k1 = rhs(t, pos)
+    k2 = rhs(t + 0.5 * h, pos + 0.5 * h * k1)
+    k3 = rhs(t + 0.5 * h, pos + 0.5 * h * k2)
+    k4 = rhs(t + h, pos + h * k3)
+    return pos + (h / 6.) * (k1 + 2. * k2 + 2. * k3 + k4)
+
+
+
+#============================================
+#           Dormand-Prince Tableau
+#============================================
+_DP_C = np.array([0., 1./5., 3./10., 4./5., 8./9., 1., 1.])
+_DP_A = [
+    [],
+    [1./5.],
+    [3./40., 9./40.],
+    [44./45., -56./15., 32./9.],
+    [19372./6561., -25360./2187., 64448./6561., -212./729.],
+    [9017./3168., -355./33., 46732./5247., 49./176., -5103./18656.],
+    [35./384., 0., 500./1113., 125./192., -2187./6784., 11./84.]
+]
+# Fifth order weights (same as the last row of A, which is what makes the scheme
+# first-same-as-last) and the difference between them and the fourth order weights
+_DP_B = np.array([35./384., 0., 500./1113., 125./192., -2187./6784., 11./84., 0.])
+_DP_E = _DP_B - np.array([5179./57600., 0., 7571./16695., 393./640.,
+    -92097./339200., 187./2100., 1./40.])
+
+
+
+#============================================
+#               dormand_prince
+#============================================
+def dormand_prince(rhs, t, pos, h, tol, dt=None, maxSubsteps=10000):
+    """
+    Adaptive embedded Runge-Kutta 5(4). This advances every path by a total of h, but
+    each path takes as many internal substeps as it needs to keep its local error
+    estimate below tol. Each path has its own substep size, so paths in smooth
+    regions take a few large steps while paths in rough regions take many small ones.
+    The Python loop runs once per substep of the slowest path, and each pass only does
+    work for the paths that haven't finished yet.
+
+    Parameters:
+    -----------
+        rhs : function
+            rhs(t, pos) gives the velocity at each position
+
+        t : float
+            The path parameter at the start of the step
+
+        pos : ndarray
+            The (npaths, ndims) positions at the start of the step
+
+        h : float
+            The total amount to advance each path by
+
+        tol : float
+            The error tolerance. It's used as both the absolute and relative tolerance
+
+        dt : ndarray, optional
+            The substep size to try first for each path (e.g., the one returned by the
+            previous call). Defaults to h
+
+        maxSubsteps : int
+            Give up if the slowest path needs more than this many substeps
+
+    Returns:
+    --------
+        pos : ndarray
+            The positions at the end of the step
+
+        dt : ndarray
+            The substep size each path should try next time
+    """
+    npaths = pos.shape[0]
+    pos = pos.copy()
+    if dt is None:
+        dt = np.full(npaths, h, dtype=float)
+    else:
+        dt = np.minimum(np.asarray(dt, dtype=float), h)
+    remaining = np.full(npaths, h, dtype=float)
+    active = np.arange(npaths)
+    nsub = 0
+    while active.size > 0:
+        if nsub >= maxSubsteps:
+            raise RuntimeError('dormand_prince: too many substeps; tolerance too small?')
+        nsub += 1
+        y = pos[active]
+        tau = t + (h - remaining[active])
+        step = np.minimum(dt[active], remaining[active])
+        stepCol = step[:, np.newaxis]
+        # Build up the stages
+        k = []
+        for i in range(7):
+            yi = y
+            for j, a in enumerate(_DP_A[i]):
+                if a != 0.:
+                    yi = yi + stepCol * a * k[j]
+            k.append(rhs(tau + _DP_C[i] * step, yi))
+        yNew = y + stepCol * sum(b * ki for b, ki in zip(_DP_B, k) if b != 0.)
+        errVec = stepCol * sum(e * ki for e, ki in zip(_DP_E, k) if e != 0.)
+        # Scaled RMS error norm. Anything <= 1 is good enough
+        scale = tol * (1. + np.maximum(np.abs(y), np.abs(yNew)))
+        err = np.sqrt(np.mean((errVec / scale)**2, axis=1))
+        accept = err <= 1.
+        # Standard step size controller with some safety margins
+        with np.errstate(divide='ignore'):
+            factor = np.where(err > 0., 0.9 * err**-0.2, 5.)
+        factor = np.clip(factor, 0.2, 5.)
+        accepted = active[accept]
+        pos[accepted] = yNew[accept]
+        remaining[accepted] -= step[accept]
+        # Leave the step size alone for accepted steps that were cut short by the end
+        # of the interval, otherwise the guess for the next interval collapses
+        clipped = accept & (step < dt[active])
+        dt[active] = np.where(clipped, dt[active], step * factor)
+        # Done once there's (numerically) nothing left to cover
+        active = active[remaining[active] > 1e-12 * h]
+    return pos, dt
+
+
+
+#============================================
+#                 Registry
+#============================================
+# Fixed step schemes, by name
+INTEGRATORS = {
+    'euler'    : euler,
+    'midpoint' : midpoint,
+    'rk4'      : rk4,
+}
+# Adaptive schemes, by name
+ADAPTIVE_INTEGRATORS = {
+    'dopri5' : dormand_prince,
+}
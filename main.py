@@ -4,51 +4,288 @@ Author:  Jared Coughlin
 Date:    3/11/19
 Purpose: Simple first implementation of modelling a matierial being moved by a random
             velocity field
-Notes:
+Notes:   The command line has a subcommand for each kind of job:
+
+                python main.py run params.txt [--plot-file out.png]
+                python main.py accumulate params.txt [--save integrals.npy]
+                python main.py plot params.txt [--plot-file out.png]
+                python main.py bench benchmarks/*.txt [-o results.json]
+
+            A bare parameter file (python main.py params.txt) is a run. Everything
+            beyond argparse is imported by the subcommand that needs it, so a run
+            that doesn't plot never loads matplotlib, and one that doesn't write
+            HDF5 never loads h5py.
 """
-import os
+import argparse
 import sys
 
-import numpy as np
 
-import grid
-import plot
-import user_fields as uf
-import utils
+
+COMMANDS = ('run', 'accumulate', 'plot', 'bench')
 
 
 
 #============================================
-#                  main
+#               parse_args
+#============================================
+def parse_args(argv=None):
+    """
+    Parses the command line.
+
+    Parameters:
+    -----------
+        argv : list, optional
+            The arguments (without the program name). Defaults to sys.argv
+
+    Returns:
+    --------
+        args : Namespace
+            The parsed arguments. args.command is the subcommand
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Before there were subcommands the parameter file came first
+    if argv and argv[0] not in COMMANDS and not argv[0].startswith('-'):
+        argv.insert(0, 'run')
+    # Everything after bench (including -h) belongs to bench.py
+    if argv and argv[0] == 'bench':
+        return argparse.Namespace(command='bench', benchArgs=argv[1:])
+    parser = argparse.ArgumentParser(description='Move material around with a field')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    # Options for everything that sets up a grid and diffuses the paths
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('paramFile', help='/path/to/param_file')
+    common.add_argument('-w', '--workers', type=int,
+        help='Number of processes to split the paths over. Defaults to workers in '
+        'the parameter file, or 1')
+    common.add_argument('--profile', metavar='REPORT.json',
+        help='Time each phase of the run and save the report here')
+    common.add_argument('--output', metavar='DIR',
+        help='Stream the trajectories to chunked files in this directory')
+    common.add_argument('--chunk-steps', type=int, default=100,
+        help='Number of steps in each output chunk')
+    common.add_argument('--checkpoint', metavar='FILE',
+        help='Save a checkpoint here every --checkpoint-every steps')
+    common.add_argument('--checkpoint-every', type=int, default=100,
+        help='Number of steps between checkpoints')
+    common.add_argument('--resume', action='store_true',
+        help='Carry on from the checkpoint if there is one')
+    common.add_argument('--deposit', choices=('ngp', 'cic'),
+        help='Deposit the tracers onto the grid every step with this scheme')
+    common.add_argument('--deposit-file', metavar='FILE.npz', default='deposit.npz',
+        help='Where --deposit saves the occupancy, residenceTime and density fields')
+    common.add_argument('--stats', action='store_true',
+        help='Gather and print the displacement statistics of the paths')
+    common.add_argument('--precision', choices=('double', 'single'), default='double',
+        help='Store the fields and paths in float64 or float32')
+    run = subparsers.add_parser('run', parents=[common],
+        help='Diffuse the paths through the field')
+    run.add_argument('--plot-file',
+        help='Also plot the field and the paths and save the plot here')
+    run.add_argument('--dpi', type=int, default=150,
+        help='Resolution of the plot')
+    accumulate = subparsers.add_parser('accumulate', parents=[common],
+        help='Diffuse the paths and integrate the field along each of them')
+    accumulate.add_argument('--quadrature', default='midpoint',
+        choices=('midpoint', 'trapezoid', 'simpson'),
+        help='Rule used on each segment of the paths')
+    accumulate.add_argument('--save', metavar='FILE.npy',
+        help='Save the integral along each path here')
+    plot = subparsers.add_parser('plot', parents=[common],
+        help='Diffuse the paths and plot them over the field')
+    plot.add_argument('--plot-file', default='diffusion.png',
+        help='Where to save the plot')
+    plot.add_argument('--dpi', type=int, default=150,
+        help='Resolution of the plot')
+    bench = subparsers.add_parser('bench', add_help=False,
+        help='Run the benchmark suite (see bench.py --help)')
+    bench.add_argument('benchArgs', nargs=argparse.REMAINDER,
+        help='Arguments for bench.py')
+    return parser.parse_args(argv)
+
+
+
+#============================================
+#                 setup
 #============================================
-def main():
+def setup(args):
+    """
+    Reads the parameter file and makes the grid, the field and the paths.
+
+    Parameters:
+    -----------
+        args : Namespace
+            The parsed arguments
+
+    Returns:
+    --------
+        params : dict
+            The parameters
+
+        g : Grid Class
+            The grid, with the field initialized and the paths set up
+
+        field : Field Class
+            The field
+    """
+    import grid
+    import instrument
+    import user_fields as uf
+    import utils
     # Read parameter file
     try:
-        params = utils.read_parameter_file(sys.argv[1])
-    except (IndexError, IOError):
-        print('Usage: python ./diffusion.py /path/to/param_file')
+        with instrument.phase('read_parameter_file'):
+            params = utils.read_parameter_file(args.paramFile)
+    except IOError:
+        print('Usage: python ./diffusion.py {} /path/to/param_file [--workers N] '
+            '[--profile REPORT.json]'.format(args.command))
         sys.exit(1)
     # Create grid
-    g = grid.Grid(params['ndims'], params['ncells'], params['boxSize'])
-    import pdb;pdb.set_trace()
+    with instrument.phase('create_grid'):
+        g = grid.Grid(params['ndims'], params['ncells'], params['boxSize'],
+            precision=args.precision)
     # Create field
-    field = uf.OceanCurrent()
+    field = uf.OceanCurrent(params.get('seed'))
     # Initialize the field on the grid
-    g.init_field(field)
+    with instrument.phase('init_field'):
+        g.init_field(field)
     # Just for now, have it start in the middle of the box
     #startingPoints = [params['boxSize'] / 2. for _ in range(params['ndims'])]
     startingPoints = [tuple([params['boxSize'] / 2. for _ in range(params['ndims'])])] * params['npaths']
 
     # Set up the paths
     g.init_paths(params['npaths'], startingPoints)
-    # Diffuse
-    g.diffuse(field, params['nsteps'], params['stepSize'])
-    # Accumulate a quantity along the path
-    #g.path_accumulation(field)
+    return params, g, field
+
+
+
+#============================================
+#                 diffuse
+#============================================
+def diffuse(args, params, g, field, history='endpoints', accumulate=None):
+    # Runs the diffusion with the options every subcommand shares. Only the endpoints
+    # of the paths are kept unless something afterwards needs the whole history
+    # (a plot, or accumulating with a rule other than midpoint), so memory stays
+    # flat however many steps there are
+    import instrument
+    import output
+    writer = None
+    workers = params.get('workers', 1) if args.workers is None else args.workers
+    if args.output:
+        writer = output.TrajectoryWriter(args.output, args.chunk_steps, [field])
+    with instrument.phase('diffuse'):
+        g.diffuse(field, params['nsteps'], params['stepSize'], history=history,
+            workers=workers, writer=writer, checkpoint=args.checkpoint,
+            checkpointEvery=args.checkpoint_every if args.checkpoint else None,
+            resume=args.resume, deposit=args.deposit, statistics=args.stats,
+            accumulate=accumulate)
+    if args.deposit:
+        save_deposit(args, g)
+    if args.stats:
+        stats = g.paths.stats
+        print('Final mean displacement: {}'.format(stats.mean[-1]))
+        print('Final MSD: {:.6g}'.format(stats.msd()[-1]))
+        if params['nsteps'] > 2:
+            print('Effective diffusivity: {:.6g}'.format(stats.diffusivity()[0]))
+
+
+
+#============================================
+#               save_deposit
+#============================================
+def save_deposit(args, g):
+    # Saves the fields the deposit made, one array per field
+    import numpy as np
+    names = ('occupancy', 'residenceTime', 'density')
+    np.savez(args.deposit_file, **{name : np.asarray(g.fields[name]) for name in names})
+    print('Deposited fields ({}) saved to {}'.format(', '.join(names), args.deposit_file))
+
+
+
+#============================================
+#                make_plot
+#============================================
+def make_plot(args, g, field):
     # Plot (just to test). Have an arrow in each cell representing the direction
     # and magnitude of the field in that cell. Then have another set of arrows showing
     # the path of the test particle
-    plots.test_plot(g, field)
+    import instrument
+    import plot
+    with instrument.phase('plot'):
+        plot.test_plot(g, field, fname=args.plot_file, dpi=args.dpi)
+
+
+
+#============================================
+#                 cmd_run
+#============================================
+def cmd_run(args):
+    params, g, field = setup(args)
+    diffuse(args, params, g, field, 'full' if args.plot_file else 'endpoints')
+    if args.plot_file:
+        make_plot(args, g, field)
+
+
+
+#============================================
+#              cmd_accumulate
+#============================================
+def cmd_accumulate(args):
+    # Accumulate a quantity along the path. The midpoint rule is done step by step
+    # while the paths move, so no history is needed. The other rules integrate over
+    # the history afterwards
+    import instrument
+    import numpy as np
+    params, g, field = setup(args)
+    if args.quadrature == 'midpoint':
+        diffuse(args, params, g, field, accumulate=[field])
+        accum = g.paths.accumulator[field.name]
+    else:
+        diffuse(args, params, g, field, 'full')
+        with instrument.phase('path_accumulation'):
+            accum = g.path_accumulation(field, args.quadrature)
+    print('Line integral of {} over {} paths: mean {:.6g}, std {:.6g}, min {:.6g}, '
+        'max {:.6g}'.format(field.name, accum.shape[0], accum.mean(), accum.std(),
+        accum.min(), accum.max()))
+    if args.save:
+        np.save(args.save, accum)
+
+
+
+#============================================
+#                 cmd_plot
+#============================================
+def cmd_plot(args):
+    params, g, field = setup(args)
+    diffuse(args, params, g, field, 'full')
+    make_plot(args, g, field)
+
+
+
+#============================================
+#                 cmd_bench
+#============================================
+def cmd_bench(args):
+    import bench
+    bench.main(args.benchArgs)
+
+
+
+#============================================
+#                  main
+#============================================
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'bench':
+        cmd_bench(args)
+        return
+    import instrument
+    if args.profile:
+        instrument.enable()
+    {'run' : cmd_run, 'accumulate' : cmd_accumulate, 'plot' : cmd_plot}[
+        args.command](args)
+    if args.profile:
+        instrument.write_json(args.profile)
+        print(instrument.format_table())
 
 
 
@@ -0,0 +1,451 @@
+"""
+Title:   output.py
+Date:    10/17/26
+Purpose: Streams trajectories to disk and saves/loads checkpoints
+Notes:   The writer fills one of two buffers of chunkSteps steps while a background
+            thread writes the other one out, so the stepping loop only waits on the
+            disk if it gets a whole chunk ahead of it. Memory use doesn't depend on
+            the number of steps. Chunks are either compressed .npz files (one per
+            chunk) or, when h5py is installed and asked for, a single HDF5 file with
+            chunked, resizable datasets. h5py is only imported when HDF5 is actually
+            used, so importing this module stays cheap.
+"""
+import glob
+import os
+import queue
+import threading
+
+import numpy as np
+
+import stats
+
+
+
+#============================================
+#               _import_h5py
+#============================================
+def _import_h5py(what):
+    # h5py, imported the first time it's needed
+    try:
+        import h5py
+    except ImportError:
+        raise ValueError('{} needs h5py'.format(what)) from None
+    return h5py
+
+
+
+#============================================
+#           TrajectoryWriter Class
+#============================================
+class TrajectoryWriter():
+    """
+    Streams the tip positions of an ensemble (and, optionally, field values sampled
+    at the tips) to disk while Grid.diffuse runs. Pass one to diffuse with
+    writer=...; diffuse opens it, records every step and closes it at the end.
+
+    Parameters:
+    -----------
+        outDir : str
+            The directory to write to. It's made if it doesn't exist
+
+        chunkSteps : int
+            The number of steps in each chunk (and in each of the two buffers)
+
+        fields : list, optional
+            Fields to sample (with linear interpolation) at the tips on every step
+
+        fmt : str
+            'npz' or 'hdf5'
+
+    Attributes:
+    -----------
+        nwritten : int
+            The number of chunks written so far
+
+    Methods:
+    --------
+        open(grid, startStep)
+            Sets up the buffers and starts the writer thread
+
+        record(grid)
+            Buffers the current state of grid.paths
+
+        flush()
+            Writes out whatever is buffered and waits for the disk to catch up
+
+        close()
+            Flushes and stops the writer thread
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, outDir, chunkSteps=100, fields=None, fmt='npz'):
+        if fmt not in ('npz', 'hdf5'):
+            raise ValueError('Unknown output format: {}'.format(fmt))
+        if fmt == 'hdf5':
+            _import_h5py('Output format hdf5')
+        self.outDir = outDir
+        self.chunkSteps = chunkSteps
+        self.names = [f.name for f in fields or []]
+        self.fmt = fmt
+        self.nwritten = 0
+        self._buffers = None
+        self._thread = None
+        self._error = None
+
+    #-----
+    # open
+    #-----
+    def open(self, grid, startStep=0):
+        """
+        Sets up the buffers and starts the writer thread. When starting from step 0
+        the starting positions are recorded right away. When resuming from a
+        checkpoint, anything already on disk past startStep is thrown away, since
+        it's about to be written again.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid whose paths are being written
+
+            startStep : int
+                The step the run is starting (or resuming) from
+
+        Returns:
+        --------
+            None
+        """
+        os.makedirs(self.outDir, exist_ok=True)
+        paths = grid.paths
+        shapes = {'step' : (), 'time' : (), 'pos' : (paths.npaths, paths.ndims)}
+        values = grid.sample_many(self.names, paths.curPos, order=1)
+        for name in self.names:
+            shapes['values/' + name] = values[name].shape
+        self._shapes = shapes
+        # Positions and field values are written at the grid's precision
+        dtypes = {'step' : np.int64, 'time' : np.float64, 'pos' : paths.curPos.dtype}
+        self._buffers = [{key : np.empty((self.chunkSteps,) + shape,
+            dtype=dtypes.get(key, grid.dtype)) for key, shape in shapes.items()}
+            for _ in range(2)]
+        self._current = 0
+        self._nrows = 0
+        self._free = queue.Queue()
+        self._free.put(1)
+        self._todo = queue.Queue()
+        self._error = None
+        if self.fmt == 'hdf5':
+            self._open_hdf5(startStep)
+        else:
+            for fname in glob.glob(os.path.join(self.outDir, 'chunk_*.npz')):
+                if _chunk_start(fname) > startStep:
+                    os.remove(fname)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        if startStep == 0:
+            self.record(grid, values)
+
+    #-----
+    # _open_hdf5
+    #-----
+    def _open_hdf5(self, startStep):
+        h5py = _import_h5py('Output format hdf5')
+        self._h5 = h5py.File(os.path.join(self.outDir, 'trajectory.h5'), 'a')
+        for key, shape in self._shapes.items():
+            if key not in self._h5:
+                self._h5.create_dataset(key, (0,) + shape, maxshape=(None,) + shape,
+                    dtype=self._buffers[0][key].dtype, chunks=(self.chunkSteps,) + shape,
+                    compression='gzip')
+            dset = self._h5[key]
+            # Rows are steps, so resuming just cuts off anything past startStep (and
+            # starting over cuts off everything)
+            keep = startStep + 1 if startStep > 0 else 0
+            if dset.shape[0] > keep:
+                dset.resize(keep, axis=0)
+
+    #-----
+    # record
+    #-----
+    def record(self, grid, values=None):
+        """
+        Copies the current step into the buffer, handing the buffer to the writer
+        thread if it's full.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid whose paths are being written
+
+            values : dict, optional
+                The fields already sampled at the tips (they're sampled here if not)
+
+        Returns:
+        --------
+            None
+        """
+        self._check()
+        paths = grid.paths
+        if values is None:
+            values = grid.sample_many(self.names, paths.curPos, order=1)
+        buf = self._buffers[self._current]
+        row = self._nrows
+        buf['step'][row] = paths.step
+        buf['time'][row] = paths.time
+        buf['pos'][row] = paths.curPos
+        for name in self.names:
+            buf['values/' + name][row] = values[name]
+        self._nrows += 1
+        if self._nrows == self.chunkSteps:
+            self._submit()
+
+    #-----
+    # _submit
+    #-----
+    def _submit(self):
+        # Hand the current buffer to the writer thread and switch to the other one,
+        # waiting for it to be written out first if need be
+        if self._nrows == 0:
+            return
+        self._todo.put((self._current, self._nrows))
+        self._current = self._free.get()
+        self._nrows = 0
+
+    #-----
+    # _run
+    #-----
+    def _run(self):
+        # The writer thread
+        while True:
+            item = self._todo.get()
+            if item is None:
+                self._todo.task_done()
+                return
+            index, nrows = item
+            try:
+                if self._error is None:
+                    self._write(self._buffers[index], nrows)
+            except Exception as e:
+                self._error = e
+            self._free.put(index)
+            self._todo.task_done()
+
+    #-----
+    # _write
+    #-----
+    def _write(self, buf, nrows):
+        if self.fmt == 'hdf5':
+            for key, data in buf.items():
+                dset = self._h5[key]
+                n = dset.shape[0]
+                dset.resize(n + nrows, axis=0)
+                dset[n:] = data[:nrows]
+            self._h5.flush()
+        else:
+            fname = os.path.join(self.outDir, 'chunk_{:09d}.npz'.format(
+                int(buf['step'][0])))
+            tmp = fname + '.tmp'
+            with open(tmp, 'wb') as f:
+                np.savez_compressed(f, **{key : data[:nrows]
+                    for key, data in buf.items()})
+            os.replace(tmp, fname)
+        self.nwritten += 1
+
+    #-----
+    # _check
+    #-----
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    #-----
+    # flush
+    #-----
+    def flush(self):
+        """
+        Writes out whatever is buffered and waits until it's on disk.
+        """
+        self._submit()
+        self._todo.join()
+        self._check()
+
+    #-----
+    # close
+    #-----
+    def close(self):
+        if self._thread is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._todo.put(None)
+            self._thread.join()
+            self._thread = None
+            self._buffers = None
+            if self.fmt == 'hdf5':
+                self._h5.close()
+
+
+
+#============================================
+#               _chunk_start
+#============================================
+def _chunk_start(fname):
+    return int(os.path.basename(fname)[len('chunk_'):-len('.npz')])
+
+
+
+#============================================
+#              read_trajectory
+#============================================
+def read_trajectory(outDir):
+    """
+    Reads back everything a TrajectoryWriter wrote.
+
+    Parameters:
+    -----------
+        outDir : str
+            The directory the writer wrote to
+
+    Returns:
+    --------
+        traj : dict
+            'step', 'time' and 'pos' (nsteps, npaths, ndims), plus 'values/<name>' for
+            each sampled field, all with the steps along the first axis
+    """
+    h5name = os.path.join(outDir, 'trajectory.h5')
+    if os.path.exists(h5name):
+        h5py = _import_h5py('Reading {}'.format(h5name))
+        with h5py.File(h5name, 'r') as f:
+            traj = {}
+            f.visititems(lambda key, obj: traj.__setitem__(key, obj[...])
+                if isinstance(obj, h5py.Dataset) else None)
+            return traj
+    fnames = sorted(glob.glob(os.path.join(outDir, 'chunk_*.npz')), key=_chunk_start)
+    chunks = []
+    for fname in fnames:
+        with np.load(fname) as chunk:
+            chunks.append({key : chunk[key] for key in chunk.files})
+    if not chunks:
+        raise ValueError('No trajectory chunks in {}'.format(outDir))
+    return {key : np.concatenate([c[key] for c in chunks]) for key in chunks[0]}
+
+
+
+#============================================
+#              save_checkpoint
+#============================================
+def save_checkpoint(fname, paths, history=True):
+    """
+    Saves everything needed to carry on a run: the state of the ensemble (including
+    its history and accumulators) and the state of the global random number
+    generator. The file is written under a temporary name and then moved into place,
+    so a crash while saving leaves the previous checkpoint intact. Only the rows of
+    the history recorded so far are saved, not the whole preallocated buffer.
+
+    Parameters:
+    -----------
+        fname : str
+            The checkpoint file
+
+        paths : PathEnsemble
+            The ensemble to save
+
+        history : bool
+            Whether to save the history at all. A run that streams its trajectory
+            with a TrajectoryWriter already has it on disk
+
+    Returns:
+    --------
+        None
+    """
+    key, state, pos, hasGauss, cached = np.random.get_state()
+    arrays = {
+        'startingPoint' : paths.startingPoint,
+        'curPos'        : paths.curPos,
+        'step'          : paths.step,
+        'time'          : paths.time,
+        'stepSize'      : paths.stepSize,
+        'active'        : paths.active,
+        'exitStep'      : paths.exitStep,
+        'exitTime'      : paths.exitTime,
+        'exitPos'       : paths.exitPos,
+        'historyShape'  : paths.history.buffer.shape,
+        'historyCount'  : paths.history.count,
+        'rngKey'        : key,
+        'rngState'      : state,
+        'rngPos'        : pos,
+        'rngHasGauss'   : hasGauss,
+        'rngCached'     : cached,
+    }
+    if history:
+        hist = paths.history
+        arrays['historyBuffer'] = hist.buffer[:min(hist.count, hist.length)]
+    if paths.substep is not None:
+        arrays['substep'] = paths.substep
+    if paths.occupancy is not None:
+        arrays['occupancy'] = paths.occupancy
+    if paths.stats is not None:
+        for key, value in paths.stats.state().items():
+            arrays['stats/' + key] = value
+    for name, acc in paths.accumulator.items():
+        arrays['accumulator/' + name] = acc
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, fname)
+
+
+
+#============================================
+#              load_checkpoint
+#============================================
+def load_checkpoint(fname, paths):
+    """
+    Restores a checkpoint written by save_checkpoint into an ensemble (whose history
+    has to be set up the same way it was when the checkpoint was saved), and puts the
+    global random number generator back the way it was. If the checkpoint was saved
+    without its history, the rows of the history from before it are left as they
+    are.
+
+    Parameters:
+    -----------
+        fname : str
+            The checkpoint file
+
+        paths : PathEnsemble
+            The ensemble to restore into
+
+    Returns:
+    --------
+        None
+    """
+    with np.load(fname) as ckpt:
+        if ckpt['curPos'].shape != paths.curPos.shape:
+            raise ValueError('Checkpoint {} is for {} paths in {} dimensions'.format(
+                fname, *ckpt['curPos'].shape))
+        if tuple(ckpt['historyShape']) != paths.history.buffer.shape:
+            raise ValueError('Checkpoint {} has a different history setup'.format(fname))
+        paths.startingPoint[...] = ckpt['startingPoint']
+        paths.curPos[...] = ckpt['curPos']
+        paths.step = int(ckpt['step'])
+        paths.time = float(ckpt['time'])
+        paths.stepSize = float(ckpt['stepSize'])
+        paths.active = ckpt['active']
+        paths.exitStep[...] = ckpt['exitStep']
+        paths.exitTime[...] = ckpt['exitTime']
+        paths.exitPos[...] = ckpt['exitPos']
+        if 'historyBuffer' in ckpt.files:
+            rows = ckpt['historyBuffer']
+            paths.history.buffer[:rows.shape[0]] = rows
+        paths.history.count = int(ckpt['historyCount'])
+        if 'substep' in ckpt.files:
+            paths.substep = ckpt['substep']
+        if 'occupancy' in ckpt.files:
+            paths.occupancy = ckpt['occupancy']
+        if 'stats/count' in ckpt.files:
+            paths.stats = stats.TransportStats.from_state({key[len('stats/'):] :
+                ckpt[key] for key in ckpt.files if key.startswith('stats/')})
+        for key in ckpt.files:
+            if key.startswith('accumulator/'):
+                paths.accumulator[key[len('accumulator/'):]] = ckpt[key]
+        np.random.set_state((str(ckpt['rngKey']), ckpt['rngState'], int(ckpt['rngPos']),
+            int(ckpt['rngHasGauss']), float(ckpt['rngCached'])))
@@ -0,0 +1,678 @@
+"""
+Title:   parallel.py
+Date:    10/17/26
+Purpose: Runs path advection across a pool of worker processes
+Notes:   Paths are independent of one another for a static field, so the ensemble is
+            split into shards and each worker advances its shard for the whole run.
+            The field arrays, the tip positions and the trajectory buffer all live in
+            shared memory, so workers never pickle or copy the grid and their results
+            land directly in the arrays the main process reads back.
+
+            The shared memory belongs to the grid and the ensemble (see
+            shared_arrays). Arrays are moved into it the first time a parallel run
+            needs them and stay there, and the history buffer is allocated there to
+            begin with, so nothing is copied in and out around each run.
+"""
+import mmap
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os
+import weakref
+
+import numpy as np
+
+import stats
+import storage
+
+
+
+# The deposit buffer of the worker process this module is loaded in (see
+# _deposit_buffer)
+_depositBuffer = None
+
+
+
+#============================================
+#                _Block Class
+#============================================
+class _Block(shared_memory.SharedMemory):
+    """
+    A shared memory block that can be closed while arrays still point into it. The
+    arrays made by SharedArrays can outlive it (e.g., an ensemble's positions after
+    the ensemble has moved on to a new array), and then the memory stays mapped
+    until the last of them goes instead of close raising.
+    """
+    #-----
+    # close
+    #-----
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            pass
+
+
+
+#============================================
+#             SharedArrays Class
+#============================================
+class SharedArrays():
+    """
+    Owns a set of named arrays that live in shared memory. The main process creates
+    them (empty or copying in some data) and hands the specs returned by spec() to
+    the workers, which attach to the same memory with attach().
+
+    Parameters:
+    -----------
+        None
+
+    Attributes:
+    -----------
+        arrays : dict
+            The shared arrays, by name
+
+    Methods:
+    --------
+        empty(name, shape, dtype)
+            Makes a new, uninitialized shared array
+
+        add(name, data)
+            Copies data into a new shared array
+
+        share(name, data)
+            The shared version of data, copying it in only if it isn't already
+
+        remove(name)
+            Releases one array
+
+        spec(names)
+            Picklable description of the arrays
+
+        close()
+            Releases and unlinks all of the shared memory
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self):
+        self.arrays = {}
+        self._blocks = {}
+
+    #-----
+    # empty
+    #-----
+    def empty(self, name, shape, dtype=np.float64):
+        """
+        Makes a new shared array without initializing it, replacing any array that
+        was already stored under name.
+
+        Parameters:
+        -----------
+            name : str
+                The key to store the array under
+
+            shape : tuple
+                The shape of the array
+
+            dtype : dtype
+                The type of the array
+
+        Returns:
+        --------
+            shared : ndarray
+                The array backed by shared memory
+        """
+        self.remove(name)
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        # Shared memory blocks can't be empty
+        block = _Block(create=True, size=max(nbytes, 1))
+        shared = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        self._blocks[name] = block
+        self.arrays[name] = shared
+        return shared
+
+    #-----
+    # add
+    #-----
+    def add(self, name, data):
+        """
+        Copies data into a new shared array.
+
+        Parameters:
+        -----------
+            name : str
+                The key to store the array under
+
+            data : ndarray
+                The initial contents
+
+        Returns:
+        --------
+            shared : ndarray
+                The array backed by shared memory
+        """
+        data = np.asarray(data)
+        shared = self.empty(name, data.shape, data.dtype)
+        shared[...] = data
+        return shared
+
+    #-----
+    # share
+    #-----
+    def share(self, name, data):
+        """
+        The shared array stored under name if data is that array, otherwise a new
+        shared copy of data. Callers replace their own reference with the result, so
+        the data is only ever copied in once.
+        """
+        if self.arrays.get(name) is data:
+            return data
+        return self.add(name, data)
+
+    #-----
+    # remove
+    #-----
+    def remove(self, name):
+        # Anyone still holding the array keeps the memory mapped until they let go,
+        # but the block itself is gone
+        self.arrays.pop(name, None)
+        block = self._blocks.pop(name, None)
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    #-----
+    # spec
+    #-----
+    def spec(self, names=None):
+        names = self.arrays if names is None else names
+        return {name : (self._blocks[name].name, self.arrays[name].shape,
+            self.arrays[name].dtype.str) for name in names}
+
+    #-----
+    # close
+    #-----
+    def close(self):
+        # The arrays have to go before the blocks can be closed
+        self.arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks = {}
+
+    #-----
+    # __enter__
+    #-----
+    def __enter__(self):
+        return self
+
+    #-----
+    # __exit__
+    #-----
+    def __exit__(self, *args):
+        self.close()
+
+
+
+#============================================
+#               shared_arrays
+#============================================
+def shared_arrays(owner):
+    """
+    The shared memory belonging to a grid or an ensemble, made the first time it's
+    asked for. It's released when the owner goes away.
+
+    Parameters:
+    -----------
+        owner : object
+            The grid or ensemble
+
+    Returns:
+    --------
+        shared : SharedArrays
+    """
+    shared = owner.__dict__.get('_sharedArrays')
+    if shared is None:
+        shared = SharedArrays()
+        owner._sharedArrays = shared
+        weakref.finalize(owner, _close_owned, shared, os.getpid())
+    return shared
+
+
+
+#============================================
+#               _close_owned
+#============================================
+def _close_owned(shared, pid):
+    # Forked workers have a copy of the owner too, but only its creator unlinks
+    if os.getpid() == pid:
+        shared.close()
+
+
+
+#============================================
+#             history_allocator
+#============================================
+def history_allocator(ens):
+    """
+    Something for PathEnsemble.init_history to allocate the history buffer with, so
+    that it's made in the ensemble's shared memory to begin with.
+    """
+    def allocate(shape, dtype):
+        return shared_arrays(ens).empty('history', shape, dtype)
+    return allocate
+
+
+
+#============================================
+#               share_ensemble
+#============================================
+def share_ensemble(ens, accumulate):
+    """
+    Moves the per-path arrays of an ensemble (positions, substeps, exits, the history
+    and the accumulators) into its shared memory, if they aren't there already.
+
+    Parameters:
+    -----------
+        ens : PathEnsemble
+            The ensemble
+
+        accumulate : list
+            The names of the accumulators
+
+    Returns:
+    --------
+        spec : dict
+            What the workers attach to (see attach)
+    """
+    shared = shared_arrays(ens)
+    names = {'pos' : 'curPos', 'substep' : 'substep', 'exitStep' : 'exitStep',
+        'exitTime' : 'exitTime', 'exitPos' : 'exitPos'}
+    for name, attr in names.items():
+        setattr(ens, attr, shared.share(name, getattr(ens, attr)))
+    ens.history.buffer = shared.share('history', ens.history.buffer)
+    for name in accumulate:
+        ens.accumulator[name] = shared.share('acc:' + name, ens.accumulator[name])
+    return shared.spec(list(names) + ['history'] + ['acc:' + n for n in accumulate])
+
+
+
+#============================================
+#                  attach
+#============================================
+def attach(spec):
+    """
+    Maps the arrays described by SharedArrays.spec() into the current process.
+
+    Parameters:
+    -----------
+        spec : dict
+            The output of SharedArrays.spec()
+
+    Returns:
+    --------
+        arrays : dict
+            The shared arrays, by name
+
+        blocks : list
+            The underlying shared memory blocks. These have to be kept alive for as
+            long as the arrays are used, and closed (but not unlinked) afterwards
+    """
+    arrays = {}
+    blocks = []
+    for name, (blockName, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=blockName)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        blocks.append(block)
+    return arrays, blocks
+
+
+
+#============================================
+#                 split_paths
+#============================================
+def split_paths(npaths, nshards):
+    """
+    Splits the paths into contiguous, nearly equal shards.
+
+    Parameters:
+    -----------
+        npaths : int
+            The number of paths
+
+        nshards : int
+            The number of shards to make
+
+    Returns:
+    --------
+        shards : list
+            (start, stop) index pairs. Empty shards are dropped
+    """
+    edges = np.linspace(0, npaths, nshards + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+
+#============================================
+#                 _share_grid
+#============================================
+def _share_grid(spec, g, names, key):
+    """
+    Puts some of the fields of a grid (and of all of its refined children) where the
+    workers can get at them. Stacked fields (see Grid.stack_fields) are shared as
+    their stack, which the worker makes the field views from again. In-memory fields
+    are moved into the grid's shared memory (once; the grid keeps using the shared
+    copy afterwards). Memory mapped arrays (e.g., from np.load with mmap_mode) and
+    fields on disk are shared through their files instead: each worker maps the file
+    itself. Lazy fields are shared as the field itself, and each worker evaluates
+    the tiles its own paths need.
+
+    Parameters:
+    -----------
+        spec : dict
+            Where to describe the shared arrays the workers attach to (see attach)
+
+        g : Grid Class
+            The grid to share
+
+        names : list
+            The names of the fields the workers need
+
+        key : str
+            A unique prefix for this grid's arrays
+
+    Returns:
+    --------
+        node : dict
+            Picklable description of the grid for _rebuild_grid
+    """
+    node = {
+        'geometry'    : (g.ndims, g.ncells, g.boxSize),
+        'origin'      : g.origin,
+        'boundary'    : g.boundary,
+        'precision'   : g.precision,
+        'level'       : g.level,
+        'key'         : key,
+        'fields'      : {},
+        'registry'    : {},
+        'refineBlock' : g.refineBlock,
+        'children'    : [],
+    }
+    for name in names:
+        if name in g.registry:
+            node['registry'][name] = g.registry[name]
+            name = g.registry[name][0]
+        if name in node['fields']:
+            continue
+        data = g.fields[name]
+        if isinstance(data, np.memmap) and isinstance(data.base, mmap.mmap):
+            node['fields'][name] = ('memmap', (data.filename, data.offset, data.shape,
+                data.dtype.str, 'F' if data.flags.f_contiguous and not
+                data.flags.c_contiguous else 'C'))
+        elif isinstance(data, np.ndarray):
+            _move_to_shared(g, name)
+            spec['{}:{}'.format(key, name)] = shared_arrays(g).spec(
+                ['field:' + name])['field:' + name]
+            node['fields'][name] = ('shared', None)
+        elif isinstance(data, storage.LazyArray):
+            node['fields'][name] = ('lazy', data.spec())
+        else:
+            node['fields'][name] = ('chunked', data.spec())
+    if g.children:
+        shared = shared_arrays(g)
+        g._childMap = shared.share('childMap', g._childMap)
+        spec[key + ':childMap'] = shared.spec(['childMap'])['childMap']
+        node['children'] = [_share_grid(spec, c, names, '{}.{}'.format(key, i))
+            for i, c in enumerate(g.children)]
+    return node
+
+
+
+#============================================
+#              _move_to_shared
+#============================================
+def _move_to_shared(g, name):
+    # Swaps an in-memory field for a shared copy, along with any fields that are
+    # views of it (if it's a stack). Nothing is copied if it's already shared
+    shared = shared_arrays(g)
+    data = g.fields[name]
+    moved = shared.share('field:' + name, data)
+    if moved is data:
+        return
+    g.fields[name] = moved
+    g.invalidate(name)
+    for view, (stackName, comps, compShape) in g.registry.items():
+        if stackName == name:
+            g.fields[view] = moved[..., comps].reshape(g.shape + compShape)
+            g.invalidate(view)
+
+
+
+#============================================
+#                _rebuild_grid
+#============================================
+def _rebuild_grid(node, arrays):
+    """
+    Rebuilds a grid hierarchy in a worker around the arrays shared by _share_grid.
+
+    Parameters:
+    -----------
+        node : dict
+            The output of _share_grid
+
+        arrays : dict
+            The attached shared arrays
+
+    Returns:
+    --------
+        g : Grid Class
+            The rebuilt grid
+    """
+    import grid
+    g = grid.Grid(*node['geometry'], origin=node['origin'],
+        boundary=node['boundary'], precision=node['precision'])
+    g.level = node['level']
+    for name, (kind, spec) in node['fields'].items():
+        if kind == 'lazy':
+            g.fields[name] = storage.LazyArray.open(spec, g)
+        elif kind == 'memmap':
+            fname, offset, shape, dtype, order = spec
+            g.fields[name] = np.memmap(fname, dtype=np.dtype(dtype), mode='r',
+                offset=offset, shape=shape, order=order)
+        elif kind == 'chunked':
+            g.fields[name] = storage.ChunkedArray.open(spec)
+        else:
+            g.fields[name] = arrays['{}:{}'.format(node['key'], name)]
+    for name, (stackName, comps, compShape) in node['registry'].items():
+        g.fields[name] = g.fields[stackName][..., comps].reshape(g.shape + compShape)
+        g.registry[name] = (stackName, comps, compShape)
+    if node['children']:
+        g.refineBlock = node['refineBlock']
+        g._childMap = arrays[node['key'] + ':childMap']
+        g.children = [_rebuild_grid(c, arrays) for c in node['children']]
+        for c in g.children:
+            c.parent = g
+    return g
+
+
+
+#============================================
+#              _deposit_buffer
+#============================================
+def _deposit_buffer(size):
+    """
+    The zeroed deposit buffer a worker process deposits its shards into. There's one
+    per process, kept between shards, so a run holds one copy of the grid per worker
+    instead of one per shard. _run_shard zeroes the cells it touched before it
+    returns.
+    """
+    global _depositBuffer
+    if _depositBuffer is None or _depositBuffer.size != size:
+        _depositBuffer = np.zeros(size)
+    return _depositBuffer
+
+
+
+#============================================
+#                 _run_shard
+#============================================
+def _run_shard(task):
+    """
+    Worker entry point. Rebuilds a grid around the shared field arrays (which is O(1)
+    since the grid doesn't allocate anything itself), advances this worker's slice of
+    the ensemble for the whole run, and writes the results straight into shared
+    memory.
+
+    Parameters:
+    -----------
+        task : dict
+            Everything the worker needs; see diffuse
+
+    Returns:
+    --------
+        count : int
+            The number of steps the shard's history recorded
+
+        state : dict
+            The shard's displacement statistics (see stats.TransportStats.state),
+            if they were asked for
+
+        deposit : tuple
+            The cells the shard deposited into and how much went into each, if the
+            tips are being deposited
+    """
+    # These are imported here so that this module doesn't depend on grid (which
+    # imports it)
+    import field
+    import path
+    arrays, blocks = attach(task['spec'])
+    try:
+        start, stop = task['shard']
+        g = _rebuild_grid(task['grid'], arrays)
+        g.paths = path.PathEnsemble(arrays['pos'][start:stop], g.dtype)
+        # Point the ensemble at shared memory so every step lands there directly
+        g.paths.curPos = arrays['pos'][start:stop]
+        g.paths.substep = arrays['substep'][start:stop]
+        g.paths.exitStep = arrays['exitStep'][start:stop]
+        g.paths.exitTime = arrays['exitTime'][start:stop]
+        g.paths.exitPos = arrays['exitPos'][start:stop]
+        g.paths.active = np.nonzero(g.paths.exitStep < 0)[0]
+        for name in task['accumulate']:
+            g.paths.accumulator[name] = arrays['acc:' + name][start:stop]
+        if task['deposit'] is not None:
+            g.paths.occupancy = _deposit_buffer(task['ncells'])
+        if task['statistics']:
+            g.paths.stats = stats.TransportStats(task['nsteps'], g.ndims)
+        g.paths.stepSize = task['stepSize']
+        g.paths.time = task['time']
+        buf = arrays['history'][:, start:stop]
+        g.paths.init_history(task['nsteps'], *task['history'], buffer=buf)
+        g._advect(field.Field(task['name'], None), task['nsteps'], task['stepSize'],
+            *task['scheme'], task['accumulate'], deposit=task['deposit'])
+        count = g.paths.history.count
+        state = None if g.paths.stats is None else g.paths.stats.state()
+        deposit = None
+        if task['deposit'] is not None:
+            # Only the touched cells are sent back, and the buffer is left zeroed for
+            # the next shard
+            touched = np.flatnonzero(g.paths.occupancy)
+            deposit = (touched, g.paths.occupancy[touched])
+            g.paths.occupancy[touched] = 0.
+        # Drop every reference into shared memory before closing it
+        del g, buf
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+    return count, state, deposit
+
+
+
+#============================================
+#                  diffuse
+#============================================
+def diffuse(g, field, nsteps, stepSize, workers, integrator, tol, interpolate,
+    accumulate=(), deposit=None, statistics=False):
+    """
+    The parallel version of Grid._advect. The grid's ensemble must already have its
+    history set up (Grid.diffuse does this). The paths are split into a few shards per
+    worker so that workers that finish early (e.g., because the adaptive integrator
+    needed fewer substeps on their paths) can pick up more work.
+
+    Parameters:
+    -----------
+        g : Grid Class
+            The grid whose paths are being advanced
+
+        field : Field Class
+            The field doing the "kicking"
+
+        nsteps : int
+            The number of steps to take
+
+        stepSize : float
+            The size of each step
+
+        workers : int
+            The number of worker processes
+
+        integrator, tol, interpolate :
+            See Grid.diffuse
+
+        accumulate : list
+            The names of the fields being integrated along the way. Their
+            accumulators have to exist already
+
+        deposit : str, optional
+            The deposit scheme, if the tips are being deposited. Each worker process
+            deposits into its own copy of the grid, and each shard sends back just the
+            cells it touched, which are added up here
+
+        statistics : bool
+            Whether the displacement statistics are being gathered. Each shard keeps
+            its own and they're merged at the end
+
+    Returns:
+    --------
+        None
+    """
+    ens = g.paths
+    hist = ens.history
+    if ens.substep is None:
+        ens.substep = np.full(ens.npaths, stepSize)
+    # Only the field being followed and the ones being integrated are needed by the
+    # workers (on every level of the refinement hierarchy, if there is one)
+    names = [field.name] + [n for n in accumulate if n != field.name]
+    spec = share_ensemble(ens, accumulate)
+    node = _share_grid(spec, g, names, 'grid')
+    shards = split_paths(ens.npaths, 4 * workers)
+    template = {
+        'spec'       : spec,
+        'grid'       : node,
+        'name'       : field.name,
+        'nsteps'     : nsteps,
+        'stepSize'   : stepSize,
+        'time'       : ens.time,
+        'history'    : (hist.mode, hist.stride,
+                          hist.length if hist.mode == 'last' else None),
+        'scheme'     : (integrator, tol, interpolate),
+        'accumulate' : list(accumulate),
+        'deposit'    : deposit,
+        'ncells'     : None if deposit is None else ens.occupancy.size,
+        'statistics' : statistics,
+    }
+    tasks = [dict(template, shard=shard) for shard in shards]
+    # The workers write straight into the ensemble's own arrays
+    with mp.get_context().Pool(workers) as pool:
+        results = pool.map(_run_shard, tasks, chunksize=1)
+    ens.active = np.nonzero(ens.exitStep < 0)[0]
+    if deposit is not None:
+        for _, _, (touched, values) in results:
+            ens.occupancy[touched] += values
+    if statistics:
+        for _, state, _ in results:
+            ens.stats.merge(stats.TransportStats.from_state(state))
+    hist.count = results[0][0]
+    ens.step += nsteps
+    ens.time += nsteps * stepSize
@@ -3,8 +3,11 @@ Title:   path.py
 Author:  Jared Coughlin
 Date:    3/13/19
 Purpose: Contains the path class
-Notes:
+Notes:   PathEnsemble is the vectorized counterpart of Path. It holds the tips of
+            every path in one array so a step is a handful of array operations no
+            matter how many paths there are.
 """
+import numpy as np
 
 
 
@@ -78,3 +81,430 @@ class Path():
         # increase or something
         self.curPos += self.stepSize * grid[ind][field.name]
         return self.curPos
+
+
+
+#============================================
+#             PathEnsemble Class
+#============================================
+class PathEnsemble():
+    """
+    This class represents a whole collection of paths moving through the simulation
+    volume at once. Instead of one Path object per path, the tips of every path are
+    stored as the rows of a single (npaths, ndims) array, so each step updates all of
+    the paths with one gather from the field array.
+
+    Parameters:
+    -----------
+        startingPoints : array_like
+            An (npaths, ndims) set of coordinates for where each path should originate
+
+        dtype : dtype
+            The type the positions are stored as (see Grid's precision)
+
+    Attributes:
+    -----------
+        curPos : ndarray
+            The (npaths, ndims) array of current tip positions
+
+        history : Trajectory
+            The retained positions from the most recent call to Grid.diffuse
+
+        locs : ndarray
+            The retained positions as an (nrecorded, npaths, ndims) array, oldest
+            first
+
+        npaths : int
+            The number of paths in the ensemble
+
+        ndims : int
+            The number of dimensions the paths live in
+
+        active : ndarray
+            The indices of the paths that are still moving. Paths that leave through
+            an absorbing boundary are dropped from this
+
+        exitStep, exitTime, exitPos : ndarray
+            The step, path parameter and position at which each path left the box
+            (-1, nan and nan for paths that are still active)
+
+        occupancy : ndarray
+            The running deposit of the tips onto the grid's cells (flattened), when
+            Grid.diffuse is asked to deposit them. None otherwise
+
+        stats : stats.TransportStats
+            The displacement statistics, when Grid.diffuse is asked for them. None
+            otherwise
+
+    Methods:
+    --------
+        init_history(nsteps, mode, stride, length, buffer)
+            Sets up the trajectory buffer for a run of nsteps steps
+
+        update(grid, ind, field)
+            Advances every tip by one Euler step
+
+        advance(newPos)
+            Moves the active tips to newPos and records the step
+
+        retire(exited, exitTime)
+            Removes paths that left the box from the active set
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, startingPoints, dtype=np.float64):
+        self.startingPoint = np.array(startingPoints, dtype=dtype, ndmin=2)
+        self.curPos = self.startingPoint.copy()
+        self.stepSize = None
+        self.accumulator = {}
+        self.step = 0
+        self.time = 0.
+        self.substep = None
+        self.history = None
+        self.active = np.arange(self.npaths)
+        self.exitStep = np.full(self.npaths, -1, dtype=np.int64)
+        self.exitTime = np.full(self.npaths, np.nan)
+        self.exitPos = np.full(self.curPos.shape, np.nan)
+        self.occupancy = None
+        self.stats = None
+
+    #-----
+    # npaths
+    #-----
+    @property
+    def npaths(self):
+        return self.curPos.shape[0]
+
+    #-----
+    # ndims
+    #-----
+    @property
+    def ndims(self):
+        return self.curPos.shape[1]
+
+    #-----
+    # __len__
+    #-----
+    def __len__(self):
+        return self.npaths
+
+    #-----
+    # locs
+    #-----
+    @property
+    def locs(self):
+        if self.history is None:
+            return self.curPos[np.newaxis].copy()
+        return self.history.positions(self.startingPoint, self.curPos)
+
+    #-----
+    # init_history
+    #-----
+    def init_history(self, nsteps, mode='full', stride=None, length=None, buffer=None,
+        allocate=None):
+        """
+        Sets up a fresh trajectory buffer for a run of nsteps steps starting from the
+        current tip positions, which are recorded as step 0.
+
+        Parameters:
+        -----------
+            nsteps : int
+                The number of steps that are going to be taken
+
+            mode : str
+                The retention mode. See Trajectory
+
+            stride : int, optional
+                The recording interval for mode 'every'
+
+            length : int, optional
+                The number of steps kept by mode 'last'
+
+            buffer : ndarray, optional
+                Existing storage to record into (e.g., a slice of a shared buffer)
+
+            allocate : function, optional
+                Makes the buffer, given its shape and dtype, if there isn't one
+                already (e.g., in shared memory, see parallel.history_allocator)
+
+        Returns:
+        --------
+            None
+        """
+        self.step = 0
+        self.history = Trajectory(nsteps, self.npaths, self.ndims, mode, stride, length,
+            buffer, self.curPos.dtype, allocate)
+        self.history.record(self.step, self.curPos)
+
+    #-----
+    # update
+    #-----
+    def update(self, grid, ind, field):
+        """
+        This function advances the tips of every path to new locations based on the
+        step size and magnitude and direction of the field at their current locations.
+        It then also archives the new positions (if the history keeps this step) for
+        later use.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid the paths are moving through
+
+            ind : ndarray
+                The flattened index of the cell each path's tip is currently in, as
+                returned by Grid._get_cell_indices
+
+            field : Field Class
+                The field doing the "kicking"
+
+        Returns:
+        --------
+            curPos : ndarray
+                The new current positions of the paths' tips
+        """
+        # Update the current positions with a single gather from the field array
+        active = self.active
+        return self.advance(self.curPos[active] + self.stepSize *
+            grid.gather(field.name, ind[active]))
+
+    #-----
+    # advance
+    #-----
+    def advance(self, newPos):
+        """
+        Moves the active tips to their new positions (as worked out by one of the
+        integrators) and archives them. Inactive paths stay where they are.
+
+        Parameters:
+        -----------
+            newPos : ndarray
+                The (nactive, ndims) positions at the end of the step, in the same
+                order as self.active
+
+        Returns:
+        --------
+            curPos : ndarray
+                The new current positions of the paths' tips
+        """
+        if self.active.size == self.npaths:
+            self.curPos[:] = newPos
+        else:
+            self.curPos[self.active] = newPos
+        self.step += 1
+        self.time += self.stepSize
+        if self.history is not None:
+            self.history.record(self.step, self.curPos)
+        return self.curPos
+
+    #-----
+    # retire
+    #-----
+    def retire(self, exited, exitTime):
+        """
+        Records where and when paths left the box and compacts them out of the active
+        set. This has to be called after advance, which has already put the exited
+        paths at their exit points.
+
+        Parameters:
+        -----------
+            exited : ndarray
+                Boolean mask over the active set of the paths that left
+
+            exitTime : ndarray
+                The path parameter at which each of them left
+
+        Returns:
+        --------
+            None
+        """
+        gone = self.active[exited]
+        self.exitStep[gone] = self.step
+        self.exitTime[gone] = exitTime
+        self.exitPos[gone] = self.curPos[gone]
+        self.active = self.active[~exited]
+
+
+
+#============================================
+#              Trajectory Class
+#============================================
+class Trajectory():
+    """
+    Preallocated storage for the positions of an ensemble of paths over a run. The
+    buffer is sized once up front, so recording a step is a single copy into an
+    existing array. How much of the run is kept depends on the mode:
+
+        'full'      : every step, (nsteps+1, npaths, ndims)
+        'every'     : every stride-th step, plus the final step
+        'last'      : the most recent length steps, kept in a ring buffer
+        'endpoints' : nothing. The start and end points are taken from the ensemble
+                      (its startingPoint and curPos), so the history takes no memory
+
+    Parameters:
+    -----------
+        nsteps : int
+            The number of steps in the run
+
+        npaths : int
+            The number of paths being tracked
+
+        ndims : int
+            The number of dimensions
+
+        mode : str
+            The retention mode (see above)
+
+        stride : int, optional
+            The recording interval for mode 'every'
+
+        length : int, optional
+            The number of steps kept by mode 'last'
+
+        buffer : ndarray, optional
+            Existing storage to use instead of allocating a new buffer. It must have
+            shape (nretained, npaths, ndims)
+
+        dtype : dtype
+            The type of a newly allocated buffer
+
+        allocate : function, optional
+            Allocates a new buffer, given its shape and dtype. Defaults to np.empty
+
+    Attributes:
+    -----------
+        buffer : ndarray
+            The raw storage. For mode 'last' the rows are in ring order
+
+    Methods:
+    --------
+        record(step, pos)
+            Stores pos as the positions at the given step, if the mode keeps it
+
+        steps()
+            The step numbers of the retained positions, oldest first
+
+        positions(startingPoint, curPos)
+            The retained positions, oldest first
+    """
+    modes = ('full', 'every', 'last', 'endpoints')
+
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, nsteps, npaths, ndims, mode='full', stride=None, length=None,
+        buffer=None, dtype=np.float64, allocate=None):
+        if mode not in self.modes:
+            raise ValueError('Unknown history mode: {}'.format(mode))
+        self.nsteps  = nsteps
+        self.mode    = mode
+        self.stride  = 1
+        self.length  = nsteps + 1
+        self.count   = 0
+        if mode == 'every':
+            if stride is None or stride < 1:
+                raise ValueError('History mode every needs a positive stride')
+            self.stride = stride
+            self.length = nsteps // stride + 1 + int(nsteps % stride != 0)
+        elif mode == 'last':
+            if length is None or length < 1:
+                raise ValueError('History mode last needs a positive length')
+            self.length = min(length, nsteps + 1)
+        elif mode == 'endpoints':
+            self.length = 0
+        shape = (self.length, npaths, ndims)
+        if buffer is None:
+            buffer = (allocate or np.empty)(shape, dtype)
+        elif buffer.shape != shape:
+            raise ValueError('History buffer has shape {}, expected {}'.format(
+                buffer.shape, shape))
+        self.buffer = buffer
+
+    #-----
+    # record
+    #-----
+    def record(self, step, pos):
+        """
+        Stores the positions for the given step.
+
+        Parameters:
+        -----------
+            step : int
+                The step number (0 is the starting point)
+
+            pos : ndarray
+                The (npaths, ndims) positions at that step
+
+        Returns:
+        --------
+            None
+        """
+        if self.mode == 'endpoints':
+            self.count = step + 1
+            return
+        if self.mode == 'every':
+            if step % self.stride != 0 and step != self.nsteps:
+                return
+            row = self.count
+        elif self.mode == 'last':
+            row = step % self.length
+        else:
+            row = step
+        self.buffer[row] = pos
+        self.count += 1
+
+    #-----
+    # steps
+    #-----
+    def steps(self):
+        """
+        Gets the step numbers of the retained positions.
+
+        Parameters:
+        -----------
+            None
+
+        Returns:
+        --------
+            steps : ndarray
+                The step number of each retained set of positions, oldest first
+        """
+        if self.mode == 'endpoints':
+            return np.unique([0, max(self.count - 1, 0)])
+        if self.mode == 'every':
+            steps = np.arange(0, self.nsteps + 1, self.stride)
+            if steps[-1] != self.nsteps:
+                steps = np.append(steps, self.nsteps)
+            return steps[:self.count]
+        last = self.count - 1
+        return np.arange(max(0, last - self.length + 1), last + 1)
+
+    #-----
+    # positions
+    #-----
+    def positions(self, startingPoint, curPos):
+        """
+        Gets the retained positions in chronological order.
+
+        Parameters:
+        -----------
+            startingPoint : ndarray
+                The starting positions of the paths. Only used by mode 'endpoints'
+
+            curPos : ndarray
+                The current tip positions. Only used by mode 'endpoints'
+
+        Returns:
+        --------
+            positions : ndarray
+                An (nretained, npaths, ndims) array, oldest first. For mode 'last'
+                this is a reordered copy of the ring buffer; otherwise it's a view
+        """
+        if self.mode == 'endpoints':
+            if self.count <= 1:
+                return startingPoint[np.newaxis].copy()
+            return np.stack([startingPoint, curPos])
+        if self.mode == 'last' and self.count > self.length:
+            return np.roll(self.buffer, -(self.count % self.length), axis=0)
+        return self.buffer[:min(self.count, self.length)]
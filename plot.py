@@ -3,9 +3,20 @@ Title:   plot.py
 Author:  Jared Coughlin
 Date:    3/202/19
 Purpose: Contains functions used for making plots from grid quantities
-Notes:
+Notes:   The amount of work done here is bounded no matter how big the run is: the
+            field is drawn from a strided subsample of the cells with a single quiver
+            call, and the paths are thinned to a vertex budget and drawn as a single
+            LineCollection.
 """
+import os
+
+import matplotlib
+# Plots are only ever saved to files, so don't go looking for a display unless a
+# backend was asked for
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import numpy as np
 
 
@@ -13,12 +24,14 @@ import numpy as np
 #============================================
 #                 test_plot
 #============================================
-def test_plot(g, field):
+def test_plot(g, field, fname='diffusion.png', dpi=150, axes=(0, 1), sliceIndex=None,
+    project=False, maxArrows=32, maxVertices=None, maxPaths=2000, figsize=(8, 8)):
     """
     This function plots an arrow showing the magnitude and direction of the field for
-    each cell in the grid, stemming from the center of the cell. It then uses a different
-    set of arrows to display the path of the test particle. This is to serve as a sanity
-    check on what I'm doing. It inherently assumes the data is 2D.
+    a subsample of the cells in the grid, stemming from the center of the cell. It then
+    draws the paths of the test particles on top. This is to serve as a sanity check
+    on what I'm doing. Grids with more than two dimensions are shown as a 2D slice (or
+    projection) onto two of the axes.
 
     Parameteters:
     -------------
@@ -28,35 +41,158 @@ def test_plot(g, field):
         field : field class object
             The name of the field to plot in the cells
 
+        fname : str
+            Where to save the figure
+
+        dpi : int
+            The resolution of the saved figure
+
+        axes : tuple
+            The two grid axes to plot along
+
+        sliceIndex : tuple, optional
+            The cell index along each of the other axes at which to take the slice.
+            Defaults to the middle of the box
+
+        project : bool
+            Average over the other axes instead of taking a slice
+
+        maxArrows : int
+            The most arrows to draw along each axis. The cells are strided to fit
+
+        maxVertices : int, optional
+            The most path vertices to draw in total. Defaults to a quarter of the
+            number of pixels in the figure
+
+        maxPaths : int
+            The most paths to draw
+
+        figsize : tuple
+            The figure size, in inches
+
     Returns:
     --------
         None
     """
+    ax0, ax1 = axes
+    others = [i for i in range(g.ndims) if i not in axes]
     # Set up figure
-    fix, ax = plt.subplots()
+    fig, ax = plt.subplots(figsize=figsize)
+    lo = g.origin
+    hi = g.origin + g.boxSize
     # Set plot limits
-    ax.set_xlim(0, g.boxSize)
-    ax.set_ylim(0, g.boxSize)
-    # Ensure the plot ticks are at the cell boundaries
-    tickLocs = [i * g.cellWidth for i in range(g.ncells)]
-    # Ensure ticks are in the right place (this is because the grid gets plotted where
-    # the ticks are)
-    ax.set_yticks(ticLocs, minor=False)
-    ax.set_xticks(ticLocs, minor=False)
-    # Plot the grid
-    ax.grid(linestyle='--', color='#B4C5E4')
-    # Plot the field arrows in the cells (this doesn't really work units-wise...)
-    for i, c in enumerate(g.grid):
-        ax.arrow(c.loc[0], c.loc[1], c[field.name][0], c[field.name][1], color='#090C9B')
-    # Plot the test particle path
-    # Loop over every path
-    for p in g.paths:
-        # Loop over every segment of the path
-        for i in range(len(p.locs)-1):
-            x = p.locs[i][0]
-            y = p.locs[i][1]
-            dx = p.locs[i+1][0] - p.locs[i][0]
-            dy = p.locs[i+1][1] - p.locs[i][1]
-            ax.arrow(x, y, dx, dy, color='#3C3744')
+    ax.set_xlim(lo[ax0], hi[ax0])
+    ax.set_ylim(lo[ax1], hi[ax1])
+    # Only draw the cell boundaries when there are few enough of them to see. Ensure
+    # ticks are in the right place (this is because the grid gets plotted where the
+    # ticks are)
+    if g.ncells <= 64:
+        tickLocs = [i * g.cellWidth for i in range(g.ncells)]
+        ax.set_yticks(np.array(tickLocs) + lo[ax1], minor=False)
+        ax.set_xticks(np.array(tickLocs) + lo[ax0], minor=False)
+        ax.set_xticklabels([])
+        ax.set_yticklabels([])
+        # Plot the grid
+        ax.grid(linestyle='--', color='#B4C5E4')
+    # Plot the field arrows in a subsample of the cells (this doesn't really work
+    # units-wise...)
+    x, y, u, v = _field_arrows(g, field, ax0, ax1, others, sliceIndex, project,
+        maxArrows)
+    ax.quiver(x, y, u, v, color='#090C9B', angles='xy')
+    # Plot the test particle paths
+    if g.paths is not None:
+        if maxVertices is None:
+            maxVertices = int(figsize[0] * figsize[1] * dpi**2) // 4
+        segs = _path_segments(g, ax0, ax1, maxVertices, maxPaths)
+        ax.add_collection(LineCollection(segs, colors='#3C3744', linewidths=0.5))
     # Save the figure
-    plt.savefig('diffusion.png')
+    fig.savefig(fname, dpi=dpi)
+    plt.close(fig)
+
+
+
+#============================================
+#               _field_arrows
+#============================================
+def _field_arrows(g, field, ax0, ax1, others, sliceIndex, project, maxArrows):
+    """
+    Picks out the field values for the arrows. Only the strided subsample of cells is
+    read (through Grid.gather), so this works the same for every kind of field storage.
+
+    Returns:
+    --------
+        x, y, u, v : ndarray
+            Arrow positions and components, as 2D arrays
+    """
+    stride = max(1, -(-g.ncells // maxArrows))
+    picked = np.arange(stride // 2, g.ncells, stride)
+    axisIndex = [None] * g.ndims
+    axisIndex[ax0] = picked
+    axisIndex[ax1] = picked
+    for i, axis in enumerate(others):
+        if project:
+            axisIndex[axis] = picked
+        elif sliceIndex is not None:
+            axisIndex[axis] = np.array([sliceIndex[i]])
+        else:
+            axisIndex[axis] = np.array([g.ncells // 2])
+    mesh = np.meshgrid(*axisIndex, indexing='ij')
+    cell_ind = np.ravel_multi_index(tuple(m.ravel() for m in mesh), g.shape)
+    values = g.gather(field.name, cell_ind)
+    values = values.reshape(mesh[0].shape + values.shape[1:])
+    # Average (or squeeze out) the other axes
+    if others:
+        values = values.mean(axis=tuple(others))
+    # Vector fields get their in-plane components. Scalars are drawn as arrows along
+    # the first axis so that at least the magnitude shows up
+    if values.ndim == 3 and values.shape[-1] == g.ndims:
+        u = values[..., ax0]
+        v = values[..., ax1]
+    else:
+        u = values.reshape(values.shape[:2] + (-1,))[..., 0]
+        v = np.zeros_like(u)
+    centers0 = g.cell_center(picked, ax0)
+    centers1 = g.cell_center(picked, ax1)
+    x, y = np.meshgrid(centers0, centers1, indexing='ij')
+    # The first two axes of values are in the order the axes were given, which is
+    # only the grid order when ax0 < ax1
+    if ax0 > ax1:
+        u = u.T
+        v = v.T
+    return x, y, u, v
+
+
+
+#============================================
+#              _path_segments
+#============================================
+def _path_segments(g, ax0, ax1, maxVertices, maxPaths):
+    """
+    Thins the paths to fit the vertex budget and turns them into line segments. Paths
+    are subsampled first, then their recorded steps are strided. Positions along
+    periodic axes are wrapped back into the box, and the segments that would jump
+    across it because of the wrap are dropped.
+
+    Returns:
+    --------
+        segs : ndarray
+            (nsegments, 2, 2) array of segment end points
+    """
+    locs = g.paths.locs
+    nrec, npaths = locs.shape[:2]
+    pathStride = max(1, -(-npaths // maxPaths))
+    nshown = -(-npaths // pathStride)
+    stepStride = max(1, -(-(nrec * nshown) // maxVertices))
+    steps = np.arange(0, nrec, stepStride)
+    if steps[-1] != nrec - 1:
+        steps = np.append(steps, nrec - 1)
+    pts = locs[:, ::pathStride][steps][..., [ax0, ax1]]
+    period = np.array([g._periodic[ax0], g._periodic[ax1]])
+    lo = g.origin[[ax0, ax1]]
+    if period.any():
+        wrapped = lo + np.mod(pts - lo, g.boxSize)
+        pts = np.where(period, wrapped, pts)
+    start = pts[:-1].reshape(-1, 2)
+    end = pts[1:].reshape(-1, 2)
+    keep = ~np.any(period & (np.abs(end - start) > 0.5 * g.boxSize), axis=1)
+    return np.stack([start[keep], end[keep]], axis=1)
@@ -0,0 +1,214 @@
+"""
+Title:   snapshots.py
+Date:    10/17/26
+Purpose: Time-dependent fields read from a series of snapshots
+Notes:   Only the two snapshots bracketing the current time are kept on the grid,
+            and the field is interpolated linearly in time between them. While the
+            paths are being advanced through one interval, the snapshot after it is
+            read on a background thread, so by the time it's needed it's usually
+            already in memory. At most three snapshots are ever in memory (the two
+            being used and the one being read), however long the series is.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import field
+
+
+
+#============================================
+#            SnapshotField Class
+#============================================
+class SnapshotField(field.Field):
+    """
+    A field that changes with the path parameter t, given as snapshots at a set of
+    times. Initialize it with Grid.init_field like any other field; Grid.diffuse then
+    moves it along as the paths' time goes on.
+
+    Between snapshots the field is interpolated linearly in time. The snapshots are
+    only moved along at the start of each step, so within a step (e.g., at the later
+    stages of a Runge-Kutta step) times past the end of the current interval are
+    extrapolated from it. Snapshots should be at least a step apart. Past the last
+    snapshot the field is held at its final value.
+
+    Parameters:
+    -----------
+        name : str
+            The name of the field
+
+        fnames : list
+            The snapshot files, in time order. Each holds the whole field, with shape
+            grid.shape (+ component shape)
+
+        times : array_like
+            The time of each snapshot. Must be increasing
+
+        loader : function, optional
+            Reads a snapshot file into an array. Defaults to np.load
+
+    Attributes:
+    -----------
+        times : ndarray
+            The snapshot times
+
+        interval : int
+            The index of the snapshot at the start of the current interval
+
+    Methods:
+    --------
+        advance_to(t)
+            Moves the resident snapshots so that they bracket t
+
+        sample(grid, pos, t, order)
+            The field at a set of positions and times
+    """
+    timeDependent = True
+
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, name, fnames, times, loader=np.load):
+        super().__init__(name, None)
+        self.fnames = list(fnames)
+        self.times = np.asarray(times, dtype=float)
+        if self.times.size != len(self.fnames) or self.times.size < 2:
+            raise ValueError('Need a time for each of at least two snapshots')
+        if np.any(np.diff(self.times) <= 0.):
+            raise ValueError('Snapshot times must be increasing')
+        self.loader = loader
+        self.interval = None
+        self._grid = None
+        self._pool = None
+        self._pending = None
+
+    #-----
+    # attach
+    #-----
+    def attach(self, grid):
+        """
+        Loads the first two snapshots onto the grid (as the fields name + '.lo' and
+        name + '.hi') and starts reading the third. Grid.init_field calls this.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid the field lives on
+
+        Returns:
+        --------
+            None
+        """
+        self.close()
+        self._grid = grid
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._set(self.name + '.lo', self._read(0))
+        self._set(self.name + '.hi', self._read(1))
+        self.interval = 0
+        self._prefetch(2)
+
+    #-----
+    # _read
+    #-----
+    def _read(self, index):
+        data = np.asarray(self.loader(self.fnames[index]), dtype=self._grid.dtype)
+        if data.shape[:self._grid.ndims] != self._grid.shape:
+            raise ValueError('Snapshot {} has shape {}, expected {}'.format(
+                self.fnames[index], data.shape, self._grid.shape))
+        return data
+
+    #-----
+    # _set
+    #-----
+    def _set(self, name, data):
+        self._grid.fields[name] = data
+        self._grid.invalidate(name)
+
+    #-----
+    # _prefetch
+    #-----
+    def _prefetch(self, index):
+        self._pending = None
+        if index < len(self.fnames):
+            self._pending = (index, self._pool.submit(self._read, index))
+
+    #-----
+    # advance_to
+    #-----
+    def advance_to(self, t):
+        """
+        Moves the resident snapshots along until they bracket t (or until the last
+        interval, past which the field is held at the final snapshot). Each move
+        waits for the snapshot being read in the background (if it isn't done) and
+        starts reading the next one.
+
+        Parameters:
+        -----------
+            t : float
+                The time to bracket
+
+        Returns:
+        --------
+            None
+        """
+        # Going back in time (e.g., a new run from the start) means starting over
+        if t < self.times[self.interval]:
+            self.attach(self._grid)
+        # Steps that land on a snapshot time can miss it by round off
+        slack = 1e-9 * (self.times[-1] - self.times[0])
+        while self.interval + 2 < self.times.size and \
+            t >= self.times[self.interval + 1] - slack:
+            index, future = self._pending
+            self._set(self.name + '.lo', self._grid.fields[self.name + '.hi'])
+            self._set(self.name + '.hi', future.result())
+            self.interval = index - 1
+            self._prefetch(index + 1)
+
+    #-----
+    # sample
+    #-----
+    def sample(self, grid, pos, t, order=0):
+        """
+        The field at a set of positions, interpolated linearly in time.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid the field lives on
+
+            pos : ndarray
+                An (npoints, ndims) array of coordinates
+
+            t : float or ndarray
+                The time, either one for every point or one per point
+
+            order : int
+                See Grid.sample
+
+        Returns:
+        --------
+            values : ndarray
+                The field values, with the points along the first axis
+        """
+        t0 = self.times[self.interval]
+        t1 = self.times[self.interval + 1]
+        w = np.maximum((np.asarray(t, dtype=float) - t0) / (t1 - t0), 0.)
+        if self.interval + 2 == self.times.size:
+            w = np.minimum(w, 1.)
+        lo = grid.sample(self.name + '.lo', pos, order)
+        hi = grid.sample(self.name + '.hi', pos, order)
+        if w.ndim:
+            w = w.reshape((-1,) + (1,) * (lo.ndim - 1))
+        return lo + w * (hi - lo)
+
+    #-----
+    # close
+    #-----
+    def close(self):
+        """
+        Stops the background reader.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        self._pool = None
+        self._pending = None
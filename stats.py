@@ -0,0 +1,336 @@
+"""
+Title:   stats.py
+Date:    10/17/26
+Purpose: Transport statistics gathered while the paths are advanced
+Notes:   Everything here is built from the displacement of each tip from its
+            starting point, one step at a time, so no trajectories need to be kept.
+            The mean and the second moments use Welford/Chan style updates, and the
+            distances travelled are binned into a fixed set of bins (at a sample of
+            the steps), which is what lets the statistics of separate shards of paths
+            be merged exactly.
+            Periodic positions are kept unwrapped, so displacements across the box
+            are counted properly.
+"""
+import numpy as np
+
+
+
+#============================================
+#           TransportStats Class
+#============================================
+class TransportStats():
+    """
+    Per-step statistics of the displacement of an ensemble of paths. For each step
+    this keeps the number of paths, their mean displacement, the sum of the outer
+    products of their deviations from the mean (i.e., the unnormalized covariance).
+    That's O(ndims**2) numbers per step, no matter how many paths there are.
+
+    The percentiles of the distance travelled need a histogram of it, which is much
+    bigger than the moments, so there's only one every percentileEvery steps (and
+    one for the last step). By default there are about 100 of them however long the
+    run is, so they don't change how the memory grows with the number of steps.
+
+    The histogram bins are spaced logarithmically over distanceRange, with
+    binsPerDecade bins per factor of ten, and are the same for every set of paths,
+    so histograms just add when statistics are merged. The percentiles of the
+    distance travelled come from the histogram, interpolating within the bin, so
+    they're only as fine as the bins (about 7% of the distance with the default
+    32 bins per decade), but they don't depend on how the paths were split up.
+    Distances below the range are counted in an underflow bin (interpolated
+    linearly from zero) and distances above it are reported as the top of the
+    range.
+
+    Only active paths are counted, so once paths start leaving through an absorbing
+    boundary the statistics are of the ones still in the box.
+
+    Parameters:
+    -----------
+        nsteps : int
+            The number of steps in the run
+
+        ndims : int
+            The number of dimensions
+
+        percentiles : tuple
+            The percentiles of the distance travelled to report at each step
+
+        distanceRange : tuple
+            The smallest and largest distances the histogram resolves
+
+        binsPerDecade : int
+            The number of histogram bins per factor of ten in distance
+
+        percentileEvery : int, optional
+            The number of steps between histograms. Defaults to nsteps / 100,
+            rounded up
+
+    Attributes:
+    -----------
+        count : ndarray
+            The number of paths counted at each step
+
+        time : ndarray
+            The path parameter at each step
+
+        mean : ndarray
+            (nsteps+1, ndims) mean displacement
+
+        M2 : ndarray
+            (nsteps+1, ndims, ndims) sum of the outer products of the deviations
+
+        edges : ndarray
+            The histogram bin edges
+
+        histSteps : ndarray
+            The steps there's a histogram for
+
+        hist : ndarray
+            (nhistSteps, nbins+2) counts of the distance travelled at histSteps.
+            The first and last columns count the distances below and above the range
+
+        envelope : ndarray
+            (nsteps+1, npercentiles) percentiles of the distance travelled, worked
+            out from hist. nan at steps without a histogram or that nothing was
+            recorded for
+
+    Methods:
+    --------
+        record(step, time, disp)
+            Adds a step's displacements
+
+        merge(other)
+            Combines with the statistics of another set of paths
+
+        msd()
+            Mean squared displacement at each step
+
+        dispersion()
+            The dispersion tensor at each step
+
+        diffusivity(start)
+            Effective diffusion coefficient from a fit of the MSD
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, nsteps, ndims, percentiles=(5., 50., 95.),
+        distanceRange=(1e-8, 1e8), binsPerDecade=32, percentileEvery=None):
+        self.nsteps = nsteps
+        self.ndims = ndims
+        self.percentiles = np.asarray(percentiles, dtype=float)
+        if percentileEvery is None:
+            percentileEvery = max(1, -(-nsteps // 100))
+        self.percentileEvery = percentileEvery
+        lo, hi = np.log10(distanceRange)
+        self.edges = np.logspace(lo, hi, int(round((hi - lo) * binsPerDecade)) + 1)
+        self.count = np.zeros(nsteps + 1, dtype=np.int64)
+        self.time = np.zeros(nsteps + 1)
+        self.mean = np.zeros((nsteps + 1, ndims))
+        self.M2 = np.zeros((nsteps + 1, ndims, ndims))
+        self.histSteps = np.union1d(np.arange(0, nsteps + 1, percentileEvery), [nsteps])
+        self.hist = np.zeros((self.histSteps.size, self.edges.size + 1), dtype=np.int64)
+
+    #-----
+    # _hist_row
+    #-----
+    def _hist_row(self, step):
+        # The row of hist for a step, or None if the step doesn't have one
+        row = np.searchsorted(self.histSteps, step)
+        if row < self.histSteps.size and self.histSteps[row] == step:
+            return row
+        return None
+
+    #-----
+    # record
+    #-----
+    def record(self, step, time, disp):
+        """
+        Adds the displacements of a batch of paths at one step. The batch is folded in
+        with Chan's update, so a step can be recorded in pieces.
+
+        Parameters:
+        -----------
+            step : int
+                The step number
+
+            time : float
+                The path parameter at that step
+
+            disp : ndarray
+                (npaths, ndims) displacements from the starting points
+
+        Returns:
+        --------
+            None
+        """
+        self.time[step] = time
+        n = disp.shape[0]
+        if n == 0:
+            return
+        mean = disp.mean(axis=0)
+        dev = disp - mean
+        M2 = dev.T @ dev
+        hist = None
+        if self._hist_row(step) is not None:
+            bins = np.searchsorted(self.edges, np.linalg.norm(disp, axis=1),
+                side='right')
+            hist = np.bincount(bins, minlength=self.edges.size + 1)
+        self._combine(step, n, mean, M2, hist)
+
+    #-----
+    # _combine
+    #-----
+    def _combine(self, step, n, mean, M2, hist):
+        na = self.count[step]
+        total = na + n
+        delta = mean - self.mean[step]
+        self.mean[step] += delta * n / total
+        self.M2[step] += M2 + np.outer(delta, delta) * na * n / total
+        if hist is not None:
+            self.hist[self._hist_row(step)] += hist
+        self.count[step] = total
+
+    #-----
+    # merge
+    #-----
+    def merge(self, other):
+        """
+        Folds in the statistics of a different set of paths over the same steps
+        (e.g., another shard of the ensemble). The moments are exact up to round off
+        and the histograms are exact. Both have to have been made with the same bins,
+        at the same steps.
+
+        Parameters:
+        -----------
+            other : TransportStats
+                The statistics to add
+
+        Returns:
+        --------
+            None
+        """
+        if not (np.array_equal(self.edges, other.edges) and
+            np.array_equal(self.histSteps, other.histSteps)):
+            raise ValueError('Can only merge statistics with the same distance bins')
+        for step in np.nonzero(other.count)[0]:
+            row = other._hist_row(step)
+            self._combine(step, other.count[step], other.mean[step], other.M2[step],
+                None if row is None else other.hist[row])
+        self.time = np.maximum(self.time, other.time)
+
+    #-----
+    # envelope
+    #-----
+    @property
+    def envelope(self):
+        envelope = np.full((self.nsteps + 1, self.percentiles.size), np.nan)
+        for row, step in enumerate(self.histSteps):
+            if self.count[step]:
+                envelope[step] = self._hist_percentiles(self.hist[row])
+        return envelope
+
+    #-----
+    # _hist_percentiles
+    #-----
+    def _hist_percentiles(self, hist):
+        # Percentiles of one step's distances from its histogram. Within a bin the
+        # distance is interpolated logarithmically (linearly in the underflow bin)
+        cum = np.cumsum(hist)
+        target = np.clip(self.percentiles / 100. * cum[-1], 1e-9, cum[-1])
+        k = np.searchsorted(cum, target, side='left')
+        below = np.where(k > 0, cum[k - 1], 0)
+        frac = (target - below) / hist[k]
+        lo = np.concatenate([[0.], self.edges])[np.minimum(k, self.edges.size)]
+        hi = self.edges[np.minimum(k, self.edges.size - 1)]
+        values = np.where(k == 0, frac * hi,
+            lo * (hi / np.where(lo > 0., lo, 1.))**frac)
+        return np.where(k > self.edges.size - 1, self.edges[-1], values)
+
+    #-----
+    # covariance
+    #-----
+    def covariance(self):
+        """
+        The covariance of the displacement at each step, (nsteps+1, ndims, ndims).
+        """
+        n = np.maximum(self.count, 1)[:, np.newaxis, np.newaxis]
+        return self.M2 / n
+
+    #-----
+    # msd
+    #-----
+    def msd(self):
+        """
+        The mean squared displacement at each step. This is the squared mean (the
+        drift) plus the trace of the covariance (the spread).
+        """
+        return (self.mean**2).sum(axis=1) + np.trace(self.covariance(), axis1=1,
+            axis2=2)
+
+    #-----
+    # dispersion
+    #-----
+    def dispersion(self):
+        """
+        The dispersion tensor, covariance / (2 t), at each step. It's nan at t = 0.
+        """
+        t = self.time[:, np.newaxis, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(t > 0., self.covariance() / (2. * t), np.nan)
+
+    #-----
+    # diffusivity
+    #-----
+    def diffusivity(self, start=0.5):
+        """
+        Fits the effective diffusion coefficient from the late time growth of the
+        spread: the slope of each diagonal element of the covariance against time is
+        2 D along that axis. Only the steps after a fraction start of the run are used,
+        to stay clear of the ballistic early phase.
+
+        Parameters:
+        -----------
+            start : float
+                The fraction of the recorded steps to skip before fitting
+
+        Returns:
+        --------
+            D : float
+                The effective diffusion coefficient (averaged over the axes)
+
+            Daxis : ndarray
+                The coefficient along each axis
+        """
+        recorded = np.nonzero(self.count)[0]
+        use = recorded[int(start * recorded.size):]
+        if use.size < 2:
+            raise ValueError('Not enough steps to fit a diffusion coefficient')
+        var = np.diagonal(self.covariance()[use], axis1=1, axis2=2)
+        slope = np.polyfit(self.time[use], var, 1)[0]
+        Daxis = slope / 2.
+        return Daxis.mean(), Daxis
+
+    #-----
+    # state
+    #-----
+    def state(self):
+        """
+        The arrays that make up the statistics (for checkpoints and for sending them
+        back from worker processes).
+        """
+        return {'count' : self.count, 'time' : self.time, 'mean' : self.mean,
+            'M2' : self.M2, 'hist' : self.hist, 'edges' : self.edges,
+            'percentiles' : self.percentiles, 'percentileEvery' : self.percentileEvery}
+
+    #-----
+    # from_state
+    #-----
+    @classmethod
+    def from_state(cls, state):
+        stats = cls(state['count'].size - 1, state['mean'].shape[1],
+            state['percentiles'], percentileEvery=int(state['percentileEvery']))
+        stats.edges = np.array(state['edges'])
+        stats.hist = np.array(state['hist'], dtype=np.int64)
+        for key in ('count', 'time', 'mean', 'M2'):
+            getattr(stats, key)[...] = state[key]
+        return stats
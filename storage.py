@@ -0,0 +1,459 @@
+"""
+Title:   storage.py
+Date:    10/17/26
+Purpose: Contains the field storage that isn't a plain in-memory array
+Notes:   Both kinds of storage here split the grid into cubic tiles and only produce
+            the tiles that are actually touched, keeping them in an LRU cache that's
+            capped at a fixed number of bytes. A ChunkedArray keeps a field on disk
+            in a chunk-major np.memmap (so each chunk of cells is one contiguous run
+            of bytes in the file) and reads tiles from there. A LazyArray doesn't
+            store the field at all; it evaluates the field's blockFunc for a tile the
+            first time that tile is needed (and again if it's been evicted).
+"""
+import abc
+from collections import OrderedDict
+import os
+
+import numpy as np
+
+import instrument
+
+
+
+#============================================
+#              TiledArray Class
+#============================================
+class TiledArray(abc.ABC):
+    """
+    Parent class for field storage that's split into cubic tiles of chunkSize cells
+    per side. It handles the reads and the tile cache; subclasses only have to say how
+    to produce a tile (_read_tile). Tiles on the high edge of the grid are padded out
+    to the full tile size so that every tile can be indexed the same way.
+
+    Reads go through take(), which groups the requested cells by tile and asks for
+    each tile once. Tiles are kept in an LRU cache, so the hot part of the field stays
+    resident while the total memory used stays under cacheBytes.
+
+    Parameters:
+    -----------
+        cellShape : tuple
+            The number of cells along each dimension
+
+        compShape : tuple
+            The shape of the field value in a single cell. Empty for scalars
+
+        chunkSize : int
+            The width of a tile, in cells
+
+        cacheBytes : int
+            The most memory the tile cache is allowed to use
+
+        dtype : dtype
+            The type of the stored values
+
+    Attributes:
+    -----------
+        shape : tuple
+            cellShape + compShape, just like an in-memory field array
+
+        hits, misses : int
+            Tile cache statistics
+
+    Methods:
+    --------
+        take(cell_ind)
+            Gets the values for a set of flattened cell indices
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, cellShape, compShape=(), chunkSize=64, cacheBytes=2**30,
+        dtype=np.float64):
+        self.cellShape  = tuple(cellShape)
+        self.compShape  = tuple(compShape)
+        self.shape      = self.cellShape + self.compShape
+        self.ndims      = len(self.cellShape)
+        self.dtype      = np.dtype(dtype)
+        self.chunkSize  = chunkSize
+        self.cacheBytes = cacheBytes
+        self.nchunks    = tuple(-(-n // chunkSize) for n in self.cellShape)
+        self.chunkShape = (chunkSize,) * self.ndims
+        self._cache = OrderedDict()
+        self._cachedBytes = 0
+        self.hits   = 0
+        self.misses = 0
+
+    #-----
+    # ndim
+    #-----
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    #-----
+    # tile_index
+    #-----
+    def tile_index(self, chunkCoord):
+        """
+        The block of cells (as a tuple of slices) covered by a tile, without the
+        padding.
+        """
+        return tuple(slice(c * self.chunkSize, min((c + 1) * self.chunkSize, n))
+            for c, n in zip(chunkCoord, self.cellShape))
+
+    #-----
+    # _read_tile
+    #-----
+    @abc.abstractmethod
+    def _read_tile(self, chunkCoord):
+        """
+        Produces a tile. Subclasses have to override this.
+
+        Parameters:
+        -----------
+            chunkCoord : tuple
+                The multi-index of the tile
+
+        Returns:
+        --------
+            tile : ndarray
+                The tile's values, with shape (chunkSize,)*ndims + compShape
+        """
+
+    #-----
+    # _load
+    #-----
+    def _load(self, chunkCoord):
+        """
+        Gets a tile from the cache, producing it if it isn't resident.
+
+        Parameters:
+        -----------
+            chunkCoord : tuple
+                The multi-index of the tile
+
+        Returns:
+        --------
+            tile : ndarray
+                The tile's values, flattened to (chunkSize**ndims,) + compShape
+        """
+        chunk = self._cache.get(chunkCoord)
+        if chunk is not None:
+            self.hits += 1
+            self._cache.move_to_end(chunkCoord)
+            return chunk
+        self.misses += 1
+        instrument.count('chunkReads')
+        return self._insert(chunkCoord, self._read_tile(chunkCoord))
+
+    #-----
+    # _insert
+    #-----
+    def _insert(self, chunkCoord, tile):
+        # Puts a tile in the cache, evicting old ones if need be, and returns it
+        # flattened the way _load does
+        chunk = tile.reshape((-1,) + self.compShape)
+        self._cache[chunkCoord] = chunk
+        self._cachedBytes += chunk.nbytes
+        # Evict the least recently used tiles until we're back under the cap (always
+        # keeping the one we just read)
+        while self._cachedBytes > self.cacheBytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._cachedBytes -= old.nbytes
+        return chunk
+
+    #-----
+    # _drop
+    #-----
+    def _drop(self, chunkCoord):
+        old = self._cache.pop(chunkCoord, None)
+        if old is not None:
+            self._cachedBytes -= old.nbytes
+
+    #-----
+    # take
+    #-----
+    def take(self, cell_ind):
+        """
+        Gets the values in a set of cells. The cells are grouped by the tile they're
+        in, so each tile that's touched is looked up once no matter how many of the
+        requested cells it holds.
+
+        Parameters:
+        -----------
+            cell_ind : ndarray
+                Flattened cell indices (see Grid._get_cell_indices)
+
+        Returns:
+        --------
+            values : ndarray
+                The values, with the cells along the first axis
+        """
+        cell_ind = np.asarray(cell_ind)
+        multi = np.unravel_index(cell_ind, self.cellShape)
+        chunkId = np.ravel_multi_index([m // self.chunkSize for m in multi],
+            self.nchunks)
+        localId = np.ravel_multi_index([m % self.chunkSize for m in multi],
+            self.chunkShape)
+        out = np.empty(cell_ind.shape + self.compShape, dtype=self.dtype)
+        order = np.argsort(chunkId, kind='stable')
+        ids, starts = np.unique(chunkId[order], return_index=True)
+        bounds = np.append(starts, order.size)
+        for k, cid in enumerate(ids):
+            sel = order[bounds[k]:bounds[k+1]]
+            chunk = self._load(np.unravel_index(cid, self.nchunks))
+            out[sel] = chunk[localId[sel]]
+        return out
+
+    #-----
+    # __getitem__
+    #-----
+    def __getitem__(self, index):
+        # Only single cells are supported (this is what Cell views use)
+        flat = np.ravel_multi_index(tuple(index[:self.ndims]), self.cellShape)
+        return self.take(np.array([flat]))[0][index[self.ndims:]]
+
+    #-----
+    # __array__
+    #-----
+    def __array__(self, dtype=None, copy=None):
+        # Reassembles the whole field in memory. Only meant for small grids (e.g.,
+        # plotting), since avoiding this is the whole point
+        out = np.empty(self.shape, dtype=self.dtype if dtype is None else dtype)
+        for chunkCoord in np.ndindex(*self.nchunks):
+            dst = self.tile_index(chunkCoord)
+            src = tuple(slice(0, s.stop - s.start) for s in dst)
+            out[dst] = self._read_tile(chunkCoord)[src]
+        return out
+
+
+
+#============================================
+#             ChunkedArray Class
+#============================================
+class ChunkedArray(TiledArray):
+    """
+    A field array that lives on disk. The file is laid out as
+    (nchunks,)*ndims + (chunkSize,)*ndims + compShape, i.e., one chunk after another,
+    so reading a tile is one contiguous read and nothing is paged in until a tile is
+    touched.
+
+    Parameters:
+    -----------
+        fname : str
+            The file backing the array
+
+        mode : str
+            The np.memmap mode. 'w+' makes a new file, 'r' and 'r+' open an existing one
+
+        The rest are the same as for TiledArray
+
+    Attributes:
+    -----------
+        See TiledArray
+
+    Methods:
+    --------
+        spec()
+            Picklable description for reopening the array in another process
+
+        flush()
+            Makes sure everything written has hit the disk
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, fname, cellShape, compShape=(), chunkSize=64, cacheBytes=2**30,
+        mode='w+', dtype=np.float64):
+        super().__init__(cellShape, compShape, chunkSize, cacheBytes, dtype)
+        self.fname = fname
+        self._mm = np.memmap(fname, dtype=self.dtype, mode=mode,
+            shape=self.nchunks + self.chunkShape + self.compShape)
+
+    #-----
+    # spec
+    #-----
+    def spec(self):
+        return {'fname' : self.fname, 'cellShape' : self.cellShape,
+            'compShape' : self.compShape, 'chunkSize' : self.chunkSize,
+            'cacheBytes' : self.cacheBytes, 'dtype' : self.dtype.str}
+
+    #-----
+    # open
+    #-----
+    @classmethod
+    def open(cls, spec, mode='r'):
+        """
+        Reopens an existing array from its spec().
+
+        Parameters:
+        -----------
+            spec : dict
+                The output of spec()
+
+            mode : str
+                'r' for read only, 'r+' to allow writes
+
+        Returns:
+        --------
+            arr : ChunkedArray
+                The reopened array (with an empty cache)
+        """
+        return cls(mode=mode, **spec)
+
+    #-----
+    # flush
+    #-----
+    def flush(self):
+        self._mm.flush()
+
+    #-----
+    # _read_tile
+    #-----
+    def _read_tile(self, chunkCoord):
+        return np.array(self._mm[chunkCoord])
+
+    #-----
+    # __setitem__
+    #-----
+    def __setitem__(self, index, values):
+        """
+        Writes a block of cells. index is a tuple of slices (with a step of one) or
+        integers, one per dimension. The block can span any number of chunks.
+        """
+        index = tuple(slice(i, i + 1) if not isinstance(i, slice) else i
+            for i in index)
+        bounds = [s.indices(n)[:2] for s, n in zip(index, self.cellShape)]
+        values = np.broadcast_to(values, tuple(b - a for a, b in bounds) +
+            self.compShape)
+        ranges = [range(a // self.chunkSize, -(-b // self.chunkSize))
+            for a, b in bounds]
+        for chunkCoord in np.ndindex(*[len(r) for r in ranges]):
+            chunkCoord = tuple(r[c] for r, c in zip(ranges, chunkCoord))
+            src = []
+            dst = []
+            for c, (a, b) in zip(chunkCoord, bounds):
+                lo = max(a, c * self.chunkSize)
+                hi = min(b, (c + 1) * self.chunkSize)
+                src.append(slice(lo - a, hi - a))
+                dst.append(slice(lo - c * self.chunkSize, hi - c * self.chunkSize))
+            self._mm[chunkCoord + tuple(dst)] = values[tuple(src)]
+            self._drop(chunkCoord)
+
+
+
+#============================================
+#               LazyArray Class
+#============================================
+class LazyArray(TiledArray):
+    """
+    A field that's evaluated on demand. Nothing is computed up front; the first time
+    a cell in a tile is read, the field's blockFunc is called for that whole tile and
+    the result goes in the tile cache. Evicted tiles are simply evaluated again the
+    next time they're needed, so blockFunc has to give the same values every time it's
+    called on the same block (random fields need to be seeded, see user_fields).
+
+    Parameters:
+    -----------
+        grid : Grid Class
+            The grid the field lives on (passed on to blockFunc)
+
+        field : Field Class
+            The field to evaluate. It has to have a blockFunc
+
+        chunkSize, cacheBytes :
+            See TiledArray. The component shape comes from evaluating the first tile.
+            Floating point values are stored at the grid's precision
+
+    Attributes:
+    -----------
+        See TiledArray
+
+    Methods:
+    --------
+        See TiledArray
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, grid, field, chunkSize=64, cacheBytes=2**30):
+        if field.blockFunc is None:
+            raise ValueError('Lazy fields need a blockFunc')
+        self.grid  = grid
+        self.field = field
+        # Evaluate one tile to find out what the values look like. It's kept as the
+        # first entry in the cache rather than thrown away
+        super().__init__(grid.shape, (), chunkSize, cacheBytes)
+        origin = (0,) * self.ndims
+        first = self._evaluate(origin)
+        dtype = grid.dtype if first.dtype.kind == 'f' else first.dtype
+        super().__init__(grid.shape, first.shape[self.ndims:], chunkSize, cacheBytes,
+            dtype)
+        self._insert(origin, self._pad(first))
+
+    #-----
+    # _evaluate
+    #-----
+    def _evaluate(self, chunkCoord):
+        index = self.tile_index(chunkCoord)
+        return np.asarray(self.field.blockFunc(self.grid, self.grid.ndims, index))
+
+    #-----
+    # _read_tile
+    #-----
+    def _read_tile(self, chunkCoord):
+        return self._pad(self._evaluate(chunkCoord))
+
+    #-----
+    # _pad
+    #-----
+    def _pad(self, values):
+        values = values.astype(self.dtype, copy=False)
+        if values.shape[:self.ndims] == self.chunkShape:
+            return values
+        # Pad out edge tiles
+        tile = np.zeros(self.chunkShape + self.compShape, dtype=self.dtype)
+        tile[tuple(slice(0, n) for n in values.shape[:self.ndims])] = values
+        return tile
+
+    #-----
+    # spec
+    #-----
+    def spec(self):
+        return {'field' : self.field, 'chunkSize' : self.chunkSize,
+            'cacheBytes' : self.cacheBytes}
+
+    #-----
+    # open
+    #-----
+    @classmethod
+    def open(cls, spec, grid):
+        """
+        Rebuilds a lazy field from its spec() on another grid (e.g., in a worker
+        process). The new copy starts with an empty cache.
+        """
+        return cls(grid, **spec)
+
+
+
+#============================================
+#               field_filename
+#============================================
+def field_filename(storageDir, name):
+    """
+    Gets the path of the file backing a field.
+
+    Parameters:
+    -----------
+        storageDir : str
+            The directory the grid keeps its fields in
+
+        name : str
+            The name of the field
+
+    Returns:
+    --------
+        fname : str
+            The file name
+    """
+    return os.path.join(storageDir, '{}.dat'.format(name))
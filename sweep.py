@@ -0,0 +1,313 @@
+"""
+Title:   sweep.py
+Date:    10/17/26
+Purpose: Runs a parameter sweep in parallel, reusing initialized fields
+Notes:   The sweep file has the same format as a parameter file, except that any value
+            can be a comma separated list (see utils.read_sweep_file). Every
+            combination is run, a few at a time in separate processes, and a summary
+            of each run goes into one table:
+
+                python sweep.py sweep.txt -j 4 -o summary.csv
+
+            Initialized fields are saved in a cache directory under a hash of
+            everything that determines their values (the grid geometry, the field
+            class, the seed and the precision), so runs that only change e.g.
+            stepSize, nsteps or npaths share one field, which they memory map instead
+            of regenerating.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import numpy as np
+
+import grid
+import user_fields as uf
+import utils
+
+
+
+#============================================
+#                field_key
+#============================================
+def field_key(g, field, seed):
+    """
+    The cache key for a field: a hash of everything that determines its values.
+
+    Parameters:
+    -----------
+        g : Grid Class
+            The grid the field is on
+
+        field : Field Class
+            The field
+
+        seed : int
+            The field's seed
+
+    Returns:
+    --------
+        key : str
+            Hex digest
+    """
+    desc = {
+        'ndims'   : g.ndims,
+        'ncells'  : g.ncells,
+        'boxSize' : g.boxSize,
+        'field'   : '{}.{}'.format(type(field).__module__, type(field).__qualname__),
+        'seed'    : seed,
+        'dtype'   : g.dtype.str,
+    }
+    return hashlib.sha256(json.dumps(desc, sort_keys=True).encode()).hexdigest()[:32]
+
+
+
+#============================================
+#             cached_init_field
+#============================================
+def cached_init_field(g, field, seed, cacheDir):
+    """
+    Initializes a field on a grid through the cache. On a miss the field is
+    initialized as usual and saved; either way the grid ends up with a read-only
+    memory map of the cached file, so nothing is copied and runs in different
+    processes share the same pages.
+
+    The file is written under a temporary name and moved into place, so runs that
+    miss on the same field at the same time just do the work twice.
+
+    Parameters:
+    -----------
+        g : Grid Class
+            The grid to put the field on (in-memory storage)
+
+        field : Field Class
+            The field
+
+        seed : int
+            The field's seed (part of the key)
+
+        cacheDir : str
+            The cache directory
+
+    Returns:
+    --------
+        hit : bool
+            Whether the field came from the cache
+    """
+    os.makedirs(cacheDir, exist_ok=True)
+    fname = os.path.join(cacheDir, field_key(g, field, seed) + '.npy')
+    hit = os.path.exists(fname)
+    if not hit:
+        g.init_field(field)
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(g.fields[field.name]))
+        os.replace(tmp, fname)
+    g.fields[field.name] = np.load(fname, mmap_mode='r')
+    g.invalidate(field.name)
+    return hit
+
+
+
+#============================================
+#               prepare_field
+#============================================
+def prepare_field(task):
+    """
+    Makes the grid for a combination of parameters and puts its field on it through
+    the cache.
+
+    Parameters:
+    -----------
+        task : tuple
+            (params, cacheDir)
+
+    Returns:
+    --------
+        g : Grid Class
+            The grid
+
+        field : Field Class
+            The field
+
+        hit : bool
+            Whether the field came from the cache
+    """
+    params, cacheDir = task
+    seed = params.get('seed', 0)
+    g = grid.Grid(params['ndims'], params['ncells'], params['boxSize'],
+        precision=params.get('precision', 'double'))
+    field = uf.OceanCurrent(seed)
+    hit = cached_init_field(g, field, seed, cacheDir)
+    return g, field, hit
+
+
+
+#============================================
+#                 run_config
+#============================================
+def run_config(task):
+    """
+    Runs one combination of parameters and summarizes it.
+
+    Parameters:
+    -----------
+        task : tuple
+            (params, cacheDir). params needs ndims, ncells, boxSize, npaths, nsteps
+            and stepSize. seed (default 0), integrator (default euler) and precision
+            (default double) are optional
+
+    Returns:
+    --------
+        summary : dict
+            The parameters, how long the field and the diffusion took, whether the
+            field came from the cache, and the transport statistics at the end of the
+            run
+    """
+    params, cacheDir = task
+    seed = params.get('seed', 0)
+    integrator = params.get('integrator', 'euler')
+    start = time.perf_counter()
+    g, field, hit = prepare_field(task)
+    fieldSeconds = time.perf_counter() - start
+    rng = np.random.default_rng(seed)
+    g.init_paths(params['npaths'], rng.uniform(0., params['boxSize'],
+        (params['npaths'], params['ndims'])))
+    start = time.perf_counter()
+    g.diffuse(field, params['nsteps'], params['stepSize'], history='endpoints',
+        integrator=integrator, tol=float(params.get('tol', 1e-6)), statistics=True)
+    diffuseSeconds = time.perf_counter() - start
+    stats = g.paths.stats
+    try:
+        D = stats.diffusivity()[0]
+    except ValueError:
+        D = float('nan')
+    summary = dict(params)
+    summary.update({
+        'cacheHit'       : hit,
+        'fieldSeconds'   : fieldSeconds,
+        'diffuseSeconds' : diffuseSeconds,
+        'meanDisp'       : float(np.linalg.norm(stats.mean[-1])),
+        'msd'            : float(stats.msd()[-1]),
+        'diffusivity'    : float(D),
+        'active'         : int(g.paths.active.size),
+    })
+    return summary
+
+
+
+#============================================
+#                   _warm
+#============================================
+def _warm(task):
+    # Pool target for filling the cache. Only returns whether the field was already
+    # there, so the grid isn't sent back
+    return prepare_field(task)[2]
+
+
+
+#============================================
+#                 write_table
+#============================================
+def write_table(summaries, fname):
+    # One row per run. .json gets the list as is, anything else is written as csv
+    if fname.endswith('.json'):
+        with open(fname, 'w') as f:
+            json.dump(summaries, f, indent=2)
+        return
+    columns = []
+    for summary in summaries:
+        columns.extend(k for k in summary if k not in columns)
+    with open(fname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(summaries)
+
+
+
+#============================================
+#                print_table
+#============================================
+def print_table(summaries):
+    if not summaries:
+        return
+    columns = list(summaries[0])
+    cells = [[_format(s.get(c, '')) for c in columns] for s in summaries]
+    widths = [max(len(c), *(len(row[i]) for row in cells))
+        for i, c in enumerate(columns)]
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for row in cells:
+        print('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+
+
+#============================================
+#                  _format
+#============================================
+def _format(value):
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return str(value)
+
+
+
+#============================================
+#                parse_args
+#============================================
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a parameter sweep')
+    parser.add_argument('sweepFile',
+        help='Parameter file whose values can be comma separated lists')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='Number of runs at once')
+    parser.add_argument('-o', '--output', default='sweep_summary.csv',
+        help='Where to save the summary table (.csv or .json)')
+    parser.add_argument('--cache-dir', default='.field_cache',
+        help='Where to keep initialized fields')
+    return parser.parse_args()
+
+
+
+#============================================
+#                   main
+#============================================
+def main():
+    args = parse_args()
+    try:
+        configs = utils.expand_sweep(utils.read_sweep_file(args.sweepFile))
+    except IOError:
+        print('Usage: python sweep.py sweep.txt [-j N] [-o summary.csv]')
+        sys.exit(1)
+    tasks = [(params, args.cache_dir) for params in configs]
+    # Build each distinct field once up front, so runs sharing a field don't race to
+    # make it
+    if args.jobs > 1 and len(tasks) > 1:
+        first = {}
+        for i, (params, _) in enumerate(tasks):
+            first.setdefault(tuple(params.get(k) for k in
+                ('ndims', 'ncells', 'boxSize', 'seed', 'precision')), i)
+        with mp.get_context().Pool(min(args.jobs, len(tasks))) as pool:
+            hits = pool.map(_warm, [tasks[i] for i in first.values()], chunksize=1)
+            summaries = pool.map(run_config, tasks, chunksize=1)
+        # Only the first run with each field would have had to build it
+        for summary in summaries:
+            summary['cacheHit'] = True
+        for i, hit in zip(first.values(), hits):
+            summaries[i]['cacheHit'] = hit
+    else:
+        summaries = [run_config(task) for task in tasks]
+    print_table(summaries)
+    write_table(summaries, args.output)
+
+
+
+#============================================
+#               Run Program
+#============================================
+if __name__ == '__main__':
+    main()
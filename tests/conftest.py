@@ -0,0 +1,11 @@
+"""
+Title:   conftest.py
+Date:    10/17/26
+Purpose: Lets the tests import the modules at the top of the repository
+Notes:
+"""
+import os
+import sys
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+"""
+Title:   test_decomp.py
+Date:    10/17/26
+Purpose: Domain decomposed runs have to match serial runs exactly
+Notes:   Most of the paths start bunched up, so the slabs are uneven and the paths
+            cross between them, and the slabs are redrawn part way through.
+"""
+import numpy as np
+import pytest
+
+import grid
+import user_fields as uf
+
+
+
+#============================================
+#      test_decompose_matches_serial
+#============================================
+@pytest.mark.parametrize('integrator', ['euler', 'rk4', 'dopri5'])
+@pytest.mark.parametrize('boundary', ['periodic', 'absorbing', 'reflecting'])
+def test_decompose_matches_serial(integrator, boundary):
+    field = uf.CorrelatedCurrent(0.08, seed=3)
+    g = grid.Grid(2, 64, 1., boundary=boundary)
+    g.init_field(field)
+    rs = np.random.RandomState(1)
+    start = np.concatenate([rs.normal(0.3, 0.03, (1800, 2)),
+        rs.uniform(0., 1., (200, 2))]) % 1.
+    ends = []
+    for kwargs in ({}, {'workers' : 3, 'decompose' : True, 'rebalanceEvery' : 15}):
+        g.init_paths(len(start), start)
+        g.diffuse(field, 40, 0.004, history='endpoints', integrator=integrator,
+            tol=1e-6 if integrator == 'dopri5' else None, interpolate=True, **kwargs)
+        ends.append((g.paths.curPos.copy(), g.paths.exitStep.copy()))
+    (serialPos, serialExit), (slabPos, slabExit) = ends
+    assert np.array_equal(slabPos, serialPos)
+    assert np.array_equal(slabExit, serialExit)
@@ -0,0 +1,106 @@
+"""
+Title:   test_output.py
+Date:    10/17/26
+Purpose: Streaming trajectories to disk and checkpoint/restart
+Notes:   A crash is faked by making the second checkpoint raise after it's been
+            saved. Resuming from it has to give exactly what the uninterrupted run
+            gave.
+"""
+import numpy as np
+import pytest
+
+import grid
+import output
+import user_fields as uf
+
+
+
+NSTEPS = 100
+EVERY = 25
+
+
+
+#============================================
+#                 setup
+#============================================
+def setup():
+    g = grid.Grid(2, 64, 1.)
+    field = uf.OceanCurrent(2)
+    g.init_field(field)
+    g.init_paths(500, np.random.RandomState(1).uniform(0., 1., (500, 2)))
+    return g, field
+
+
+
+#============================================
+#                 Crash
+#============================================
+class Crash(Exception):
+    pass
+
+
+
+#============================================
+#                crash_after
+#============================================
+def crash_after(monkeypatch, ncheckpoints):
+    # Makes save_checkpoint raise once it's saved ncheckpoints of them
+    save = output.save_checkpoint
+    saved = []
+    def save_then_crash(*args, **kwargs):
+        save(*args, **kwargs)
+        saved.append(True)
+        if len(saved) == ncheckpoints:
+            raise Crash
+    monkeypatch.setattr(output, 'save_checkpoint', save_then_crash)
+
+
+
+#============================================
+#        test_read_trajectory_round_trip
+#============================================
+def test_read_trajectory_round_trip(tmp_path):
+    g, field = setup()
+    writer = output.TrajectoryWriter(str(tmp_path / 'out'), chunkSteps=16,
+        fields=[field])
+    g.diffuse(field, NSTEPS, 0.002, integrator='rk4', writer=writer)
+    traj = output.read_trajectory(str(tmp_path / 'out'))
+    assert np.array_equal(traj['step'], np.arange(NSTEPS + 1))
+    assert np.array_equal(traj['pos'], g.paths.locs)
+    assert traj['values/' + field.name].shape[:2] == (NSTEPS + 1, 500)
+
+
+
+#============================================
+#         test_resume_is_bit_identical
+#============================================
+@pytest.mark.parametrize('streamed', [True, False])
+def test_resume_is_bit_identical(tmp_path, monkeypatch, streamed):
+    # Streamed runs keep only the endpoints and leave the trajectory to the writer.
+    # The others keep the full history, which has to come back from the checkpoint
+    history = 'endpoints' if streamed else 'full'
+    def run(outDir, **kwargs):
+        g, field = setup()
+        writer = None
+        if streamed:
+            writer = output.TrajectoryWriter(str(tmp_path / outDir), chunkSteps=16,
+                fields=[field])
+        g.diffuse(field, NSTEPS, 0.002, history=history, integrator='rk4',
+            writer=writer, accumulate=[field], **kwargs)
+        return g, field
+    ref, field = run('ref')
+    ckpt = str(tmp_path / 'ckpt.npz')
+    with monkeypatch.context() as m:
+        crash_after(m, 2)
+        with pytest.raises(Crash):
+            run('resumed', checkpoint=ckpt, checkpointEvery=EVERY)
+    g, _ = run('resumed', checkpoint=ckpt, checkpointEvery=EVERY, resume=True)
+    assert np.array_equal(g.paths.curPos, ref.paths.curPos)
+    assert np.array_equal(g.paths.locs, ref.paths.locs)
+    assert np.array_equal(g.paths.accumulator[field.name],
+        ref.paths.accumulator[field.name])
+    if streamed:
+        before = output.read_trajectory(str(tmp_path / 'ref'))
+        after = output.read_trajectory(str(tmp_path / 'resumed'))
+        for key in before:
+            assert np.array_equal(after[key], before[key])
@@ -0,0 +1,102 @@
+"""
+Title:   test_parallel.py
+Date:    10/17/26
+Purpose: Runs split over worker processes have to match serial runs exactly
+Notes:   Each path is advanced by the same code whichever process it's in, so the
+            positions, histories and accumulators are compared bit for bit. Only the
+            deposits are summed in a different order.
+"""
+import gc
+import os
+
+import numpy as np
+import pytest
+
+import grid
+import user_fields as uf
+
+
+
+#============================================
+#                  run
+#============================================
+def run(workers, integrator='euler', boundary='periodic', storage='memory',
+    lazy=False, refine=False, tmp_path=None):
+    storageDir = None
+    if tmp_path is not None:
+        storageDir = tmp_path / str(workers)
+        storageDir.mkdir()
+    g = grid.Grid(2, 32, 1., storage=storage, boundary=boundary,
+        storageDir=None if storageDir is None else str(storageDir))
+    field = uf.OceanCurrent(4)
+    g.init_field(field, lazy=lazy)
+    if refine:
+        g.refine(field, threshold=0.)
+    g.init_paths(600, np.random.RandomState(2).uniform(0., 1., (600, 2)))
+    g.diffuse(field, 30, 0.004, integrator=integrator,
+        tol=1e-6 if integrator == 'dopri5' else None, workers=workers,
+        accumulate=[field], deposit='cic')
+    return g, field
+
+
+
+#============================================
+#                 same_run
+#============================================
+def same_run(a, b, field):
+    assert np.array_equal(a.paths.curPos, b.paths.curPos)
+    assert np.array_equal(a.paths.locs, b.paths.locs)
+    assert np.array_equal(a.paths.exitStep, b.paths.exitStep)
+    assert np.array_equal(a.paths.active, b.paths.active)
+    assert np.array_equal(a.paths.accumulator[field.name],
+        b.paths.accumulator[field.name])
+    # The shards' deposits are added up in a different order
+    assert np.allclose(a.fields['occupancy'], b.fields['occupancy'], rtol=1e-12,
+        atol=0.)
+
+
+
+#============================================
+#         test_workers_match_serial
+#============================================
+@pytest.mark.parametrize('integrator', ['euler', 'rk4', 'dopri5'])
+@pytest.mark.parametrize('boundary', ['periodic', 'absorbing', 'reflecting'])
+def test_workers_match_serial(integrator, boundary):
+    serial, field = run(1, integrator, boundary)
+    sharded, _ = run(2, integrator, boundary)
+    same_run(serial, sharded, field)
+
+
+
+#============================================
+#       test_workers_match_serial_storage
+#============================================
+@pytest.mark.parametrize('storage, lazy, refine', [
+    ('disk', False, False), ('memory', True, False), ('memory', False, True)])
+def test_workers_match_serial_storage(tmp_path, storage, lazy, refine):
+    serial, field = run(1, 'rk4', storage=storage, lazy=lazy, refine=refine,
+        tmp_path=tmp_path)
+    sharded, _ = run(2, 'rk4', storage=storage, lazy=lazy, refine=refine,
+        tmp_path=tmp_path)
+    same_run(serial, sharded, field)
+
+
+
+#============================================
+#          test_arrays_stay_shared
+#============================================
+def test_arrays_stay_shared():
+    # A second parallel run reuses the shared arrays the first one made instead of
+    # copying everything in and out again
+    g, field = run(2)
+    values = g.fields[field.name]
+    pos = g.paths.curPos
+    g.diffuse(field, 10, 0.004, workers=2)
+    assert g.fields[field.name] is values
+    assert g.paths.curPos is pos
+    names = [b.name for b in g._sharedArrays._blocks.values()] + \
+        [b.name for b in g.paths._sharedArrays._blocks.values()]
+    assert all(os.path.exists('/dev/shm/' + n.lstrip('/')) for n in names)
+    del g, values, pos
+    gc.collect()
+    assert not any(os.path.exists('/dev/shm/' + n.lstrip('/')) for n in names)
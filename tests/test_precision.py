@@ -0,0 +1,72 @@
+"""
+Title:   test_precision.py
+Date:    10/17/26
+Purpose: Bounds the error of single precision runs against double precision ones
+Notes:   Each integrator gets its own bound. The ones that interpolate the field
+            between cell centers move the paths smoothly, so every path has to stay
+            within a small fraction of a cell of its float64 reference. Euler without
+            interpolation follows the value in the cell a path is in, and a rounding
+            error can put a path on the other side of a cell edge from its reference,
+            after which it goes its own way. There only the bulk of the ensemble and
+            its statistics are bounded.
+"""
+import numpy as np
+import pytest
+
+import bench
+import grid
+import user_fields as uf
+
+
+
+# integrator, interpolate, max error (cells), 99th percentile error (cells), relative
+# error of the mean squared displacement
+BOUNDS = [
+    ('euler',    True, 1e-2,   1e-3, 1e-5),
+    ('midpoint', None, 1e-2,   1e-3, 1e-5),
+    ('rk4',      None, 1e-2,   1e-3, 1e-5),
+    ('dopri5',   None, 1e-2,   1e-3, 1e-5),
+    ('euler',    None, np.inf, 1e-3, 1e-3),
+]
+
+
+
+#============================================
+#           test_single_precision_error
+#============================================
+@pytest.mark.parametrize('integrator, interpolate, maxError, p99Error, msdError',
+    BOUNDS)
+def test_single_precision_error(integrator, interpolate, maxError, p99Error,
+    msdError):
+    # bench.run_case runs single precision cases again at double precision and
+    # measures the difference (see bench.precision_error)
+    params = {'ndims' : 2, 'ncells' : 64, 'boxSize' : 100., 'npaths' : 4000,
+        'nsteps' : 50, 'stepSize' : 0.1, 'integrator' : integrator,
+        'interpolate' : interpolate, 'tol' : 1e-6, 'precision' : 'single'}
+    error = bench.run_case(params)['error']
+    assert error['maxError'] < maxError
+    assert error['p99Error'] < p99Error
+    assert error['msdError'] < msdError
+
+
+
+#============================================
+#        test_storage_is_bit_identical
+#============================================
+@pytest.mark.parametrize('precision', ['double', 'single'])
+@pytest.mark.parametrize('boundary, integrator', [('reflecting', 'dopri5'),
+    ('absorbing', 'rk4'), ('periodic', 'euler')])
+def test_storage_is_bit_identical(tmp_path, precision, boundary, integrator):
+    # Every storage is interpolated the same way, so it can't change the paths
+    field = uf.CorrelatedCurrent(0.1, 3)
+    ends = []
+    for storage, lazy in (('memory', False), ('disk', False), ('memory', True)):
+        g = grid.Grid(2, 32, 1., storage=storage, storageDir=str(tmp_path),
+            boundary=boundary, precision=precision)
+        g.init_field(field, lazy=lazy)
+        g.init_paths(1000, np.random.default_rng(1).uniform(0., 1., (1000, 2)))
+        g.diffuse(field, 50, 0.01, history='endpoints', integrator=integrator,
+            tol=1e-6, interpolate=True)
+        ends.append(g.paths.curPos)
+    assert np.array_equal(ends[0], ends[1])
+    assert np.array_equal(ends[0], ends[2])
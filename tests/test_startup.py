@@ -0,0 +1,29 @@
+"""
+Title:   test_startup.py
+Date:    10/17/26
+Purpose: Keeps the command line quick to start
+Notes:   Everything beyond argparse is imported by the subcommand that needs it, so a
+            run that doesn't plot, interpolate or write HDF5 must not load
+            matplotlib, scipy or h5py. bench.startup_case does the timing, in a
+            fresh interpreter, since this one may have imported them already.
+"""
+import bench
+
+
+
+HEAVY = ('matplotlib', 'scipy', 'h5py')
+# Seconds from importing main to a parsed command line with the modules a run uses
+# loaded. The CLI takes about 0.1 s with the imports deferred and over 1 s without
+MAX_STARTUP = 0.5
+
+
+
+#============================================
+#             test_run_startup_is_light
+#============================================
+def test_run_startup_is_light():
+    # Best of a few, so a busy machine doesn't fail the timing
+    results = [bench.startup_case(HEAVY) for _ in range(3)]
+    assert results[0]['heavyModules'] == []
+    seconds = min(r['phases']['import_run']['seconds'] for r in results)
+    assert seconds < MAX_STARTUP
@@ -0,0 +1,58 @@
+"""
+Title:   test_stats.py
+Date:    10/17/26
+Purpose: Streaming transport statistics
+Notes:
+"""
+import numpy as np
+
+import grid
+import stats
+import user_fields as uf
+
+
+
+#============================================
+#         test_histograms_are_sampled
+#============================================
+def test_histograms_are_sampled():
+    # A long run keeps about 100 histograms, not one per step
+    st = stats.TransportStats(10**5, 3)
+    assert st.hist.shape[0] == 101
+    assert st.histSteps[0] == 0 and st.histSteps[-1] == 10**5
+    assert stats.TransportStats(37, 3).hist.shape[0] == 38
+
+
+
+#============================================
+#        test_percentiles_within_a_bin
+#============================================
+def test_percentiles_within_a_bin():
+    st = stats.TransportStats(2, 2)
+    disp = np.random.default_rng(0).normal(0., 1., (100000, 2))
+    st.record(1, 1., disp)
+    exact = np.percentile(np.linalg.norm(disp, axis=1), st.percentiles)
+    # Bins are 10**(1/32), about 7.5%, wide
+    assert np.allclose(st.envelope[1], exact, rtol=0.075)
+    assert np.isnan(st.envelope[2]).all()
+
+
+
+#============================================
+#     test_statistics_independent_of_workers
+#============================================
+def test_statistics_independent_of_workers():
+    field = uf.OceanCurrent(2)
+    results = []
+    for workers in (1, 2):
+        g = grid.Grid(2, 32, 1.)
+        g.init_field(field)
+        g.init_paths(3000, np.random.RandomState(1).uniform(0., 1., (3000, 2)))
+        g.diffuse(field, 40, 0.003, history='endpoints', integrator='rk4',
+            statistics=True, workers=workers)
+        results.append(g.paths.stats)
+    serial, sharded = results
+    assert np.array_equal(serial.count, sharded.count)
+    assert np.array_equal(serial.hist, sharded.hist)
+    assert np.array_equal(serial.envelope, sharded.envelope, equal_nan=True)
+    assert np.allclose(serial.msd(), sharded.msd(), rtol=1e-12)
@@ -14,18 +14,24 @@ import field
 #============================================
 #             OceanCurrent Class
 #============================================
-class OceanCurrent(field.Field):
+class OceanCurrent(field.RandomField):
     """
     This is a test field. It models the current of a patch of ocean as random velocity
     vectors in each cell.
 
     Parameters:
     -----------
-        None
+        seed : int, optional
+            The seed for the field. The same seed always gives the same field, however
+            it's initialized (see field.RandomField). Drawn from np.random if not given
+
+        rngBlock : int
+            The width, in cells, of the RNG blocks
 
     Attributes:
     -----------
-        pass
+        seed : int
+            The seed in use
 
     Methods:
     --------
@@ -34,8 +40,9 @@ class OceanCurrent(field.Field):
     #-----
     # Constructor
     #-----
-    def __init__(self):
-        super().__init__('OceanCurrent', self.random_vel)
+    def __init__(self, seed=None, rngBlock=16):
+        super().__init__('OceanCurrent', self.random_vel, self.random_vel_block, seed,
+            rngBlock)
 
     #-----
     # random_vel
@@ -43,7 +50,7 @@ class OceanCurrent(field.Field):
     def random_vel(self, grid, ndims, index):
         """
         This function is the assignmentFunc for this field. It assigns a random vector
-        to each cell.
+        to each cell. The vector is the same one random_vel_block gives the cell.
 
         Parameters:
         -----------
@@ -57,5 +64,153 @@ class OceanCurrent(field.Field):
         Returns:
         --------
         """
-        vel = np.random.normal(size=ndims)
+        block = tuple(slice(i, i + 1) for i in index)
+        vel = self.normal_block(grid.grid, block, (ndims,))[(0,) * ndims]
+        return vel
+
+    #-----
+    # random_vel_block
+    #-----
+    def random_vel_block(self, grid, ndims, index):
+        """
+        This function is the blockFunc for this field. It assigns a random vector to
+        every cell in a block, drawing from the streams of the RNG blocks the block
+        overlaps.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The current grid for which the field values are being initialized
+
+            index : tuple
+                A tuple of slices giving the block of cells being initialized
+
+        Returns:
+        --------
+            vel : ndarray
+                The random vectors, with shape block shape + (ndims,)
+        """
+        vel = self.normal_block(grid, index, (ndims,))
+        return vel
+
+
+
+#============================================
+#          CorrelatedCurrent Class
+#============================================
+class CorrelatedCurrent(field.RandomField):
+    """
+    Like OceanCurrent, but the velocity is spatially correlated. The white noise from
+    the RNG blocks is filtered in Fourier space with a Gaussian kernel, so each
+    component has covariance exp(-r**2 / (2 * corrLength**2)) and unit variance. The
+    filtering needs the whole grid at once, so the field is built in bulk the first
+    time any block of it is asked for and blocks are then sliced out of that. The
+    field is periodic over the grid.
+
+    Parameters:
+    -----------
+        corrLength : float
+            The correlation length, in the same units as boxSize
+
+        seed : int, optional
+            The seed for the white noise. Drawn from np.random if not given
+
+        rngBlock : int
+            The width, in cells, of the RNG blocks
+
+    Attributes:
+    -----------
+        corrLength : float
+            The correlation length
+
+    Methods:
+    --------
+        pass
+    """
+    #-----
+    # Constructor
+    #-----
+    def __init__(self, corrLength, seed=None, rngBlock=16):
+        super().__init__('CorrelatedCurrent', self.correlated_vel,
+            self.correlated_vel_block, seed, rngBlock)
+        self.corrLength = corrLength
+        self._built = None
+
+    #-----
+    # __getstate__
+    #-----
+    def __getstate__(self):
+        # Workers rebuild the field themselves rather than getting a pickled copy
+        state = super().__getstate__()
+        state['_built'] = None
+        return state
+
+    #-----
+    # build
+    #-----
+    def build(self, grid):
+        """
+        Makes the field over the whole grid. The result is kept for the last grid it
+        was built for.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The grid to build the field on
+
+        Returns:
+        --------
+            vel : ndarray
+                The velocity in every cell, with shape grid.shape + (ndims,)
+        """
+        key = (grid.shape, grid.cellWidth, tuple(grid.origin), grid.level)
+        if self._built is not None and self._built[0] == key:
+            return self._built[1]
+        ndims = grid.ndims
+        axes = tuple(range(ndims))
+        noise = self.normal_block(grid, tuple(slice(0, n) for n in grid.shape),
+            (ndims,))
+        # Gaussian filter. Its square has to average to one over the full set of
+        # modes for the output to have unit variance
+        k = [2. * np.pi * np.fft.fftfreq(n, grid.cellWidth) for n in grid.shape]
+        k2 = sum(np.meshgrid(*[ki**2 for ki in k], indexing='ij', sparse=True))
+        kernel = np.exp(-k2 * self.corrLength**2 / 4.)
+        kernel /= np.sqrt(np.mean(kernel**2))
+        half = kernel[..., :grid.shape[-1] // 2 + 1]
+        modes = np.fft.rfftn(noise, axes=axes) * half[..., np.newaxis]
+        vel = np.fft.irfftn(modes, s=grid.shape, axes=axes)
+        self._built = (key, vel)
         return vel
+
+    #-----
+    # correlated_vel
+    #-----
+    def correlated_vel(self, grid, ndims, index):
+        """
+        This function is the assignmentFunc for this field. It looks the cell up in
+        the bulk field.
+        """
+        return self.build(grid.grid)[tuple(index)]
+
+    #-----
+    # correlated_vel_block
+    #-----
+    def correlated_vel_block(self, grid, ndims, index):
+        """
+        This function is the blockFunc for this field. It slices the block out of the
+        bulk field.
+
+        Parameters:
+        -----------
+            grid : Grid Class
+                The current grid for which the field values are being initialized
+
+            index : tuple
+                A tuple of slices giving the block of cells being initialized
+
+        Returns:
+        --------
+            vel : ndarray
+                The velocities, with shape block shape + (ndims,)
+        """
+        return self.build(grid)[tuple(index)]
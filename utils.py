@@ -5,6 +5,7 @@ Date:    3/13/19
 Purpose: Contains helper functions
 Notes:
 """
+import itertools
 
 
 
@@ -16,7 +17,9 @@ def get_registers():
                     'nsteps',
                     'npaths',
                     'ndims',
-                    'ncells'
+                    'ncells',
+                    'workers',
+                    'seed'
                     ]
     float_register = [
                         'boxSize',
@@ -43,3 +46,38 @@ def read_parameter_file(fname):
                 value = float(value)
             params[key] = value
     return params
+
+
+
+#============================================
+#              read_sweep_file
+#============================================
+def read_sweep_file(fname):
+    # Same format as read_parameter_file, except that any value can be a comma
+    # separated list. Every key maps to a list of values, and the sweep is over every
+    # combination of them (see expand_sweep)
+    params = {}
+    int_register, float_register = get_registers()
+    with open(fname, 'r') as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            key, value = line.split(':')
+            key = key.strip()
+            values = [v.strip() for v in value.split(',')]
+            if key in int_register:
+                values = [int(v) for v in values]
+            elif key in float_register:
+                values = [float(v) for v in values]
+            params[key] = values
+    return params
+
+
+
+#============================================
+#               expand_sweep
+#============================================
+def expand_sweep(sweep):
+    # Turns {key : [values]} into one parameter dict per combination of values
+    keys = list(sweep.keys())
+    return [dict(zip(keys, combo)) for combo in itertools.product(*sweep.values())]